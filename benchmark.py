@@ -0,0 +1,231 @@
+# coding: utf-8
+
+import time
+import torch
+import logging
+from config import Args
+from train import eval, to_device, autocast
+from models.gate import Gate
+from models.bert_gate import BertGate
+from models.modules.GlobalAttention import GlobalAttention
+from dataloader import load_dev_dataloader
+from binding_runtime import BindingRuntime
+from utils import load_model, set_seed, masked_attention, sequence_mask
+
+logger = logging.getLogger('binding')
+
+
+def load_batches(data_loader, args, max_batches=None):
+    """
+    :return: [(inputs, labels)] moved to the device, so the timing does not include the dataloader.
+    """
+    batches = []
+    for data in data_loader:
+        if max_batches is not None and len(batches) >= max_batches:
+            break
+        batches.append((to_device(data[0], args.device), data[1][0].to(args.device)))
+    return batches
+
+
+def synchronize(args):
+    if args.device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def measure_latency(model, data_loader, args, max_batches=None):
+    """
+    :return: seconds per question of the forward of model, under autocast when args.amp.
+    """
+    batches = load_batches(data_loader, args, max_batches=max_batches)
+    model.eval()
+    total_time, total = 0., 0
+    with torch.no_grad(), autocast(args):
+        # warm up
+        model(batches[0][0])
+        for inputs, _ in batches:
+            start = time.time()
+            model(inputs)
+            synchronize(args)
+            total_time += time.time() - start
+            total += inputs[0][0].size(0)
+    return total_time / total
+
+
+def measure_train_step(model, data_loader, args, max_batches=None):
+    """
+    :return: seconds per question of forward and backward, and bytes per question of the tensors saved for backward,
+             which are most of the training memory and what autocast halves.
+    """
+    batches = load_batches(data_loader, args, max_batches=max_batches)
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=-100)
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.dtype, tensor.size())] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    model.train()
+    total_time, total, total_bytes = 0., 0, 0
+    for step, (inputs, labels) in enumerate(batches):
+        saved.clear()
+        start = time.time()
+        with autocast(args), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            _, _, logit = model(inputs)
+            logit = logit.float()
+            loss = 0
+            for ti in range(logit.size(1)):
+                loss += criterion(logit[:, ti], labels[:, ti])
+        loss.backward()
+        model.zero_grad()
+        synchronize(args)
+        # the first step is the warm up
+        if step > 0:
+            total_time += time.time() - start
+            total += labels.size(0)
+            total_bytes += sum(saved.values())
+    return total_time / total, total_bytes / total
+
+
+def benchmark_bert_layers(args, layers_list, checkpoints=None, max_batches=50):
+    """
+    latency and accuracy on dev of BertGate with part of the bert layers.
+    :param layers_list: values of args.bert_layers, e.g. [None, 2, 4, 6, 8] or [(0, 1, 2, 3)].
+    :param checkpoints: {bert_layers: path of a BertGate trained with these bert_layers},
+                        bert_layers without a checkpoint are built from the pretrained bert_model and only get the latency.
+    """
+    checkpoints = checkpoints or {}
+    data_loader = load_dev_dataloader(args)
+    results, args_bert_layers = [], args.bert_layers
+    for bert_layers in layers_list:
+        if bert_layers in checkpoints:
+            model = load_model(checkpoints[bert_layers], args.device, args=args)
+        else:
+            args.bert_layers = bert_layers
+            model = BertGate(args=args)
+        model.to(args.device)
+        latency = measure_latency(model, data_loader, args, max_batches=max_batches)
+        correct_ratio = None
+        if bert_layers in checkpoints:
+            correct, total = eval(data_loader, args, model)
+            correct_ratio = correct / total
+        results.append((bert_layers, model.bert_model.config.num_hidden_layers, latency, correct_ratio))
+    args.bert_layers = args_bert_layers
+    print('bert_layers\tnum_layers\tms/question\tcorrect_ratio')
+    for bert_layers, num_layers, latency, correct_ratio in results:
+        print('{}\t{}\t{:.3f}\t{}'.format(bert_layers, num_layers, latency * 1000, correct_ratio))
+    return results
+
+
+def benchmark_amp(args, max_batches=20):
+    """
+    train step and inference of Gate or BertGate on dev in float32 and under autocast of args.amp_dtype.
+    """
+    data_loader = load_dev_dataloader(args)
+    model = Gate(args=args) if args.bert_model is None else BertGate(args=args)
+    model.to(args.device)
+    results = []
+    for amp in [False, True]:
+        args.amp = amp
+        step_time, saved_bytes = measure_train_step(model, data_loader, args, max_batches=max_batches)
+        latency = measure_latency(model, data_loader, args, max_batches=max_batches)
+        results.append((amp, step_time, saved_bytes, latency))
+    args.amp = False
+    print('amp\tms/question train\tMB/question saved\tms/question eval')
+    for amp, step_time, saved_bytes, latency in results:
+        print('{}\t{:.3f}\t{:.3f}\t{:.3f}'.format(amp, step_time * 1000, saved_bytes / 2 ** 20, latency * 1000))
+    print('train speedup: {:.2f}, saved memory ratio: {:.2f}, eval speedup: {:.2f}'.format(
+        results[0][1] / results[1][1], results[1][2] / results[0][2], results[0][3] / results[1][3]))
+    return results
+
+
+def benchmark_onnx(checkpoint_path, onnx_path, args, max_batches=50, num_threads=None):
+    """
+    parity and latency on dev of a model exported by export.export_onnx against the eager checkpoint, on cpu.
+    """
+    args.device, args.cuda = torch.device('cpu'), False
+    data_loader = load_dev_dataloader(args)
+    model = load_model(checkpoint_path, args.device, args=args).eval()
+    runtime = BindingRuntime(onnx_path, num_threads=num_threads)
+    batches = load_batches(data_loader, args, max_batches=max_batches)
+    max_diff, same, total = 0., 0, 0
+    with torch.no_grad():
+        for inputs, _ in batches:
+            _, _, expected = model(inputs)
+            expected_pred = expected.argmax(-1).numpy()
+            actual = runtime.run(inputs)[2]
+            for index, pred in enumerate(runtime.bind(inputs)):
+                length = len(pred)
+                max_diff = max(max_diff, float(abs(expected[index, :length].numpy() - actual[index, :length]).max()))
+                same += int(pred == expected_pred[index, :length].tolist())
+                total += 1
+    torch_latency = measure_latency(model, data_loader, args, max_batches=max_batches)
+    # warm up
+    runtime.run(batches[0][0])
+    start = time.time()
+    for inputs, _ in batches:
+        runtime.run(inputs)
+    onnx_latency = (time.time() - start) / total
+    print('max diff: {}, same bindings: {}/{}'.format(max_diff, same, total))
+    print('torch: {:.3f} ms/question, onnxruntime: {:.3f} ms/question'.format(torch_latency * 1000, onnx_latency * 1000))
+    return max_diff, same / total, torch_latency, onnx_latency
+
+
+def unfused_attention(query, key, value, lengths):
+    """
+    the dot attention as GlobalAttention and Attention did it before masked_attention, the reference of benchmark_attention.
+    """
+    align = torch.bmm(query, key.transpose(1, 2))
+    align = align.masked_fill(~sequence_mask(lengths, key.size(1)).bool().unsqueeze(1), -float('inf'))
+    align_vectors = torch.softmax(align, dim=-1)
+    return torch.bmm(align_vectors, value), align_vectors
+
+
+def benchmark_attention(args, shapes=((64, 1, 30), (64, 30, 30), (64, 40, 200), (16, 100, 600)), dim=200, repeat=100):
+    """
+    latency of the dot / general attention: the unfused steps, masked_attention with the weights (what the models run)
+    and without them (scaled_dot_product_attention), on random inputs of args.device.
+    :param shapes: (batch_size, tgt_len, src_len)
+    """
+    attention = GlobalAttention(args, dim, attn_type='general').to(args.device).eval()
+    variants = [('unfused', unfused_attention),
+                ('masked_attention', masked_attention),
+                ('sdpa', lambda query, key, value, lengths: masked_attention(query, key, value, lengths=lengths, need_weights=False))]
+    results = []
+    with torch.no_grad():
+        for batch_size, tgt_len, src_len in shapes:
+            input, context = torch.randn(batch_size, tgt_len, dim, device=args.device), torch.randn(batch_size, src_len, dim, device=args.device)
+            lengths = torch.randint(1, src_len + 1, (batch_size, ), device=args.device)
+            query, key = attention.dot_inputs(input, context)
+            expected = unfused_attention(query, key, context, lengths)
+            # the module runs masked_attention
+            max_diff = (attention(input, context, lengths)[1] - expected[1]).abs().max().item()
+            latencies = []
+            for name, run in variants:
+                # warm up
+                run(query, key, context, lengths)
+                synchronize(args)
+                start = time.time()
+                for _ in range(repeat):
+                    run(query, key, context, lengths)
+                synchronize(args)
+                latencies.append((time.time() - start) / repeat)
+                max_diff = max(max_diff, (run(query, key, context, lengths)[0] - expected[0]).abs().max().item())
+            results.append(((batch_size, tgt_len, src_len), latencies, max_diff))
+    print('batch_size, tgt_len, src_len\t' + '\t'.join('{} ms'.format(name) for name, _ in variants) + '\tmax diff')
+    for shape, latencies, max_diff in results:
+        print('{}\t'.format(shape) + '\t'.join('{:.3f}'.format(latency * 1000) for latency in latencies) + '\t{:.2e}'.format(max_diff))
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = Args()
+    set_seed(args.seed)
+    args.model = 'gate'
+    args.attn_concat = True
+    args.bucket_batching = True
+    benchmark_bert_layers(args, [None, 2, 4, 6, 8])
+    # args.amp_dtype = torch.bfloat16
+    # benchmark_amp(args)
+    # benchmark_onnx('./res/gate/epoch100', './res/gate/epoch100.onnx', args)
+    # benchmark_attention(args)
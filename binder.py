@@ -0,0 +1,201 @@
+# coding: utf-8
+
+import torch
+import logging
+from train import autocast, to_device
+from models.gate import Gate
+from models.modules.TableEncodingCache import TableEncodingCache
+from pytorch_pretrained_bert import BertTokenizer
+from wordpiece import FastWordPieceTokenizer
+from dataloader import BindingDataset, load_data_from_train, trim_batch
+from utils import UNK_WORD, get_annotate, build_info, load_model
+
+logger = logging.getLogger('binding')
+
+
+def decode_bindings(pointer_align_scores, tokenize_len, columns_len, columns_num, values_len=None):
+    """
+    the argmax of pointer_align_scores to the labels of preprocess_info: UNK_WORD, Column_i or Value_j.
+    the padded columns and values of every question are masked, their scores are not comparable to the real ones.
+    :param columns_len: number of the columns of every question.
+    :param columns_num: number of the columns in pointer_align_scores, col_align_score.size(-1).
+    :param values_len: number of the cells of every question, None when all the values share one score, they are decoded to 'Value'.
+    :return: list of labels of every question.
+    """
+    slots = torch.arange(pointer_align_scores.size(-1)).unsqueeze(0)
+    valid = (slots == 0) | ((slots >= 1) & (slots <= columns_len.unsqueeze(1)))
+    values_num = torch.ones_like(columns_len) if values_len is None else values_len
+    valid = valid | ((slots > columns_num) & (slots <= columns_num + values_num.unsqueeze(1)))
+    pred = pointer_align_scores.masked_fill(~valid.unsqueeze(1), -float('inf')).argmax(-1)
+    res = []
+    for row, length in zip(pred.tolist(), tokenize_len.tolist()):
+        labels = []
+        for p in row[:length]:
+            if p == 0:
+                labels.append(UNK_WORD)
+            elif p <= columns_num:
+                labels.append('Column_' + str(p - 1))
+            else:
+                labels.append('Value_' + str(p - 1 - columns_num) if values_len is not None else 'Value')
+        res.append(labels)
+    return res
+
+
+def pad(values, length):
+    """
+    values truncated or padded with 0 to length, one row of a padded tensor of BindingDataset.
+    """
+    values = list(values[:length])
+    return values + [0] * (length - len(values))
+
+
+def bert_row(ids, length, marker, ids_max_len, marker_max_len, trim_marker=True):
+    """
+    one row of a group of bert inputs of BindingDataset trimmed by trim_batch, see _trim_bert.
+    :param length: the value of the *_len tensors, the number of tokens (or columns, cells).
+    :return: [ids, length, marker, marker_len]
+    """
+    marker = pad(marker, marker_max_len)
+    split_max_len = min(max(marker) + 1, ids_max_len)
+    marker_len = min(length, marker_max_len)
+    if trim_marker:
+        # the first marker is 0, count the others
+        split_marker_max_len = min(sum(m > 0 for m in marker) + 1, marker_max_len)
+    else:
+        split_marker_max_len = marker_len
+    return [[pad(ids, split_max_len)], [min(length, ids_max_len, split_max_len)], [marker[:split_marker_max_len]], [min(marker_len, split_marker_max_len)]]
+
+
+class Binder(object):
+    """
+    get the bindings of new (question, table) pairs with a loaded Gate or BertGate,
+    the records are built in memory by build_info and a batch is run by the model once.
+    """
+    def __init__(self, model, args, data_from_train, annotate=get_annotate, table_cache=None, checkpoint_id=None):
+        """
+        :param args: with the vocab and data_from_train set, see load_data_from_train.
+        :param annotate: get_annotate, or a function with the same outputs, e.g. a stand-in without CoreNLP.
+        :param table_cache: a TableEncodingCache for the encoded columns of Gate, see Gate.set_table_cache, None to encode every batch.
+        :param checkpoint_id: identify the weights of model in table_cache, e.g. the path of the checkpoint.
+        """
+        self.model = model.eval()
+        if table_cache is not None and isinstance(model, Gate):
+            self.model.set_table_cache(table_cache, checkpoint_id)
+        self.args = args
+        self.data_from_train = data_from_train
+        self.annotate = annotate
+        self.tokenizer = None
+        if args.bert_model is not None:
+            self.tokenizer = FastWordPieceTokenizer.from_bert_tokenizer(BertTokenizer.from_pretrained(args.bert_model))
+        # BertGate scores all the values as one
+        self.cell_info = isinstance(model, Gate) and bool(args.cell_info)
+
+    @classmethod
+    def from_checkpoint(cls, path, args, annotate=get_annotate, table_cache_size=1000):
+        """
+        :param table_cache_size: number of tables in the TableEncodingCache of Gate, None for no cache.
+        """
+        model = load_model(path, args.device, args=args)
+        # the inputs are built by the args of the checkpoint
+        for name in ['model', 'bert_model', 'cell_info', 'attn_concat', 'crf']:
+            setattr(args, name, getattr(model.args, name))
+        data_from_train = load_data_from_train(args)
+        # the cache is not saved with the checkpoint, see Gate.__getstate__
+        table_cache = TableEncodingCache(table_cache_size) if table_cache_size is not None else None
+        return cls(model, args, data_from_train, annotate=annotate, table_cache=table_cache, checkpoint_id=path)
+
+    def featurize(self, requests):
+        """
+        :param requests: [(question, table)] or [(question, table, trusted)], trusted when the table comes from the wikisql tables,
+                         only then its id is the key of the caches, see utils.table_key.
+        :return: the infos of the requests, None for the questions without any cell of the table.
+        """
+        infos = []
+        for request in requests:
+            question, table, trusted = request if len(request) == 3 else tuple(request) + (False, )
+            info = build_info(question, table, tokenizer=self.tokenizer, annotate=self.annotate, trusted=trusted)
+            # same as iter_data, the pointer networks need at least one cell
+            infos.append(info if info['cells_split_len'] > 0 else None)
+        return infos
+
+    def build_inputs(self, info):
+        """
+        the inputs of a batch with only info built directly from the lists of the record, without BindingDataset.
+        same tensors as trim_batch(dataset[:1], dataset) of a BindingDataset of [info].
+        """
+        tokenize_max_len, columns_token_max_len, columns_split_marker_max_len, cells_token_max_len, cells_split_marker_max_len, pos_tag_vocab,\
+        bert_tokenize_max_len, bert_tokenize_marker_max_len, bert_columns_split_max_len, bert_columns_split_marker_max_len,\
+        bert_cells_split_max_len, bert_cells_split_marker_max_len = self.data_from_train
+        if self.args.bert_model is None:
+            vocab = self.args.vocab
+            tokenize_len, columns_split_len, cells_split_len = min(len(info['tokenize']), tokenize_max_len), min(info['columns_split_len'], columns_token_max_len), min(info['cells_split_len'], cells_token_max_len)
+            columns_split_marker_len, cells_split_marker_len = min(info['columns_split_marker_len'], columns_split_marker_max_len), min(info['cells_split_marker_len'], cells_split_marker_max_len)
+            # the number of columns is not trimmed for crf
+            columns_marker_width, cells_marker_width = (columns_split_marker_max_len, cells_split_marker_max_len) if self.args.crf else (columns_split_marker_len, cells_split_marker_len)
+            inputs = [
+                [[[vocab.get(token, 0) for token in info['tokenize'][:tokenize_len]]], [tokenize_len]],
+                [[[pos_tag_vocab.get(pos_tag, 0) for pos_tag in info['pos_tag'][:tokenize_len]]]],
+                [[[vocab.get(token, 0) for token in info['columns_split'][:columns_split_len]]], [columns_split_len]],
+                [[pad(info['columns_split_marker'], columns_marker_width)], [columns_split_marker_len]],
+                [[[vocab.get(token, 0) for token in info['cells_split'][:cells_split_len]]], [cells_split_len]],
+                [[pad(info['cells_split_marker'], cells_marker_width)], [cells_split_marker_len]],
+                [[0]],
+            ]
+        else:
+            inputs = [
+                bert_row(info['bert_indexed_tokenize'], len(info['tokenize']), info['bert_tokenize_marker'], bert_tokenize_max_len, bert_tokenize_marker_max_len, trim_marker=False),
+                bert_row(info['bert_indexed_columns'], info['columns_split_len'], info['bert_columns_split_marker'], bert_columns_split_max_len, bert_columns_split_marker_max_len, trim_marker=not self.args.crf),
+                bert_row(info['bert_indexed_cells'], info['cells_split_len'], info['bert_cells_split_marker'], bert_cells_split_max_len, bert_cells_split_marker_max_len, trim_marker=not self.args.crf),
+                [[0]],
+            ]
+        device = self.args.device
+        return [[torch.tensor(value, dtype=torch.long, device=device) for value in group] for group in inputs]
+
+    def run(self, inputs, table_ids):
+        """
+        run the model once on a batch of inputs.
+        :return: the bindings of every question of the batch.
+        """
+        with torch.no_grad(), autocast(self.args):
+            if isinstance(self.model, Gate):
+                # the encoded columns are reused when the model has a table_cache
+                _, col_align_score, pointer_align_scores = self.model(inputs, table_ids=table_ids)
+            else:
+                _, col_align_score, pointer_align_scores = self.model(inputs)
+        if isinstance(self.model, Gate):
+            columns_split_marker_len, values_len = inputs[3][1], (inputs[5][1] - 1 if self.cell_info else None)
+        else:
+            columns_split_marker_len, values_len = inputs[1][3], None
+        return decode_bindings(pointer_align_scores.float().cpu(), inputs[0][1].cpu(), (columns_split_marker_len - 1).cpu(), col_align_score.size(-1),
+                               values_len=None if values_len is None else values_len.cpu())
+
+    def bind(self, question, table, trusted=False):
+        """
+        the bindings of a single question, the inputs are built in memory by build_info and build_inputs.
+        :return: {'tokens': [...], 'bindings': [...]} or {'error': ...}
+        """
+        info = self.featurize([(question, table, trusted)])[0]
+        if info is None:
+            return {'error': 'no cell of the table is in the question'}
+        return {'tokens': info['tokenize'], 'bindings': self.run(self.build_inputs(info), [info['table_id']])[0]}
+
+    def bind_batch(self, requests):
+        """
+        :param requests: [(question, table)] or [(question, table, trusted)], see featurize.
+        :return: [{'tokens'': [...], 'bindings': [...]} or {'error': ...}] in the order of requests.
+        """
+        infos = self.featurize(requests)
+        res = [{'error': 'no cell of the table is in the question'} if info is None else None for info in infos]
+        rows = [index for index, info in enumerate(infos) if info is not None]
+        if len(rows) == 0:
+            return res
+        if len(rows) == 1:
+            # a single question does not need BindingDataset
+            inputs = self.build_inputs(infos[rows[0]])
+        else:
+            dataset = BindingDataset('bind', args=self.args, data_from_train=self.data_from_train, infos=[infos[index] for index in rows])
+            inputs = to_device(trim_batch(dataset[:len(dataset)], dataset)[0], self.args.device)
+        bindings = self.run(inputs, [infos[index]['table_id'] for index in rows])
+        for index, labels in zip(rows, bindings):
+            res[index] = {'tokens': infos[index]['tokenize'], 'bindings': labels}
+        return res
@@ -0,0 +1,56 @@
+# coding: utf-8
+
+import numpy as np
+import onnxruntime as ort
+
+# the arguments of ScriptGate.forward and FlatBertGate.forward, see export.export_onnx
+GATE_INPUT_NAMES = ['tokenize', 'tokenize_len', 'pos_tag', 'columns_split', 'columns_split_len', 'columns_split_marker', 'columns_split_marker_len',
+                    'cells_split', 'cells_split_len', 'cells_split_marker', 'cells_split_marker_len']
+BERT_GATE_INPUT_NAMES = ['tokenize', 'tokenize_len', 'tokenize_marker', 'tokenize_marker_len',
+                         'columns_split', 'columns_split_len', 'columns_split_marker', 'columns_split_marker_len']
+OUTPUT_NAMES = ['gate_output', 'col_align_score', 'pointer_align_scores']
+
+
+class BindingRuntime(object):
+    """
+    run a Gate or BertGate exported by export.export_onnx with onnxruntime on cpu, only needs numpy and onnxruntime.
+    the inputs are the same groups of tensors (or arrays) as the inputs of BindingDataset.
+    """
+    def __init__(self, path, num_threads=None):
+        """
+        :param num_threads: intra op threads of onnxruntime, None for its default.
+        """
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.binding_model = self.session.get_modelmeta().custom_metadata_map.get('binding_model', 'gate')
+        # the inputs not used by the model, e.g. the cells without cell_info, are removed from the graph
+        self.input_names = set(node.name for node in self.session.get_inputs())
+
+    def feed(self, inputs):
+        """
+        :return: {input name: array}
+        """
+        if self.binding_model == 'bert_gate':
+            names, groups = BERT_GATE_INPUT_NAMES, inputs[:2]
+        else:
+            names, groups = GATE_INPUT_NAMES, inputs[:6]
+        values = [value for group in groups for value in group]
+        return {name: np.asarray(value) for name, value in zip(names, values) if name in self.input_names}
+
+    def run(self, inputs):
+        """
+        :return: gate_output, col_align_score, pointer_align_scores, same as the forward of the model.
+        """
+        return self.session.run(OUTPUT_NAMES, self.feed(inputs))
+
+    def bind(self, inputs):
+        """
+        :return: the argmax of pointer_align_scores of every question, cut to its number of tokens.
+        """
+        pointer_align_scores = self.run(inputs)[2]
+        # the number of tokens for both models, see BindingDataset
+        tokenize_len = np.asarray(inputs[0][1])
+        pred = pointer_align_scores.argmax(-1)
+        return [pred[index, :tokenize_len[index]].tolist() for index in range(pred.shape[0])]
@@ -0,0 +1,116 @@
+# coding: utf-8
+
+import os
+import json
+import atexit
+import sqlite3
+import threading
+import collections
+
+
+class LRUCache(object):
+    """
+    in-memory cache, evict the least recently used item when more than max_size items.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class AnnotationCache(object):
+    """
+    disk-backed cache for the annotate results (CoreNLP, see utils.get_annotate), keyed by (namespace, text, lower).
+    the wordpieces are memoized in memory by FastWordPieceTokenizer instead.
+    results are saved in a sqlite file so they can be shared across runs, processes and threads,
+    a bounded LRUCache in front of it keeps the hot items in memory.
+    puts are buffered and written in one short transaction every commit_interval puts,
+    so the write lock is not held between puts and the other processes are not blocked.
+    """
+    def __init__(self, path, max_size=100000, commit_interval=1000):
+        self.path = path
+        self.memory = LRUCache(max_size)
+        self.commit_interval = commit_interval
+        self.pending = {}
+        # the connection of every thread, the buffered puts and the memory are shared by the threads under the lock
+        self.local, self.lock = threading.local(), threading.Lock()
+        atexit.register(self.commit)
+
+    def _connect(self):
+        # sqlite connections can not be shared by threads or forked processes, connect again in every thread and process
+        if getattr(self.local, 'conn', None) is None or self.local.pid != os.getpid():
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name, exist_ok=True)
+            # autocommit, the transactions are opened by commit only
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, text TEXT, lower INTEGER, value TEXT, '
+                         'PRIMARY KEY (namespace, text, lower))')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return self.local.conn
+
+    def get(self, namespace, text, lower):
+        """
+        :return: the cached value, or None if not cached.
+        """
+        key = (namespace, text, lower)
+        with self.lock:
+            value = self.memory.get(key)
+            if value is None:
+                value = self.pending.get(key)
+        if value is None:
+            row = self._connect().execute('SELECT value FROM cache WHERE namespace = ? AND text = ? AND lower = ?',
+                                          (namespace, text, int(lower))).fetchone()
+            if row is None:
+                return None
+            value = row[0]
+            with self.lock:
+                self.memory.put(key, value)
+        # decode every time, so callers can modify the result
+        return json.loads(value)
+
+    def put(self, namespace, text, lower, value):
+        key, value = (namespace, text, lower), json.dumps(value)
+        with self.lock:
+            self.memory.put(key, value)
+            self.pending[key] = value
+            full = len(self.pending) >= self.commit_interval
+        if full:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            conn = self._connect()
+            # BEGIN IMMEDIATE takes the write lock up front, waiting up to timeout for the other writers
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                                 [(namespace, text, int(lower), value) for (namespace, text, lower), value in self.pending.items()])
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self.pending = {}
@@ -9,6 +9,9 @@ preprocess_path = data_path + 'preprocess/'
 anonymous_path = data_path + 'anonymous/'
 bert_path = data_path + 'bert/'
 word_embedding_path = data_path + 'glove.6B.300d.txt'
+cache_path = data_path + 'cache/'
+annotation_cache_path = cache_path + 'annotation.db'
+vocab_path = cache_path + 'vocab.json'
 
 
 # hyperparameters
@@ -27,7 +30,7 @@ class Args(object):
         self.teacher_forcing_ratio = 0.5
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.device_ids = [0, 4, 5, 6]
-        self.cuda = True if str(self.device) == 'cuda' else False
+        self.cuda = self.device.type == 'cuda'
         self.save_bar_pretrained = 0.45
         self.save_bar_rl = 0.7
         self.gate_class = 3
@@ -43,6 +46,16 @@ class Args(object):
         self.cell_info = False
         self.attn_concat = False
         self.crf = False
+        self.dataset_cache = True
+        self.pos_tag_vocab = None
+        self.bucket_batching = False
+        self.streaming = False
+        self.bert_packed = True
+        self.bert_features = False
+        self.bert_layers = None
+        self.amp = False
+        self.amp_dtype = torch.bfloat16
+        self.attn_chunk_size = 2 ** 20
 
 
 if __name__ == '__main__':
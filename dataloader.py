@@ -1,23 +1,95 @@
 # coding: utf-8
 
+import os
 import json
 import nltk
+import shutil
 import torch
 import functools
+import itertools
 import numpy as np
-from config import Args
+from config import Args, cache_path
 from torch.autograd import Variable
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler, get_worker_info
 from pytorch_pretrained_bert import BertTokenizer, BertModel
-from utils import get_wikisql_tables_path, get_preprocess_path, UNK_WORD, get_bert_path
-from utils import load_data, build_vocab, build_all_vocab, change2idx, pad, max_len_of_m_lists
+from utils import get_wikisql_tables_path, get_preprocess_path, UNK_WORD, BOS_WORD, get_bert_path
+from utils import load_data, collect_data, iter_data, build_vocab, count_words, build_vocab_from_count, load_all_vocab, max_len_of_m_lists, file_digest, dict_digest, module_digest, sequence_mask
+from ragged import RaggedArray, clip_lengths
+
+# change it when the tensors of BindingDataset change, so old caches are not used
+CACHE_VERSION = 3
 
 
 class BindingDataset(Dataset):
-    def __init__(self, mode, args, data_from_train=None):
+    meta_names = ['len', 'tokenize_max_len', 'columns_token_max_len', 'columns_split_marker_max_len', 'cells_token_max_len',
+                  'cells_split_marker_max_len', 'pos_tag_vocab', 'bert_tokenize_max_len', 'bert_tokenize_marker_max_len',
+                  'bert_columns_split_max_len', 'bert_columns_split_marker_max_len', 'bert_cells_split_max_len', 'bert_cells_split_marker_max_len', 'table_ids']
+
+    def __init__(self, mode, args, data_from_train=None, infos=None):
+        """
+        :param infos: build from these records instead of the data file, e.g. a batch of StreamingBindingDataset.
+        """
         self.args = args
         # get path
-        data_path, tables_path = get_bert_path(mode), get_wikisql_tables_path(mode)
+        data_path = get_bert_path(mode)
+        if infos is not None:
+            self.build(mode, data_path, data_from_train, infos=infos)
+            return
+        if not self.args.dataset_cache:
+            self.build(mode, data_path, data_from_train)
+            return
+        # use the cached tensors if the data and the args are not changed
+        cache_dir = self.get_cache_dir(mode, data_path, data_from_train)
+        if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            print('loading cache {}'.format(cache_dir))
+            self.load_cache(cache_dir)
+        else:
+            self.build(mode, data_path, data_from_train)
+            self.save_cache(cache_dir)
+
+    def get_tensor_names(self):
+        tensor_names = ['pointer_label_tensor', 'gate_label_tensor', 'sql_sel_col_list', 'sql_conds_cols_list', 'sql_conds_values_list', 'table_index_tensor']
+        if self.args.bert_model is None:
+            tensor_names += ['tokenize_tensor', 'tokenize_len_tensor', 'pos_tag_tensor',
+                             'columns_split_tensor', 'columns_split_len_tensor', 'columns_split_marker_tensor', 'columns_split_marker_len_tensor',
+                             'cells_split_tensor', 'cells_split_len_tensor', 'cells_split_marker_tensor', 'cells_split_marker_len_tensor']
+        else:
+            tensor_names += ['bert_tokenize_tensor', 'bert_tokenize_len_tensor', 'bert_tokenize_marker_tensor', 'bert_tokenize_marker_len_tensor',
+                             'bert_columns_split_tensor', 'bert_columns_split_len_tensor', 'bert_columns_split_marker_tensor', 'bert_columns_split_marker_len_tensor',
+                             'bert_cells_split_tensor', 'bert_cells_split_len_tensor', 'bert_cells_split_marker_tensor', 'bert_cells_split_marker_len_tensor']
+        return tensor_names
+
+    def get_cache_dir(self, mode, data_path, data_from_train):
+        # key: the content of data file and every args that change the tensors
+        key = [CACHE_VERSION, file_digest(data_path), self.args.model, self.args.cell_info, self.args.crf, self.args.only_label, self.args.bert_model]
+        if self.args.bert_model is None:
+            key.append(dict_digest(self.args.vocab))
+        key.append(None if data_from_train is None else dict_digest(data_from_train))
+        return os.path.join(cache_path, 'dataset', mode + '_' + dict_digest(key))
+
+    def load_cache(self, cache_dir):
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        for name in self.meta_names:
+            setattr(self, name, meta[name])
+        for name in self.get_tensor_names():
+            # copy-on-write mmap, the tensors are read from disk on demand
+            setattr(self, name, torch.from_numpy(np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='c')))
+
+    def save_cache(self, cache_dir):
+        # write to a tmp dir, then rename, so a crashed run never leaves a broken cache
+        tmp_dir = cache_dir + '.tmp' + str(os.getpid())
+        os.makedirs(tmp_dir)
+        for name in self.get_tensor_names():
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name).numpy())
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(dict((name, getattr(self, name)) for name in self.meta_names), f)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, cache_dir)
+
+    def build(self, mode, data_path, data_from_train, infos=None):
         # load data
         tokenize_list, tokenize_len_list, pos_tag_list, table_id_list,\
         (columns_split_list, columns_split_len_list, columns_split_marker_list, columns_split_marker_len_list),\
@@ -26,14 +98,18 @@ class BindingDataset(Dataset):
         (bert_tokenize_list, bert_tokenize_len_list, bert_tokenize_marker_list, bert_tokenize_marker_len_list),\
         (bert_columns_split_list, bert_columns_split_len_list, bert_columns_split_marker_list, bert_columns_split_marker_len_list),\
         (bert_cells_split_list, bert_cells_split_len_list, bert_cells_split_marker_list, bert_cells_split_marker_len_list),\
-        (bert_indexed_tokenize_list, bert_indexed_columns_list, bert_indexed_cells_list) = load_data(data_path, only_label=self.args.only_label)
+        (bert_indexed_tokenize_list, bert_indexed_columns_list, bert_indexed_cells_list) = load_data(data_path, only_label=self.args.only_label) if infos is None else collect_data(infos)
         # get len
         self.len = len(tokenize_list)
         # the data that need use train's data for dev and test
         if data_from_train is None:
             self.tokenize_max_len, self.columns_token_max_len, self.columns_split_marker_max_len, self.cells_token_max_len, self.cells_split_marker_max_len =\
                 max(tokenize_len_list), max(columns_split_len_list), max(columns_split_marker_len_list), max(cells_split_len_list), max(cells_split_marker_len_list)
-            self.pos_tag_vocab, _ = build_vocab(pos_tag_list, init_vocab={UNK_WORD: 0})
+            # pos_tag_vocab of the vocab file is built from train with only_label
+            if self.args.pos_tag_vocab is not None and self.args.only_label and mode == 'train':
+                self.pos_tag_vocab = self.args.pos_tag_vocab
+            else:
+                self.pos_tag_vocab, _ = build_vocab(pos_tag_list, init_vocab={UNK_WORD: 0})
             self.bert_tokenize_max_len, self.bert_tokenize_marker_max_len = max(bert_tokenize_len_list), max(bert_tokenize_marker_len_list)
             self.bert_columns_split_max_len, self.bert_columns_split_marker_max_len = max(bert_columns_split_len_list), max(bert_columns_split_marker_len_list)
             self.bert_cells_split_max_len, self.bert_cells_split_marker_max_len = max(bert_cells_split_len_list), max(bert_cells_split_marker_len_list)
@@ -69,58 +145,85 @@ class BindingDataset(Dataset):
                         pointer_label.append(_get_label(pos=2, index=index, suffix=int(single_label_split[1])))
                         gate_label.append(2)
             pointer_label_list.append(pointer_label), gate_label_list.append(gate_label)
-        # change2tensor
+        # index of the table of every question in table_ids, the questions on the same table share the column encoding
+        self.table_ids, table_index, table_rows = [], {}, []
+        for row, table_id in enumerate(table_id_list):
+            if table_id not in table_index:
+                table_index[table_id] = len(self.table_ids)
+                self.table_ids.append(table_id)
+                table_rows.append(row)
+        self.table_index_tensor = torch.LongTensor([table_index[table_id] for table_id in table_id_list])
+        # the columns are the same for the questions on a table, keep them once for every table and index them in __getitem__
+        def _get_tables(m_list):
+            return [m_list[row] for row in table_rows]
+        # change2tensor, do not print the oov of every streaming batch
+        from_tokens = functools.partial(RaggedArray.from_tokens, verbose=infos is None)
         if self.args.bert_model is None:
-            self.tokenize_tensor = torch.LongTensor(pad(change2idx(tokenize_list, vocab=self.args.vocab, name='tokenize_' + mode), max_len=self.tokenize_max_len))
-            self.tokenize_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.tokenize_max_len), tokenize_len_list)))
-            self.pos_tag_tensor = torch.LongTensor(pad(change2idx(pos_tag_list, vocab=self.pos_tag_vocab, name='pos_tag_' + mode), max_len=self.tokenize_max_len))
-            self.columns_split_tensor = torch.LongTensor(pad(change2idx(columns_split_list, vocab=self.args.vocab, name='columns_split_' + mode), max_len=self.columns_token_max_len))
-            self.columns_split_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.columns_token_max_len), columns_split_len_list)))
-            self.columns_split_marker_tensor = torch.LongTensor(pad(columns_split_marker_list, max_len=self.columns_split_marker_max_len))
-            self.columns_split_marker_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.columns_split_marker_max_len), columns_split_marker_len_list)))
-            self.cells_split_tensor = torch.LongTensor(pad(change2idx(cells_split_list, vocab=self.args.vocab, name='cells_split_' + mode), max_len=self.cells_token_max_len))
-            self.cells_split_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.cells_token_max_len), cells_split_len_list)))
-            self.cells_split_marker_tensor = torch.LongTensor(pad(cells_split_marker_list, max_len=self.cells_split_marker_max_len))
-            self.cells_split_marker_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.cells_split_marker_max_len), cells_split_marker_len_list)))
+            self.tokenize_tensor = torch.from_numpy(from_tokens(tokenize_list, vocab=self.args.vocab, name='tokenize_' + mode).to_padded(self.tokenize_max_len))
+            self.tokenize_len_tensor = torch.from_numpy(clip_lengths(tokenize_len_list, self.tokenize_max_len))
+            self.pos_tag_tensor = torch.from_numpy(from_tokens(pos_tag_list, vocab=self.pos_tag_vocab, name='pos_tag_' + mode).to_padded(self.tokenize_max_len))
+            self.columns_split_tensor = torch.from_numpy(from_tokens(_get_tables(columns_split_list), vocab=self.args.vocab, name='columns_split_' + mode).to_padded(self.columns_token_max_len))
+            self.columns_split_len_tensor = torch.from_numpy(clip_lengths(_get_tables(columns_split_len_list), self.columns_token_max_len))
+            self.columns_split_marker_tensor = torch.from_numpy(RaggedArray.from_lists(_get_tables(columns_split_marker_list)).to_padded(self.columns_split_marker_max_len))
+            self.columns_split_marker_len_tensor = torch.from_numpy(clip_lengths(_get_tables(columns_split_marker_len_list), self.columns_split_marker_max_len))
+            self.cells_split_tensor = torch.from_numpy(from_tokens(cells_split_list, vocab=self.args.vocab, name='cells_split_' + mode).to_padded(self.cells_token_max_len))
+            self.cells_split_len_tensor = torch.from_numpy(clip_lengths(cells_split_len_list, self.cells_token_max_len))
+            self.cells_split_marker_tensor = torch.from_numpy(RaggedArray.from_lists(cells_split_marker_list).to_padded(self.cells_split_marker_max_len))
+            self.cells_split_marker_len_tensor = torch.from_numpy(clip_lengths(cells_split_marker_len_list, self.cells_split_marker_max_len))
         # can not pad -100 for crf
-        pad_token = 0 if args.crf else -100
-        self.pointer_label_tensor = torch.LongTensor(pad(pointer_label_list, max_len=self.tokenize_max_len, pad_token=pad_token))
-        self.gate_label_tensor = torch.LongTensor(pad(gate_label_list, max_len=self.tokenize_max_len, pad_token=-100))
+        pad_token = 0 if self.args.crf else -100
+        self.pointer_label_tensor = torch.from_numpy(RaggedArray.from_lists(pointer_label_list).to_padded(self.tokenize_max_len, pad_token=pad_token))
+        self.gate_label_tensor = torch.from_numpy(RaggedArray.from_lists(gate_label_list).to_padded(self.tokenize_max_len, pad_token=-100))
         # handle sql_sel_col_list, sql_conds_cols_list, sql_conds_values_list
         self.sql_sel_col_list = torch.LongTensor(sql_sel_col_list)
         assert max_len_of_m_lists(sql_conds_cols_list) == max_len_of_m_lists(sql_conds_values_list)
-        self.sql_conds_cols_list = torch.LongTensor(pad(sql_conds_cols_list, max_len=max_len_of_m_lists(sql_conds_cols_list), pad_token=-100))
-        self.sql_conds_values_list = torch.LongTensor(pad(sql_conds_values_list, max_len=max_len_of_m_lists(sql_conds_values_list), pad_token=[-100, -100]))
+        self.sql_conds_cols_list = torch.from_numpy(RaggedArray.from_lists(sql_conds_cols_list).to_padded(max_len_of_m_lists(sql_conds_cols_list), pad_token=-100))
+        self.sql_conds_values_list = torch.from_numpy(RaggedArray.from_lists(sql_conds_values_list, inner_shape=(2,)).to_padded(max_len_of_m_lists(sql_conds_values_list), pad_token=-100))
         if self.args.bert_model is not None:
-            self.bert_tokenize_tensor = torch.LongTensor(pad(bert_indexed_tokenize_list, max_len=self.bert_tokenize_max_len))
-            self.bert_tokenize_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.bert_tokenize_max_len), tokenize_len_list)))
-            self.bert_tokenize_marker_tensor = torch.LongTensor(pad(bert_tokenize_marker_list, max_len=self.bert_tokenize_marker_max_len))
-            self.bert_tokenize_marker_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.bert_tokenize_marker_max_len), tokenize_len_list)))
-            self.bert_columns_split_tensor = torch.LongTensor(pad(bert_indexed_columns_list, max_len=self.bert_columns_split_max_len))
-            self.bert_columns_split_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.bert_columns_split_max_len), columns_split_len_list)))
-            self.bert_columns_split_marker_tensor = torch.LongTensor(pad(bert_columns_split_marker_list, max_len=self.bert_columns_split_marker_max_len))
-            self.bert_columns_split_marker_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.bert_columns_split_marker_max_len), columns_split_len_list)))
-            self.bert_cells_split_tensor = torch.LongTensor(pad(bert_indexed_cells_list, max_len=self.bert_cells_split_max_len))
-            self.bert_cells_split_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.bert_cells_split_max_len), cells_split_len_list)))
-            self.bert_cells_split_marker_tensor = torch.LongTensor(pad(bert_cells_split_marker_list, max_len=self.bert_cells_split_marker_max_len))
-            self.bert_cells_split_marker_len_tensor = torch.LongTensor(list(map(lambda len: min(len, self.bert_cells_split_marker_max_len), cells_split_len_list)))
+            self.bert_tokenize_tensor = torch.from_numpy(RaggedArray.from_lists(bert_indexed_tokenize_list).to_padded(self.bert_tokenize_max_len))
+            self.bert_tokenize_len_tensor = torch.from_numpy(clip_lengths(tokenize_len_list, self.bert_tokenize_max_len))
+            self.bert_tokenize_marker_tensor = torch.from_numpy(RaggedArray.from_lists(bert_tokenize_marker_list).to_padded(self.bert_tokenize_marker_max_len))
+            self.bert_tokenize_marker_len_tensor = torch.from_numpy(clip_lengths(tokenize_len_list, self.bert_tokenize_marker_max_len))
+            self.bert_columns_split_tensor = torch.from_numpy(RaggedArray.from_lists(_get_tables(bert_indexed_columns_list)).to_padded(self.bert_columns_split_max_len))
+            self.bert_columns_split_len_tensor = torch.from_numpy(clip_lengths(_get_tables(columns_split_len_list), self.bert_columns_split_max_len))
+            self.bert_columns_split_marker_tensor = torch.from_numpy(RaggedArray.from_lists(_get_tables(bert_columns_split_marker_list)).to_padded(self.bert_columns_split_marker_max_len))
+            self.bert_columns_split_marker_len_tensor = torch.from_numpy(clip_lengths(_get_tables(columns_split_len_list), self.bert_columns_split_marker_max_len))
+            self.bert_cells_split_tensor = torch.from_numpy(RaggedArray.from_lists(bert_indexed_cells_list).to_padded(self.bert_cells_split_max_len))
+            self.bert_cells_split_len_tensor = torch.from_numpy(clip_lengths(cells_split_len_list, self.bert_cells_split_max_len))
+            self.bert_cells_split_marker_tensor = torch.from_numpy(RaggedArray.from_lists(bert_cells_split_marker_list).to_padded(self.bert_cells_split_marker_max_len))
+            self.bert_cells_split_marker_len_tensor = torch.from_numpy(clip_lengths(cells_split_len_list, self.bert_cells_split_marker_max_len))
+
+    def get_lengths(self):
+        """
+        lengths for BucketBatchSampler, the real lengths of question (and columns for bert).
+        """
+        if self.args.bert_model is None:
+            return self.tokenize_len_tensor.tolist()
+        return (self.bert_tokenize_marker_tensor.max(1)[0] + self.bert_columns_split_marker_tensor.max(1)[0][self.table_index_tensor] + 2).tolist()
 
     def __getitem__(self, index):
+        """
+        :param index: an index, or a list of indices (or a slice) to get a whole batch, every tensor is indexed once.
+        """
+        # the columns are indexed by table
+        table_index = self.table_index_tensor[index]
         if self.args.bert_model is None:
             return (
                         [self.tokenize_tensor[index], self.tokenize_len_tensor[index]],
                         [self.pos_tag_tensor[index], ],
-                        [self.columns_split_tensor[index], self.columns_split_len_tensor[index]],
-                        [self.columns_split_marker_tensor[index], self.columns_split_marker_len_tensor[index]],
+                        [self.columns_split_tensor[table_index], self.columns_split_len_tensor[table_index]],
+                        [self.columns_split_marker_tensor[table_index], self.columns_split_marker_len_tensor[table_index]],
                         [self.cells_split_tensor[index], self.cells_split_len_tensor[index]],
                         [self.cells_split_marker_tensor[index], self.cells_split_marker_len_tensor[index]],
+                        [table_index, ],
                     ),\
                         (self.pointer_label_tensor[index], self.gate_label_tensor[index]), (self.sql_sel_col_list[index], self.sql_conds_cols_list[index], self.sql_conds_values_list[index])
         else:
             return (
                         [self.bert_tokenize_tensor[index], self.bert_tokenize_len_tensor[index], self.bert_tokenize_marker_tensor[index], self.bert_tokenize_marker_len_tensor[index]],
-                        [self.bert_columns_split_tensor[index], self.bert_columns_split_len_tensor[index], self.bert_columns_split_marker_tensor[index], self.bert_columns_split_marker_len_tensor[index]],
-                        [self.bert_cells_split_tensor[index], self.bert_cells_split_len_tensor[index], self.bert_cells_split_marker_tensor[index], self.bert_cells_split_marker_len_tensor[index]]
+                        [self.bert_columns_split_tensor[table_index], self.bert_columns_split_len_tensor[table_index], self.bert_columns_split_marker_tensor[table_index], self.bert_columns_split_marker_len_tensor[table_index]],
+                        [self.bert_cells_split_tensor[index], self.bert_cells_split_len_tensor[index], self.bert_cells_split_marker_tensor[index], self.bert_cells_split_marker_len_tensor[index]],
+                        [table_index, ],
                     ),\
                    (self.pointer_label_tensor[index], self.gate_label_tensor[index]), (self.sql_sel_col_list[index], self.sql_conds_cols_list[index], self.sql_conds_values_list[index])
 
@@ -128,9 +231,295 @@ class BindingDataset(Dataset):
         return self.len
 
 
+class StreamingBindingDataset(IterableDataset):
+    """
+    read the preprocessed data line by line and yield ready batches, instead of building the tensors of the whole split.
+    only buffer_size records are kept in memory and shuffled within the buffer,
+    the max lengths and pos_tag_vocab come from train (data_from_train), so the batches have the same shapes as BindingDataset.
+    """
+    def __init__(self, mode, args, data_from_train, shuffle=True, buffer_size=10000):
+        assert data_from_train is not None, 'StreamingBindingDataset needs data_from_train, see stream_data_from_train'
+        self.mode = mode
+        self.args = args
+        self.data_from_train = data_from_train
+        self.data_path = get_bert_path(mode)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+
+    def get_length(self, info):
+        # same as BindingDataset.get_lengths
+        if self.args.bert_model is None:
+            return len(info['tokenize'])
+        return len(info['bert_tokenize']) + len(info['bert_columns_split'])
+
+    def get_batches(self, buffer, last=False):
+        """
+        :return: batches of the buffer and the rest records, which are not enough for a batch. use all records if last.
+        """
+        if self.shuffle:
+            buffer = [buffer[i] for i in torch.randperm(len(buffer)).tolist()]
+        if self.args.bucket_batching:
+            buffer = sorted(buffer, key=self.get_length)
+        num = len(buffer) if last else len(buffer) // self.args.batch_size * self.args.batch_size
+        batches = [buffer[i:i + self.args.batch_size] for i in range(0, num, self.args.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches, buffer[num:]
+
+    def make_batch(self, infos):
+        # the table_index of the batch is an index into the table_ids of the batch
+        dataset = BindingDataset(self.mode, self.args, data_from_train=self.data_from_train, infos=infos)
+        batch = dataset[:len(dataset)]
+        if self.args.bucket_batching:
+            batch = trim_batch(batch, dataset)
+        return batch
+
+    def __iter__(self):
+        infos = iter_data(self.data_path, only_label=self.args.only_label)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # every worker reads its own lines
+            infos = itertools.islice(infos, worker_info.id, None, worker_info.num_workers)
+        buffer = []
+        for info in infos:
+            buffer.append(info)
+            if len(buffer) >= self.buffer_size:
+                batches, buffer = self.get_batches(buffer)
+                for batch in batches:
+                    yield self.make_batch(batch)
+        batches, _ = self.get_batches(buffer, last=True)
+        for batch in batches:
+            yield self.make_batch(batch)
+
+
+def stream_data_from_train(args):
+    """
+    the same data_from_train as BindingDataset('train'), but read train line by line.
+    """
+    # tokenize, columns_token, columns_split_marker, cells_token, cells_split_marker, and the bert ones
+    max_lens, pos_tag_count = [0] * 11, {}
+    for info in iter_data(get_bert_path('train'), only_label=args.only_label):
+        lens = [len(info['tokenize']), info['columns_split_len'], info['columns_split_marker_len'], info['cells_split_len'], info['cells_split_marker_len'],
+                len(info['bert_tokenize']), len(info['bert_tokenize_marker']), len(info['bert_columns_split']), len(info['bert_columns_split_marker']),
+                len(info['bert_cells_split']), len(info['bert_cells_split_marker'])]
+        max_lens = list(map(max, max_lens, lens))
+        count_words(info['pos_tag'], pos_tag_count)
+    if args.pos_tag_vocab is not None and args.only_label:
+        pos_tag_vocab = args.pos_tag_vocab
+    else:
+        pos_tag_vocab, _ = build_vocab_from_count(pos_tag_count, init_vocab={UNK_WORD: 0})
+    return tuple(max_lens[:5]) + (pos_tag_vocab, ) + tuple(max_lens[5:])
+
+
+class BucketBatchSampler(Sampler):
+    """
+    yield batches of indices with similar lengths, so a trimmed batch only pads to its own max length.
+    when shuffle, indices are shuffled, sorted by length in buckets of bucket_size batches, then the batches are shuffled.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths)).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+        batches, step = [], self.batch_size * self.bucket_size
+        for start in range(0, len(indices), step):
+            bucket = sorted(indices[start:start + step], key=lambda index: self.lengths[index])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def move_pointer_label(pointer_label, dataset, tokenize_max_len, columns_split_marker_max_len):
+    """
+    pointer labels are built with the max lengths of dataset (see _get_label),
+    move the positions after the trimmed tokens and columns to the trimmed positions.
+    """
+    columns_shift = dataset.columns_split_marker_max_len - columns_split_marker_max_len
+    if dataset.args.model == 'gate':
+        # [0, columns..., values...]
+        return pointer_label - (pointer_label >= dataset.columns_split_marker_max_len).long() * columns_shift
+    elif dataset.args.model == 'baseline':
+        # [tokens..., columns..., values...]
+        tokens_shift = dataset.tokenize_max_len - tokenize_max_len
+        is_column_or_value = (pointer_label >= dataset.tokenize_max_len).long()
+        is_value = (pointer_label >= dataset.tokenize_max_len + dataset.columns_split_marker_max_len - 1).long()
+        return pointer_label - is_column_or_value * tokens_shift - is_value * columns_shift
+    else:
+        raise NotImplementedError
+
+
+def trim_batch(batch, dataset):
+    """
+    trim the padded tensors of a batch to the max lengths of the batch, keep the labels consistent with the trimmed inputs.
+    the number of columns is not trimmed for crf, its number of tags is fixed.
+    """
+    inputs, (pointer_label, gate_label), sql_labels = batch
+    if dataset.args.bert_model is None:
+        (tokenize, tokenize_len), (pos_tag, ), (columns_split, columns_split_len), (columns_split_marker, columns_split_marker_len),\
+        (cells_split, cells_split_len), (cells_split_marker, cells_split_marker_len) = inputs[:6]
+        tokenize_max_len, columns_split_max_len, cells_split_max_len = int(tokenize_len.max()), int(columns_split_len.max()), int(cells_split_len.max())
+        columns_split_marker_max_len, cells_split_marker_max_len = int(columns_split_marker_len.max()), int(cells_split_marker_len.max())
+        if dataset.args.crf:
+            columns_split_marker_max_len, cells_split_marker_max_len = columns_split_marker.size(1), cells_split_marker.size(1)
+        inputs = [
+            [tokenize[:, :tokenize_max_len], tokenize_len],
+            [pos_tag[:, :tokenize_max_len]],
+            [columns_split[:, :columns_split_max_len], columns_split_len],
+            [columns_split_marker[:, :columns_split_marker_max_len], columns_split_marker_len],
+            [cells_split[:, :cells_split_max_len], cells_split_len],
+            [cells_split_marker[:, :cells_split_marker_max_len], cells_split_marker_len],
+        ] + list(inputs[6:])
+    else:
+        def _trim_bert(split, split_len, split_marker, split_marker_len, trim_marker=True):
+            # markers are the positions of [SEP] (or the last sub_token of a token), the last one + 1 is the real length
+            split_max_len = int(split_marker.max()) + 1
+            if trim_marker:
+                # the first marker is 0, count the others
+                split_marker_max_len = int((split_marker > 0).sum(1).max()) + 1
+            else:
+                split_marker_max_len = int(split_marker_len.max())
+            return [split[:, :split_max_len], split_len.clamp(max=split_max_len),
+                    split_marker[:, :split_marker_max_len], split_marker_len.clamp(max=split_marker_max_len)]
+        tokenize_inputs = _trim_bert(*inputs[0], trim_marker=False)
+        columns_split_inputs = _trim_bert(*inputs[1], trim_marker=not dataset.args.crf)
+        cells_split_inputs = _trim_bert(*inputs[2], trim_marker=not dataset.args.crf)
+        inputs = [tokenize_inputs, columns_split_inputs, cells_split_inputs] + list(inputs[3:])
+        tokenize_max_len, columns_split_marker_max_len = tokenize_inputs[2].size(1), columns_split_inputs[2].size(1)
+    pointer_label = move_pointer_label(pointer_label[:, :tokenize_max_len], dataset, tokenize_max_len, columns_split_marker_max_len)
+    return inputs, (pointer_label, gate_label[:, :tokenize_max_len]), sql_labels
+
+
+def build_bert_features(model, dataset, mode, args):
+    """
+    run the bert_model of a BertGate once over the dataset, save the pooled bert_tokens_sum and bert_columns_split_sum
+    as fp16 npy files, which are opened as memmap by BertFeatureDataset. the features are built again when bert_model changed.
+    :return: the dir of the features.
+    """
+    key = [CACHE_VERSION, mode, file_digest(get_bert_path(mode)), args.only_label, len(dataset), dataset.bert_tokenize_marker_max_len,
+           dataset.bert_columns_split_marker_max_len, getattr(args, 'bert_packed', False), module_digest(model.bert_model)]
+    features_dir = os.path.join(cache_path, 'bert_features', mode + '_' + dict_digest(key))
+    if os.path.exists(os.path.join(features_dir, 'meta.json')):
+        print('loading bert features {}'.format(features_dir))
+        return features_dir
+    print('building bert features {}'.format(features_dir))
+    # write to a tmp dir, then rename, same as BindingDataset.save_cache
+    tmp_dir = features_dir + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_dir)
+    hidden_size = model.bert_model.config.hidden_size
+    # padded to the max lengths of dataset, the same as the untrimmed batches
+    bert_tokens_sum = np.lib.format.open_memmap(os.path.join(tmp_dir, 'bert_tokens_sum.npy'), mode='w+', dtype=np.float16,
+                                                shape=(len(dataset), dataset.bert_tokenize_marker_max_len, hidden_size))
+    bert_columns_split_sum = np.lib.format.open_memmap(os.path.join(tmp_dir, 'bert_columns_split_sum.npy'), mode='w+', dtype=np.float16,
+                                                       shape=(len(dataset), dataset.bert_columns_split_marker_max_len - 1, hidden_size))
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        for indices in BucketBatchSampler(dataset.get_lengths(), args.batch_size, shuffle=False):
+            inputs, _, _ = trim_batch(dataset[indices], dataset)
+            inputs = [[inp.to(args.device) for inp in input] for input in inputs]
+            tokens_sum, columns_split_sum = model.encode(inputs)
+            # zeros for the padded columns of every question
+            columns_split_num = (inputs[1][2] > 0).sum(-1)
+            columns_split_sum = columns_split_sum * sequence_mask(columns_split_num, max_len=columns_split_sum.size(1)).unsqueeze(-1).to(columns_split_sum.dtype)
+            bert_tokens_sum[indices, :tokens_sum.size(1)] = tokens_sum.cpu().numpy()
+            bert_columns_split_sum[indices, :columns_split_sum.size(1)] = columns_split_sum.cpu().numpy()
+    model.train(training)
+    bert_tokens_sum.flush(), bert_columns_split_sum.flush()
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'len': len(dataset), 'hidden_size': hidden_size}, f)
+    if os.path.exists(features_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        os.rename(tmp_dir, features_dir)
+    return features_dir
+
+
+class BertFeatureDataset(Dataset):
+    """
+    the features from build_bert_features and the labels of a BindingDataset,
+    to train the heads of BertGate (args.bert_features) without running the frozen bert_model.
+    the batches are not trimmed, the features are padded to the max lengths of the dataset.
+    the inputs of a batch are [features], which are passed to BertGate.forward as features, see train.feed_forward.
+    """
+    def __init__(self, dataset, features_dir):
+        self.dataset = dataset
+        self.args = dataset.args
+        self.bert_tokens_sum = np.load(os.path.join(features_dir, 'bert_tokens_sum.npy'), mmap_mode='r')
+        self.bert_columns_split_sum = np.load(os.path.join(features_dir, 'bert_columns_split_sum.npy'), mmap_mode='r')
+
+    def __getitem__(self, index):
+        inputs, labels, sql_labels = self.dataset[index]
+        # the padded columns of the features are zeros, count the real columns from the markers (the first marker is 0)
+        columns_split_marker, columns_split_marker_len = inputs[1][2], inputs[1][3]
+        columns_split_marker_len = torch.min(columns_split_marker_len, (columns_split_marker > 0).sum(-1) + 1)
+        # same place of tokenize_len as the inputs of BindingDataset
+        features = [torch.from_numpy(self.bert_tokens_sum[index].astype(np.float32)), inputs[0][1],
+                    torch.from_numpy(self.bert_columns_split_sum[index].astype(np.float32)), columns_split_marker_len]
+        return [features], labels, sql_labels
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def get_dataloader(dataset, args, shuffle):
+    """
+    the sampler yields lists of indices and the dataset returns whole batches (batch_size=None, no collate),
+    instead of getting every item and stacking them.
+    with args.bucket_batching, batch by BucketBatchSampler and trim every batch to its own max lengths.
+    a StreamingBindingDataset makes, shuffles and trims its batches itself.
+    """
+    pin_memory = args.device.type == 'cuda'
+    if isinstance(dataset, IterableDataset):
+        return DataLoader(dataset=dataset, batch_size=None, pin_memory=pin_memory)
+    if args.bucket_batching:
+        batch_sampler = BucketBatchSampler(dataset.get_lengths(), args.batch_size, shuffle=shuffle)
+        collate_fn = functools.partial(trim_batch, dataset=dataset)
+    else:
+        batch_sampler = BatchSampler(RandomSampler(dataset) if shuffle else SequentialSampler(dataset), args.batch_size, drop_last=False)
+        collate_fn = None
+    return DataLoader(dataset=dataset, sampler=batch_sampler, batch_size=None, collate_fn=collate_fn, pin_memory=pin_memory)
+
+
+def load_data_from_train(args):
+    """
+    build the vocab and data_from_train the same way as main, and set them on args.
+    """
+    word2index, index2word, args.pos_tag_vocab = load_all_vocab(init_vocab={UNK_WORD: 0, BOS_WORD: 1})
+    args.vocab, args.vocab_size, args.index2word = word2index, len(word2index), index2word
+    # data_from_train from only_label = True, same as main
+    args.only_label = True
+    data_from_train = stream_data_from_train(args)
+    args.tokenize_max_len, args.columns_token_max_len, args.columns_split_marker_max_len, \
+    args.cells_token_max_len, args.cells_split_marker_max_len, args.pos_tag_vocab,\
+    args.bert_tokenize_max_len, args.bert_tokenize_marker_max_len, args.bert_columns_split_max_len, args.bert_columns_split_marker_max_len,\
+    args.bert_cells_split_max_len, args.bert_cells_split_marker_max_len = data_from_train
+    return data_from_train
+
+
+def load_dev_dataloader(args, only_label=True):
+    """
+    the dev dataloader built the same way as main, for the scripts that only evaluate.
+    :param only_label: False for eval_rl, which needs the sql labels.
+    """
+    data_from_train = load_data_from_train(args)
+    args.only_label = only_label
+    dev_dataset = BindingDataset('dev', args=args, data_from_train=data_from_train)
+    return get_dataloader(dev_dataset, args, shuffle=False)
+
+
 if __name__ == '__main__':
     args = Args()
-    word2index, index2word = build_all_vocab(init_vocab={UNK_WORD: 0})
+    word2index, index2word, args.pos_tag_vocab = load_all_vocab(init_vocab={UNK_WORD: 0})
     args.vocab, args.vocab_size = word2index, len(word2index)
     print(args.vocab_size)
     args.model = 'baseline'
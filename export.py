@@ -0,0 +1,159 @@
+# coding: utf-8
+
+import copy
+import onnx
+import torch
+import logging
+from torch import nn
+from config import Args
+from train import eval, eval_rl
+from models.gate import Gate
+from models.bert_gate import BertGate
+from models.script_gate import ScriptGate, FlatBertGate, flatten_inputs, flatten_bert_inputs
+from binding_runtime import BindingRuntime, GATE_INPUT_NAMES, BERT_GATE_INPUT_NAMES, OUTPUT_NAMES
+from dataloader import load_dev_dataloader
+from utils import load_model, set_seed
+
+logger = logging.getLogger('binding')
+
+
+def quantize(model):
+    """
+    dynamic int8 quantization for cpu inference, the weights of nn.LSTM and nn.Linear (also the ones in bert_model) are saved in int8,
+    the activations are quantized on the fly. the embeddings and the crf stay in float32.
+    :return: a quantized copy of model.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    # the cached encodings come from the float32 weights, the table_cache is not copied by deepcopy
+    return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def validate(model, quantized, data_loader, args, rl=False):
+    """
+    eval (and eval_rl) of the float32 and the quantized model on the same data_loader.
+    :return: {'float32': ..., 'int8': ...}, correct ratio, or the reward of eval_rl when rl.
+    """
+    res = {}
+    with torch.no_grad():
+        for name, m in [('float32', model), ('int8', quantized)]:
+            m.eval()
+            if rl:
+                res[name] = float(eval_rl(data_loader, args, m, epoch=name))
+            else:
+                correct, total = eval(data_loader, args, m)
+                res[name] = correct / total
+    logger.info('float32: {}, int8: {}'.format(res['float32'], res['int8']))
+    return res
+
+
+def export(checkpoint_path, args, output_path=None, rl=False):
+    """
+    load a checkpoint saved by train or train_rl, quantize it, validate it on dev and save it for load_model.
+    :param rl: validate by eval_rl instead of eval, for the checkpoints of train_rl.
+    """
+    # the quantized kernels only run on cpu
+    args.device, args.cuda = torch.device('cpu'), False
+    model = load_model(checkpoint_path, args.device)
+    quantized = quantize(model)
+    if rl:
+        # Policy decodes the labels with args.*_max_len
+        args.bucket_batching = False
+    data_loader = load_dev_dataloader(args, only_label=not rl)
+    res = validate(model, quantized, data_loader, args, rl=rl)
+    output_path = output_path or checkpoint_path + '_int8'
+    torch.save(quantized, output_path)
+    logger.info('save model: {}'.format(output_path))
+    return output_path, res
+
+
+def check_outputs(model, run, data_loader, atol=1e-5):
+    """
+    compare pointer_align_scores of the eager model and of run(inputs) on every batch of data_loader.
+    :param run: inputs -> pointer_align_scores, a tensor or an array.
+    :return: max absolute difference over the valid tokens.
+    """
+    model.eval()
+    max_diff = 0.
+    with torch.no_grad():
+        for data in data_loader:
+            inputs = data[0]
+            _, _, expected = model(inputs)
+            actual = torch.as_tensor(run(inputs))
+            assert expected.size() == actual.size(), (expected.size(), actual.size())
+            # the scores of padded tokens are not used
+            tokenize_len = inputs[0][1]
+            for index in range(tokenize_len.size(0)):
+                length = int(tokenize_len[index])
+                max_diff = max(max_diff, (expected[index, :length] - actual[index, :length]).abs().max().item())
+    assert max_diff <= atol, 'the outputs differ from the eager model: {}'.format(max_diff)
+    return max_diff
+
+
+def script(checkpoint_path, args, output_path=None):
+    """
+    script a Gate checkpoint to ScriptGate, check it against the eager model on dev and save it for torch.jit.load.
+    """
+    model = load_model(checkpoint_path, args.device)
+    assert isinstance(model, Gate), 'only Gate can be scripted'
+    scripted = torch.jit.script(ScriptGate(model).eval())
+    data_loader = load_dev_dataloader(args)
+    max_diff = check_outputs(model, lambda inputs: scripted(*flatten_inputs(inputs))[2], data_loader)
+    logger.info('ScriptGate max diff: {}'.format(max_diff))
+    output_path = output_path or checkpoint_path + '_script.pt'
+    scripted.save(output_path)
+    logger.info('save model: {}'.format(output_path))
+    return output_path
+
+
+def export_onnx_model(model, inputs, output_path, opset_version=17):
+    """
+    export a Gate or BertGate to onnx with dynamic batch and length axes, traced on inputs, a batch of BindingDataset.
+    Gate is exported through ScriptGate, the lstms with packed sequences need the torchscript based exporter (dynamo=False).
+    """
+    model = model.eval()
+    if isinstance(model, BertGate):
+        flat_model, flatten, input_names, binding_model = FlatBertGate(model), flatten_bert_inputs, BERT_GATE_INPUT_NAMES, 'bert_gate'
+    elif isinstance(model, Gate):
+        flat_model, flatten, input_names, binding_model = ScriptGate(model), flatten_inputs, GATE_INPUT_NAMES, 'gate'
+    else:
+        raise NotImplementedError
+    dynamic_axes = {name: {0: 'batch_size'} if name.endswith('_len') else {0: 'batch_size', 1: name + '_max_len'} for name in input_names}
+    dynamic_axes.update({'gate_output': {0: 'batch_size', 1: 'tokenize_max_len'},
+                         'col_align_score': {0: 'batch_size', 1: 'tokenize_max_len', 2: 'columns_num'},
+                         'pointer_align_scores': {0: 'batch_size', 1: 'tokenize_max_len', 2: 'pointer_num'}})
+    with torch.no_grad():
+        torch.onnx.export(flat_model.eval(), flatten(inputs), output_path, input_names=input_names, output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+    # BindingRuntime reads the layout of the inputs from the metadata
+    onnx_model = onnx.load(output_path)
+    onnx.helper.set_model_props(onnx_model, {'binding_model': binding_model})
+    onnx.save(onnx_model, output_path)
+    return output_path
+
+
+def export_onnx(checkpoint_path, args, output_path=None, opset_version=17):
+    """
+    export a Gate or BertGate checkpoint by export_onnx_model, check it by BindingRuntime on dev.
+    """
+    args.device, args.cuda = torch.device('cpu'), False
+    model = load_model(checkpoint_path, args.device).eval()
+    data_loader = load_dev_dataloader(args)
+    output_path = export_onnx_model(model, next(iter(data_loader))[0], output_path or checkpoint_path + '.onnx', opset_version=opset_version)
+    runtime = BindingRuntime(output_path)
+    max_diff = check_outputs(model, lambda inputs: runtime.run(inputs)[2], data_loader, atol=1e-4)
+    logger.info('onnx max diff: {}'.format(max_diff))
+    logger.info('save model: {}'.format(output_path))
+    return output_path
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = Args()
+    set_seed(args.seed)
+    args.model = 'gate'
+    args.attn_concat = True
+    args.bucket_batching = True
+    export('./res/gate/epoch100', args)
+    # export('./res/policy_gradient/0.819928_True_True_True_412532', args, rl=True)
+    # script('./res/gate/epoch100', args)
+    # export_onnx('./res/gate/epoch100', args)
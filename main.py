@@ -10,24 +10,27 @@ from train import train, eval, train_rl, eval_rl, test
 from models.gate import Gate
 from models.bert_gate import BertGate
 from models.baseline import Baseline
-from dataloader import BindingDataset
+from dataloader import BindingDataset, StreamingBindingDataset, BertFeatureDataset, stream_data_from_train, build_bert_features, get_dataloader
 from torch.utils.data import Dataset, DataLoader
-from utils import UNK_WORD, BOS_WORD, build_all_vocab, set_seed, load_word_embedding, add_abstraction, anonymous
+from utils import UNK_WORD, BOS_WORD, load_all_vocab, set_seed, load_word_embedding, add_abstraction, anonymous, load_model
 
 
 def main(mode, args):
     # build vocab
-    word2index, index2word = build_all_vocab(init_vocab={UNK_WORD: 0, BOS_WORD: 1})
+    word2index, index2word, args.pos_tag_vocab = load_all_vocab(init_vocab={UNK_WORD: 0, BOS_WORD: 1})
     args.vocab, args.vocab_size, args.index2word = word2index, len(word2index), index2word
     # get data_from_train from only_label = True, for same as train baseline
     args.only_label = True
-    train_dataset = BindingDataset('train', args=args)
-    data_from_train = (train_dataset.tokenize_max_len, train_dataset.columns_token_max_len,
-                       train_dataset.columns_split_marker_max_len, train_dataset.cells_token_max_len,
-                       train_dataset.cells_split_marker_max_len, train_dataset.pos_tag_vocab,
-                       train_dataset.bert_tokenize_max_len, train_dataset.bert_tokenize_marker_max_len,
-                       train_dataset.bert_columns_split_max_len, train_dataset.bert_columns_split_marker_max_len,
-                       train_dataset.bert_cells_split_max_len, train_dataset.bert_cells_split_marker_max_len)
+    if args.streaming:
+        data_from_train = stream_data_from_train(args)
+    else:
+        train_dataset = BindingDataset('train', args=args)
+        data_from_train = (train_dataset.tokenize_max_len, train_dataset.columns_token_max_len,
+                           train_dataset.columns_split_marker_max_len, train_dataset.cells_token_max_len,
+                           train_dataset.cells_split_marker_max_len, train_dataset.pos_tag_vocab,
+                           train_dataset.bert_tokenize_max_len, train_dataset.bert_tokenize_marker_max_len,
+                           train_dataset.bert_columns_split_max_len, train_dataset.bert_columns_split_marker_max_len,
+                           train_dataset.bert_cells_split_max_len, train_dataset.bert_cells_split_marker_max_len)
     args.tokenize_max_len, args.columns_token_max_len, args.columns_split_marker_max_len, \
     args.cells_token_max_len, args.cells_split_marker_max_len, args.pos_tag_vocab,\
     args.bert_tokenize_max_len, args.bert_tokenize_marker_max_len, args.bert_columns_split_max_len, args.bert_columns_split_marker_max_len,\
@@ -47,12 +50,21 @@ def main(mode, args):
     elif mode == 'anonymous':
         args.only_label = False
     # build train_dataloader
-    train_dataset = BindingDataset('train', args=args, data_from_train=data_from_train)
-    train_dataloader = DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=args.shuffle)
+    # Policy and test decode the labels with args.*_max_len, only trim batches for train baseline
+    if mode != 'train baseline':
+        args.bucket_batching = False
+    if args.streaming:
+        train_dataset = StreamingBindingDataset('train', args=args, data_from_train=data_from_train, shuffle=args.shuffle)
+    else:
+        train_dataset = BindingDataset('train', args=args, data_from_train=data_from_train)
+    train_dataloader = get_dataloader(train_dataset, args, shuffle=args.shuffle)
     # build dev_dataloader
-    args.shuffle = False
-    dev_dataset = BindingDataset('dev', args=args, data_from_train=data_from_train)
-    dev_dataloader = DataLoader(dataset=dev_dataset, batch_size=args.batch_size, shuffle=args.shuffle)
+    train_shuffle, args.shuffle = args.shuffle, False
+    if args.streaming:
+        dev_dataset = StreamingBindingDataset('dev', args=args, data_from_train=data_from_train, shuffle=args.shuffle)
+    else:
+        dev_dataset = BindingDataset('dev', args=args, data_from_train=data_from_train)
+    dev_dataloader = get_dataloader(dev_dataset, args, shuffle=args.shuffle)
     # build test_dataloader
     # test_dataset = BindingDataset('test', args=args, data_from_train=data_from_train)
     # test_dataloader = DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=args.shuffle)
@@ -70,23 +82,32 @@ def main(mode, args):
                 model = BertGate(args=args)
         else:
             raise NotImplementedError
+        if args.bert_features and isinstance(model, BertGate):
+            # bert_model is frozen, run it once over train and dev, then train the heads from the saved features
+            assert not args.streaming, 'bert_features needs BindingDataset'
+            model.to(args.device)
+            for parameter in model.bert_model.parameters():
+                parameter.requires_grad = False
+            args.bucket_batching = False
+            train_dataloader = get_dataloader(BertFeatureDataset(train_dataset, build_bert_features(model, train_dataset, 'train', args)), args, shuffle=train_shuffle)
+            dev_dataloader = get_dataloader(BertFeatureDataset(dev_dataset, build_bert_features(model, dev_dataset, 'dev', args)), args, shuffle=False)
         train(train_dataloader, dev_dataloader, args=args, model=model)
     elif mode == 'policy gradient':
-        model = torch.load('./res/' + args.model + '/2816_False_True_True_726425', map_location=lambda storage, loc: storage.cuda(0))
+        model = load_model('./res/' + args.model + '/2816_False_True_True_726425', args.device, args=args)
         train_rl(train_dataloader, dev_dataloader, args=args, model=model)
     elif mode == 'test model':
         # also need the correct 'model' for dataloader
-        model = torch.load('./res/policy_gradient/0.819928_True_True_True_412532', map_location=lambda storage, loc: storage.cuda(0))
+        model = load_model('./res/policy_gradient/0.819928_True_True_True_412532', args.device, args=args)
         eval(dev_dataloader, args, model, epoch=0)
         eval_rl(dev_dataloader, args, model, epoch=0)
     elif mode == 'add feature':
-        model = torch.load('./res/policy_gradient/0.804922_22-16-28', map_location=lambda storage, loc: storage.cuda(0))
+        model = load_model('./res/policy_gradient/0.804922_22-16-28', args.device, args=args)
         res = test(dev_dataloader, args, model)
         add_abstraction('dev', res=res, args=args)
     elif mode == 'write cases':
-        model = torch.load('./res/policy_gradient/0.819928_True_True_True_412532', map_location=lambda storage, loc: storage.cuda(0))
+        model = load_model('./res/policy_gradient/0.819928_True_True_True_412532', args.device, args=args)
         res_pg = test(dev_dataloader, args, model, sep=' ')
-        model = torch.load('./res/gate/epoch100', map_location=lambda storage, loc: storage.cuda(0))
+        model = load_model('./res/gate/epoch100', args.device, args=args)
         res_gate = test(dev_dataloader, args, model, sep=' ')
         with open('cases.txt', 'w', encoding='utf-8') as f:
             for key in res_pg.keys():
@@ -99,7 +120,7 @@ def main(mode, args):
                         f.write('Label:\t\t\t\t\t' + json.dumps(res_pg[key]['label']) + '\n')
                         f.write('SQL_Labels:\t\t\t\t' + json.dumps(res_pg[key]['sql_labels']) + '\n' + '\n')
     elif mode == 'anonymous':
-        model = torch.load('./res/policy_gradient/0.819928_True_True_True_412532', map_location=lambda storage, loc: storage.cuda(0))
+        model = load_model('./res/policy_gradient/0.819928_True_True_True_412532', args.device, args=args)
         res = test(train_dataloader, args, model, sep='')
         anonymous('train', res, args)
 
@@ -119,6 +140,7 @@ if __name__ == '__main__':
     args.cell_info = False
     args.attn_concat = True
     args.crf = False
+    args.bucket_batching = True
     # args.bert_model = None
     main('train baseline', args)
     # main('test model', args)
@@ -50,7 +50,8 @@ class Baseline(nn.Module):
         columns_split_marker, columns_split_marker_len = inputs[3]  # _, (batch_size)
         cells_split, cells_split_len = inputs[4]
         cells_split_marker, cells_split_marker_len = inputs[5]  # _, (batch_size)
-        batch_size = tokenize.size(0)
+        # lengths of the batch, can be shorter than args.*_max_len when the batch is trimmed
+        batch_size, tokenize_max_len = tokenize.size(0), tokenize.size(1)
         # encode token
         token_embed = self.token_embedding(tokenize)
         token_embed = token_embed.transpose(0, 1).contiguous()  # (tokenize_max_len, batch_size, word_dim)
@@ -58,19 +59,19 @@ class Baseline(nn.Module):
         pos_tag_embed = self.pos_tag_embedding(pos_tag).transpose(0, 1).contiguous()  # (tokenize_max_len, batch_size, word_dim)
         token_embed += pos_tag_embed
         # run token lstm
-        token_out, token_hidden = runBiRNN(self.token_lstm, token_embed, tokenize_len, total_length=self.args.tokenize_max_len)  # (tokenize_max_len, batch_size, 2*hidden_size), _
+        token_out, token_hidden = runBiRNN(self.token_lstm, token_embed, tokenize_len, total_length=tokenize_max_len)  # (tokenize_max_len, batch_size, 2*hidden_size), _
         # encode columns
         col_embed = self.token_embedding(columns_split).transpose(0, 1).contiguous()  # (columns_token_max_len, batch_size, word_dim)
-        col_out, col_hidden = self.table_encoder(self.token_lstm, col_embed, columns_split_len, columns_split_marker, hidden=token_hidden, total_length=self.args.columns_token_max_len)  # (columns_split_marker_max_len - 1, batch_size, 2 * hidden_size)
+        col_out, col_hidden = self.table_encoder(self.token_lstm, col_embed, columns_split_len, columns_split_marker, hidden=token_hidden, total_length=columns_split.size(1))  # (columns_split_marker_max_len - 1, batch_size, 2 * hidden_size)
         # encode cells
         cell_embed = self.token_embedding(cells_split).transpose(0,1).contiguous()
-        cell_out, cell_hidden = self.table_encoder(self.token_lstm, cell_embed, cells_split_len, cells_split_marker, hidden=col_hidden, total_length=self.args.cells_token_max_len)
+        cell_out, cell_hidden = self.table_encoder(self.token_lstm, cell_embed, cells_split_len, cells_split_marker, hidden=col_hidden, total_length=cells_split.size(1))
         # concat as memory_bank
         memory_bank = torch.cat([token_out, col_out, cell_out], dim=0).transpose(0, 1).contiguous()
         # decode one step (encode)
         pointer_align_scores, _, _ = self.pointer_net_decoder(tgt=token_embed, src=memory_bank, hidden=col_hidden,
                                                                 tgt_lengths=tokenize_len,
-                                                                tgt_max_len=self.args.tokenize_max_len,
+                                                                tgt_max_len=tokenize_max_len,
                                                                 src_lengths=None,
                                                                 src_max_len=None)
         logger.debug('pointer_align_scores'), logger.debug(pointer_align_scores.size())
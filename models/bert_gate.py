@@ -22,12 +22,28 @@ np.set_printoptions(threshold=np.inf)
 torch.set_printoptions(precision=None, threshold=None, edgeitems=None, linewidth=None, profile='full')
 
 
+def truncate_bert_layers(bert_model, bert_layers):
+    """
+    keep part of the encoder layers of a loaded bert_model, the kept layers keep their weights.
+    :param bert_layers: k to keep the first k layers, or a list of the indices of the layers to keep.
+    """
+    layers = bert_model.encoder.layer
+    indices = list(range(bert_layers)) if isinstance(bert_layers, int) else list(bert_layers)
+    assert 0 < len(indices) and all(0 <= index < len(layers) for index in indices), 'bert_layers out of range: {}'.format(bert_layers)
+    bert_model.encoder.layer = nn.ModuleList([layers[index] for index in indices])
+    bert_model.config.num_hidden_layers = len(indices)
+    return bert_model
+
+
 class BertGate(nn.Module):
     def __init__(self, args):
         super(BertGate, self).__init__()
         # args
         self.args = args
         self.bert_model = BertModel.from_pretrained(self.args.bert_model)
+        # use part of the encoder layers, models saved before bert_layers use all layers
+        if getattr(self.args, 'bert_layers', None) is not None:
+            truncate_bert_layers(self.bert_model, self.args.bert_layers)
         # # pos_tag embedding
         # self.pos_tag_embedding = nn.Embedding(len(args.pos_tag_vocab), args.word_dim)
         # gate
@@ -44,54 +60,20 @@ class BertGate(nn.Module):
             else:
                 raise NotImplementedError
 
-    def forward(self, inputs):
-        # unpack inputs to data
-        # (batch_size, tokenize_max_len), (batch_size), (batch_size, tokenize_max_len), (batch_size)
-        tokenize, tokenize_len, tokenize_marker, tokenize_marker_len = inputs[0]
-        # (batch_size, bert_columns_split_max_len), _, _, _
-        columns_split, columns_split_len, columns_split_marker, columns_split_marker_len = inputs[1]
-        # cells_split, cells_split_len, cells_split_marker, cells_split_marker_len = inputs[2]
-        # get batch_size and device
-        batch_size = tokenize.size(0)
-        device = tokenize.device
-        # print(batch_size, device)
-        # encode token and columns
-        # (batch_size, tokenize_max_len + bert_columns_split_max_len)
-        bert_tokens_and_cols = torch.cat([tokenize, columns_split], dim=-1)
-        bert_tokens_segments, bert_columns_segments = torch.zeros_like(tokenize).to(device), torch.ones_like(columns_split).to(device)
-        # (batch_size, tokenize_max_len + bert_columns_split_max_len)
-        bert_segments = torch.cat([bert_tokens_segments, bert_columns_segments], dim=-1)
-        bert_tokens_mask, bert_columns_mask = sequence_mask(tokenize_len, max_len=self.args.bert_tokenize_max_len), sequence_mask(columns_split_len, max_len=self.args.bert_columns_split_max_len)
-        # print(bert_tokens_mask.size(), bert_columns_mask.size(), bert_tokens_mask.device, bert_columns_mask.device)
-        # print(tokenize_len)
-        # print(bert_tokens_mask)
-        # print(columns_split_len)
-        # print(bert_columns_mask)
-        bert_mask = torch.cat([bert_tokens_mask, bert_columns_mask], dim=-1)
-        # (batch_size, tokenize_max_len + bert_columns_split_max_len, self.bert_model.config.hidden_size), _
-        bert_output, _ = self.bert_model(bert_tokens_and_cols, bert_segments, attention_mask=bert_mask, output_all_encoded_layers=False)
-        # (batch_size, tokenize_max_len, self.bert_model.config.hidden_size), (batch_size, bert_columns_split_max_len, self.bert_model.config.hidden_size)
-        bert_tokens_output, bert_columns_output = bert_output[:, :self.args.bert_tokenize_max_len, :], bert_output[:, self.args.bert_tokenize_max_len:, :]
-        # add sub_tokens
-        bert_tokens_output_cumsum, bert_columns_output_cumsum = torch.cumsum(bert_tokens_output, dim=1), torch.cumsum(bert_columns_output, dim=1)
-        batch_index = torch.LongTensor(range(batch_size)).unsqueeze(-1).to(device)
-        # (batch_size, tokenize_max_len - 1), (batch_size, bert_columns_split_max_len - 1)
-        tokens_batch_index, columns_batch_index = batch_index.expand(tokenize_marker.size(0), tokenize_marker.size(1) - 1), batch_index.expand(columns_split_marker.size(0), columns_split_marker.size(1) - 1)
-        # add sub_tokens for tokens
-        right_tokens_marker, left_tokens_marker = tokenize_marker[:, 1:], tokenize_marker[:, :-1]
-        # (batch_size, tokenize_max_len - 1, self.bert_model.config.hidden_size), (batch_size, tokenize_max_len - 1, self.bert_model.config.hidden_size)
-        right_bert_tokens_output_cumsum, left_bert_tokens_output_cumsum = bert_tokens_output_cumsum[tokens_batch_index, right_tokens_marker, :], bert_tokens_output_cumsum[tokens_batch_index, left_tokens_marker, :]
-        # (batch_size, tokenize_max_len, self.bert_model.config.hidden_size)
-        bert_tokens_sum = torch.cat([bert_tokens_output_cumsum[batch_index, tokenize_marker[:, 0].unsqueeze(1), :], right_bert_tokens_output_cumsum - left_bert_tokens_output_cumsum], dim=1)
-        # add sub_tokens for columns
-        right_columns_split_marker, left_columns_split_marker = (columns_split_marker - 1)[:, 1:], columns_split_marker[:, :-1]
-        right_bert_columns_output_cumsum, left_bert_columns_output_cumsum = bert_columns_output_cumsum[columns_batch_index, right_columns_split_marker, :], bert_columns_output_cumsum[columns_batch_index, left_columns_split_marker, :]
-        # (batch_size, bert_columns_split_max_len - 1, self.bert_model.config.hidden_size)
-        bert_columns_split_sum = right_bert_columns_output_cumsum - left_bert_columns_output_cumsum
+    def forward(self, inputs=None, features=None):
+        """
+        :param inputs: the inputs of BindingDataset, bert_model is run.
+        :param features: the pooled features of BertFeatureDataset instead of inputs, bert_model is not run.
+        """
+        if features is not None:
+            bert_tokens_sum, _, bert_columns_split_sum, columns_split_marker_len = features
+        else:
+            bert_tokens_sum, bert_columns_split_sum = self.encode(inputs)
+            columns_split_marker_len = inputs[1][3]
         if self.args.attn_concat:
             # (batch_size, tokenize_max_len, self.bert_model.config.hidden_size), _
             column_attn_h, column_align_score = self.column_pointer_network(input=bert_tokens_sum, context=bert_columns_split_sum,
-                                                                            context_lengths=columns_split_marker_len - 1, context_max_len=self.args.bert_columns_split_marker_max_len - 1)
+                                                                            context_lengths=columns_split_marker_len - 1, context_max_len=bert_columns_split_sum.size(1))
         else:
             raise NotImplementedError
         # gate_input = torch.cat([column_attn_h, bert_tokens_sum], dim=-1)
@@ -108,5 +90,84 @@ class BertGate(nn.Module):
             # loss /= batch_size
             # return loss
 
+    def encode(self, inputs):
+        """
+        run bert_model and add the sub_tokens of every token and column.
+        :return: bert_tokens_sum (batch_size, tokenize_max_len, hidden_size), bert_columns_split_sum (batch_size, bert_columns_split_marker_max_len - 1, hidden_size)
+        """
+        # unpack inputs to data
+        # (batch_size, tokenize_max_len), (batch_size), (batch_size, tokenize_max_len), (batch_size)
+        tokenize, tokenize_len, tokenize_marker, tokenize_marker_len = inputs[0]
+        # (batch_size, bert_columns_split_max_len), _, _, _
+        columns_split, columns_split_len, columns_split_marker, columns_split_marker_len = inputs[1]
+        # cells_split, cells_split_len, cells_split_marker, cells_split_marker_len = inputs[2]
+        # get batch_size and device
+        # lengths of the batch, can be shorter than args.bert_*_max_len when the batch is trimmed
+        batch_size, bert_tokenize_max_len = tokenize.size(0), tokenize.size(1)
+        device = tokenize.device
+        # print(batch_size, device)
+        # models saved before bert_packed use the padded layout
+        if getattr(self.args, 'bert_packed', False):
+            # (batch_size, packed_max_len, self.bert_model.config.hidden_size), (batch_size)
+            bert_output_cumsum, columns_start = self.encode_packed(tokenize, tokenize_marker, columns_split, columns_split_marker)
+            # the columns start after the question, move the markers of columns to the packed positions
+            bert_tokens_output_cumsum, bert_columns_output_cumsum = bert_output_cumsum, bert_output_cumsum
+            columns_split_marker = columns_split_marker + columns_start.unsqueeze(1)
+        else:
+            # encode token and columns
+            # (batch_size, tokenize_max_len + bert_columns_split_max_len)
+            bert_tokens_and_cols = torch.cat([tokenize, columns_split], dim=-1)
+            bert_tokens_segments, bert_columns_segments = torch.zeros_like(tokenize).to(device), torch.ones_like(columns_split).to(device)
+            # (batch_size, tokenize_max_len + bert_columns_split_max_len)
+            bert_segments = torch.cat([bert_tokens_segments, bert_columns_segments], dim=-1)
+            bert_tokens_mask, bert_columns_mask = sequence_mask(tokenize_len, max_len=bert_tokenize_max_len), sequence_mask(columns_split_len, max_len=columns_split.size(1))
+            # print(bert_tokens_mask.size(), bert_columns_mask.size(), bert_tokens_mask.device, bert_columns_mask.device)
+            # print(tokenize_len)
+            # print(bert_tokens_mask)
+            # print(columns_split_len)
+            # print(bert_columns_mask)
+            bert_mask = torch.cat([bert_tokens_mask, bert_columns_mask], dim=-1)
+            # (batch_size, tokenize_max_len + bert_columns_split_max_len, self.bert_model.config.hidden_size), _
+            bert_output, _ = self.bert_model(bert_tokens_and_cols, bert_segments, attention_mask=bert_mask, output_all_encoded_layers=False)
+            # (batch_size, tokenize_max_len, self.bert_model.config.hidden_size), (batch_size, bert_columns_split_max_len, self.bert_model.config.hidden_size)
+            bert_tokens_output, bert_columns_output = bert_output[:, :bert_tokenize_max_len, :], bert_output[:, bert_tokenize_max_len:, :]
+            # add sub_tokens
+            bert_tokens_output_cumsum, bert_columns_output_cumsum = torch.cumsum(bert_tokens_output, dim=1), torch.cumsum(bert_columns_output, dim=1)
+        batch_index = torch.arange(batch_size, device=device).unsqueeze(-1)
+        # (batch_size, tokenize_max_len), (batch_size, bert_columns_split_max_len - 1)
+        tokens_batch_index, columns_batch_index = batch_index.expand_as(tokenize_marker), batch_index.expand(columns_split_marker.size(0), columns_split_marker.size(1) - 1)
+        # add sub_tokens for tokens, the cumsum at every token minus the cumsum at the previous token (0 for the first token),
+        # the index is never empty, onnx can not reshape the empty index of a batch of questions of one token
+        # (batch_size, tokenize_max_len, self.bert_model.config.hidden_size)
+        bert_tokens_marker_cumsum = bert_tokens_output_cumsum[tokens_batch_index, tokenize_marker, :]
+        bert_tokens_sum = bert_tokens_marker_cumsum - torch.cat([torch.zeros_like(bert_tokens_marker_cumsum[:, :1]), bert_tokens_marker_cumsum[:, :-1]], dim=1)
+        # add sub_tokens for columns
+        right_columns_split_marker, left_columns_split_marker = (columns_split_marker - 1)[:, 1:], columns_split_marker[:, :-1]
+        right_bert_columns_output_cumsum, left_bert_columns_output_cumsum = bert_columns_output_cumsum[columns_batch_index, right_columns_split_marker, :], bert_columns_output_cumsum[columns_batch_index, left_columns_split_marker, :]
+        # (batch_size, bert_columns_split_max_len - 1, self.bert_model.config.hidden_size)
+        bert_columns_split_sum = right_bert_columns_output_cumsum - left_bert_columns_output_cumsum
+        return bert_tokens_sum, bert_columns_split_sum
+
+    def encode_packed(self, tokenize, tokenize_marker, columns_split, columns_split_marker):
+        """
+        encode [question, columns, padding] instead of [question, padding, columns, padding],
+        padded to the longest real length of the batch, so bert does not attend over the padding inside.
+        :return: cumsum of the bert output (batch_size, packed_max_len, hidden_size), the start of the columns (batch_size).
+        """
+        batch_size = tokenize.size(0)
+        # the markers are the last sub_token of every token and the [SEP]s of columns, the last marker + 1 is the real length
+        tokenize_len, columns_split_len = tokenize_marker.max(1)[0] + 1, columns_split_marker.max(1)[0] + 1
+        packed_len = tokenize_len + columns_split_len
+        # (batch_size, packed_max_len)
+        # arange of a tensor keeps the length dynamic when traced, e.g. by torch.onnx.export
+        positions = torch.arange(packed_len.max(), device=tokenize.device).unsqueeze(0).expand(batch_size, -1)
+        is_tokens, bert_mask = positions < tokenize_len.unsqueeze(1), positions < packed_len.unsqueeze(1)
+        tokens_index = positions.clamp(max=tokenize.size(1) - 1)
+        columns_index = (positions - tokenize_len.unsqueeze(1)).clamp(0, columns_split.size(1) - 1)
+        bert_packed = torch.where(is_tokens, tokenize.gather(1, tokens_index), columns_split.gather(1, columns_index)).masked_fill(~bert_mask, 0)
+        bert_segments = (~is_tokens & bert_mask).long()
+        bert_output, _ = self.bert_model(bert_packed, bert_segments, attention_mask=bert_mask.long(), output_all_encoded_layers=False)
+        return torch.cumsum(bert_output, dim=1), tokenize_len
+
     def get_small_lr_parameters(self):
         return self.bert_model.parameters()
@@ -4,6 +4,7 @@ import sys
 import torch
 import random
 import logging
+import collections
 import numpy as np
 from torch import nn
 from torchcrf import CRF
@@ -42,6 +43,8 @@ class Gate(nn.Module):
                                   num_layers=args.num_layers, dropout=args.dropout_p)
         # table_encoder
         self.table_encoder = TableRNNEncoder(self.args)
+        # cache of the encoded columns for inference, see set_table_cache
+        self.table_cache, self.checkpoint_id = None, None
         # gate
         if self.args.cell_info:
             self.gate = nn.Linear(6 * self.args.hidden_size, self.args.gate_class)
@@ -61,7 +64,10 @@ class Gate(nn.Module):
             else:
                 raise NotImplementedError
 
-    def forward(self, inputs):
+    def forward(self, inputs, table_ids=None):
+        """
+        :param table_ids: the table_id of every question, to get the encoded columns from the table_cache when not training.
+        """
         # unpack inputs to data
         tokenize, tokenize_len = inputs[0]  # _, (batch_size)
         pos_tag = inputs[1][0]
@@ -69,7 +75,9 @@ class Gate(nn.Module):
         columns_split_marker, columns_split_marker_len = inputs[3]  # _, (batch_size)
         cells_split, cells_split_len = inputs[4]
         cells_split_marker, cells_split_marker_len = inputs[5]  # _, (batch_size)
-        batch_size = tokenize.size(0)
+        # lengths of the batch, can be shorter than args.*_max_len when the batch is trimmed
+        batch_size, tokenize_max_len = tokenize.size(0), tokenize.size(1)
+        columns_split_marker_max_len, cells_split_marker_max_len = columns_split_marker.size(1), cells_split_marker.size(1)
         # encode token
         token_embed = self.token_embedding(tokenize)
         token_embed = token_embed.transpose(0, 1).contiguous()  # (tokenize_max_len, batch_size, word_dim)
@@ -77,27 +85,33 @@ class Gate(nn.Module):
         pos_tag_embed = self.pos_tag_embedding(pos_tag).transpose(0, 1).contiguous()  # (tokenize_max_len, batch_size, word_dim)
         token_embed += pos_tag_embed
         # run token lstm; (tokenize_max_len, batch_size, 2 * hidden_size), _
-        token_out, token_hidden = runBiRNN(self.token_lstm, token_embed, tokenize_len, total_length=self.args.tokenize_max_len)
-        # encode columns
-        col_embed = self.token_embedding(columns_split).transpose(0, 1).contiguous()  # (columns_token_max_len, batch_size, word_dim)
+        token_out, token_hidden = runBiRNN(self.token_lstm, token_embed, tokenize_len, total_length=tokenize_max_len)
+        # encode columns, once for every table of the batch
         # (columns_split_marker_max_len - 1, batch_size, 2 * hidden_size), ((layer * bidirectional, batch, hidden_size), _)
-        col_out, col_hidden = self.table_encoder(self.col_lstm, col_embed, columns_split_len, columns_split_marker, hidden=None, total_length=self.args.columns_token_max_len)
+        if table_ids is not None and getattr(self, 'table_cache', None) is not None and not self.training:
+            col_out, col_hidden, col_context_proj = self.encode_columns_cached(columns_split, columns_split_len, columns_split_marker, columns_split_marker_len, table_ids)
+            col_context_proj = col_context_proj.transpose(0, 1).contiguous()
+        else:
+            table_index = inputs[6][0] if len(inputs) > 6 else None
+            col_out, col_hidden = self.encode_columns(columns_split, columns_split_len, columns_split_marker, table_index=table_index)
+            col_context_proj = None
         # encode cells
         cell_embed = self.token_embedding(cells_split).transpose(0,1).contiguous()
-        cell_out, cell_hidden = self.table_encoder(self.cell_lstm, cell_embed, cells_split_len, cells_split_marker, hidden=None, total_length=self.args.cells_token_max_len)
+        cell_out, cell_hidden = self.table_encoder(self.cell_lstm, cell_embed, cells_split_len, cells_split_marker, hidden=None, total_length=cells_split.size(1))
         if self.args.attn_concat:
             col_contex, col_align_score = self.col_pointer_network(input=token_out.transpose(0, 1).contiguous(),
                                                        context=col_out.transpose(0, 1).contiguous(),
                                                        context_lengths=columns_split_marker_len - 1,
-                                                       context_max_len=self.args.columns_split_marker_max_len - 1)
+                                                       context_max_len=columns_split_marker_max_len - 1,
+                                                       context_proj=col_context_proj)
             cell_contex, cell_align_score = self.cell_pointer_network(input=token_out.transpose(0, 1).contiguous(),
                                                                       context=cell_out.transpose(0, 1).contiguous(),
                                                                       context_lengths=cells_split_marker_len - 1,
-                                                                      context_max_len=self.args.cells_split_marker_max_len - 1)
+                                                                      context_max_len=cells_split_marker_max_len - 1)
             col_contex, cell_contex = col_contex.transpose(0, 1).contiguous(), cell_contex.transpose(0, 1).contiguous()
         else:
             # concat token_out and hidden, todo: more layers -> modify fix_hidden
-            col_contex, cell_contex = fix_hidden(col_hidden[0]).expand(self.args.tokenize_max_len, batch_size, 2 * self.args.hidden_size), fix_hidden(cell_hidden[0]).expand(self.args.tokenize_max_len, batch_size, 2 * self.args.hidden_size)
+            col_contex, cell_contex = fix_hidden(col_hidden[0]).expand(tokenize_max_len, batch_size, 2 * self.args.hidden_size), fix_hidden(cell_hidden[0]).expand(tokenize_max_len, batch_size, 2 * self.args.hidden_size)
         if self.args.cell_info:
             # (tokenize_max_len, batch_size, 6 * hidden_size)
             gate_input = torch.cat([token_out, col_contex, cell_contex], -1)
@@ -111,11 +125,12 @@ class Gate(nn.Module):
             col_contex, col_align_score = self.col_pointer_network(input=token_out.transpose(0, 1).contiguous(),
                                                                    context=col_out.transpose(0, 1).contiguous(),
                                                                    context_lengths=columns_split_marker_len - 1,
-                                                                   context_max_len=self.args.columns_split_marker_max_len - 1)
+                                                                   context_max_len=columns_split_marker_max_len - 1,
+                                                                   context_proj=col_context_proj)
             cell_contex, cell_align_score = self.cell_pointer_network(input=token_out.transpose(0, 1).contiguous(),
                                                                       context=cell_out.transpose(0, 1).contiguous(),
                                                                       context_lengths=cells_split_marker_len - 1,
-                                                                      context_max_len=self.args.cells_split_marker_max_len - 1)
+                                                                      context_max_len=cells_split_marker_max_len - 1)
         # gate_col; (batch_size, tokenize_max_len, columns_split_marker_max_len - 1)
         gate_out_col = gate_output[:, :, 1].unsqueeze(-1).expand(col_align_score.size()) * col_align_score
         gate_out_cell = gate_output[:, :, 2].unsqueeze(-1).expand(cell_align_score.size()) * cell_align_score
@@ -128,11 +143,80 @@ class Gate(nn.Module):
         # _, _, (batch_size, tgt_len, src_len or class_num)
         return gate_output, col_align_score, pointer_align_scores
 
+    def encode_columns(self, columns_split, columns_split_len, columns_split_marker, table_index=None):
+        """
+        the columns of the questions on the same table are the same, encode the unique tables then scatter back to the questions.
+        :param table_index: (batch_size), the table of every question, None to encode every question.
+        """
+        if table_index is not None:
+            unique_table, inverse = torch.unique(table_index, return_inverse=True)
+            # any question of a table, they have the same columns
+            first = inverse.new_zeros(unique_table.size(0)).scatter_(0, inverse, torch.arange(table_index.size(0), device=inverse.device))
+            columns_split, columns_split_len, columns_split_marker = columns_split[first], columns_split_len[first], columns_split_marker[first]
+        col_embed = self.token_embedding(columns_split).transpose(0, 1).contiguous()  # (columns_token_max_len, num_tables, word_dim)
+        col_out, col_hidden = self.table_encoder(self.col_lstm, col_embed, columns_split_len, columns_split_marker, hidden=None, total_length=columns_split.size(1))
+        if table_index is not None:
+            col_out, col_hidden = col_out[:, inverse], tuple(hidden[:, inverse] for hidden in col_hidden)
+        return col_out, col_hidden
+
+    def set_table_cache(self, table_cache, checkpoint_id):
+        """
+        use a TableEncodingCache for inference, the table_cache is not saved with the model, see __getstate__.
+        :param checkpoint_id: identify the weights, e.g. the path of the loaded model, so a table_cache shared by
+                              several models never returns the encodings of other weights. None when table_cache is None.
+        """
+        assert table_cache is None or checkpoint_id is not None, 'a table_cache needs a checkpoint_id'
+        self.table_cache, self.checkpoint_id = table_cache, checkpoint_id
+
+    def __getstate__(self):
+        # torch.save and copy.deepcopy drop the table_cache
+        state = super(Gate, self).__getstate__()
+        state['table_cache'], state['checkpoint_id'] = None, None
+        return state
+
+    def encode_columns_cached(self, columns_split, columns_split_len, columns_split_marker, columns_split_marker_len, table_ids):
+        """
+        encode the columns of the tables missing in table_cache, then get every table from table_cache.
+        :return: col_out, col_hidden and linear_context(col_out) of col_pointer_network, padded columns are zeros.
+        """
+        keys, entries, missing = [], {}, collections.OrderedDict()
+        for index, table_id in enumerate(table_ids):
+            key = self.table_cache.get_key(table_id, columns_split[index, :columns_split_len[index]],
+                                           columns_split_marker[index, :columns_split_marker_len[index]], self.checkpoint_id)
+            keys.append(key)
+            if key in entries or key in missing:
+                continue
+            entry = self.table_cache.get(key)
+            if entry is None:
+                missing[key] = index
+            else:
+                entries[key] = entry
+        if len(missing) > 0:
+            rows = torch.LongTensor(list(missing.values())).to(columns_split.device)
+            col_out, col_hidden = self.encode_columns(columns_split[rows], columns_split_len[rows], columns_split_marker[rows])
+            col_context_proj = self.col_pointer_network.linear_context(col_out)
+            for i, (key, index) in enumerate(missing.items()):
+                num_columns = int(columns_split_marker_len[index]) - 1
+                # copies, views of the batch would keep the storage (and the graph, when grad is enabled) of the whole batch alive
+                entries[key] = (col_out[:num_columns, i].detach().clone(), col_context_proj[:num_columns, i].detach().clone(),
+                                tuple(hidden[:, i].detach().clone() for hidden in col_hidden))
+                self.table_cache.put(key, entries[key])
+        # the padded columns are masked by the pointer networks
+        col_out = columns_split.new_zeros((columns_split_marker.size(1) - 1, len(keys), 2 * self.hidden_size), dtype=torch.float)
+        col_context_proj = torch.zeros_like(col_out)
+        for index, key in enumerate(keys):
+            out, context_proj, _ = entries[key]
+            col_out[:out.size(0), index], col_context_proj[:out.size(0), index] = out, context_proj
+        col_hidden = tuple(torch.stack([entries[key][2][i] for key in keys], dim=1) for i in range(len(entries[keys[0]][2])))
+        return col_out, col_hidden, col_context_proj
+
     def forward_loss(self, inputs, labels):
         gate_output, _, pointer_align_scores = self.forward(inputs)
         tokenize_len = inputs[0][1]
-        mask = sequence_mask(tokenize_len, max_len=self.args.tokenize_max_len).to(self.args.device)
-        loss = -self.crf(pointer_align_scores, labels, mask=mask)
+        mask = sequence_mask(tokenize_len, max_len=labels.size(1)).to(self.args.device)
+        # the crf sums the scores over the sequence, keep it in float32 under autocast
+        with torch.autocast(device_type=pointer_align_scores.device.type, enabled=False):
+            loss = -self.crf(pointer_align_scores.float(), labels, mask=mask)
         loss /= labels.size(1)
         return loss
 
@@ -3,18 +3,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-
-
-def sequence_mask(lengths, max_len=None):
-    """
-    Creates a boolean mask from sequence lengths.
-    """
-    batch_size = lengths.numel()
-    max_len = max_len or lengths.max()
-    return (torch.arange(0, max_len)
-            .type_as(lengths)
-            .repeat(batch_size, 1)
-            .lt(lengths.unsqueeze(1)))
+from utils import masked_attention
 
 
 class Attention(nn.Module):
@@ -37,24 +26,6 @@ class Attention(nn.Module):
         else:
             raise NotImplementedError()
 
-    def score(self, src, tgt):
-        """ Attention score calculation
-        Args:
-          src : source values (bz, src_len, dim)
-          tgt : target values (bz, tgt_len, dim)
-        """
-        bz, src_len, dim = src.size()
-        _, tgt_len, _ = tgt.size()
-
-        if self.attn_type in ["general", "dot"]:
-            tgt_ = tgt
-            if self.attn_type == "general":
-                tgt_ = self.linear(tgt_)
-            src_ = src.transpose(1, 2)
-            return torch.bmm(tgt_, src_)
-        else:
-            raise NotImplementedError()
-
     def forward(self, src, tgt, src_lengths=None, src_max_len=None):
         """
         Args:
@@ -64,29 +35,16 @@ class Attention(nn.Module):
         """
         if tgt.dim() == 2:
             one_step = True
-            src = src.unsqueeze(1)
+            tgt = tgt.unsqueeze(1)
         else:
             one_step = False
 
         bz, src_len, dim = src.size()
         _, tgt_len, _ = tgt.size()
 
-        align_score = self.score(src, tgt)
-
-        if src_lengths is not None:
-            mask = sequence_mask(src_lengths, src_max_len)
-            # (bz, max_len) -> (bz, 1, max_len)
-            # so mask can broadcast
-            mask = mask.unsqueeze(1)
-            if self.args.cuda:
-                mask = mask.cuda()
-            align_score.data.masked_fill_(1 - mask, -float('inf'))
-
-        # Normalize weights
-        # bugs: softmax zero in the last can't get zero?
-        align_score = torch.softmax(align_score, -1)
-
-        c = torch.bmm(align_score, src)
+        tgt_ = self.linear(tgt) if self.attn_type == "general" else tgt
+        # scores, mask, softmax and the weighted average of src in one masked_attention
+        c, align_score = masked_attention(tgt_, src, src, lengths=src_lengths)
 
         concat_c = torch.cat([c, tgt], -1)
         attn_h = self.linear_out(concat_c)
@@ -1,6 +1,8 @@
 import torch
+import functools
 import torch.nn as nn
-from utils import aeq
+from torch.utils.checkpoint import checkpoint
+from utils import aeq, masked_attention
 
 
 class GlobalAttention(nn.Module):
@@ -66,10 +68,12 @@ class GlobalAttention(nn.Module):
 
         self.tanh = nn.Tanh()
 
-    def score(self, h_t, h_s):
+    def score(self, h_t, h_s, h_s_proj=None):
         """
         h_t (FloatTensor): batch x tgt_len x dim
         h_s (FloatTensor): batch x src_len x dim
+        h_s_proj (FloatTensor): batch x src_len x dim, linear_context(h_s) computed before (mlp only)
+        mlp scores the pairs in tiles of at most args.attn_chunk_size elements of batch x tgt_len x src_len x dim
         returns scores (FloatTensor): batch x tgt_len x src_len:
             raw attention scores for each src index
         """
@@ -82,33 +86,77 @@ class GlobalAttention(nn.Module):
         aeq(self.dim, src_dim)
 
         if self.attn_type in ["general", "dot"]:
-            if self.attn_hidden > 0:
-                h_t = self.transform_in(h_t)
-                h_s = self.transform_in(h_s)
-            if self.attn_type == "general":
-                h_t = self.linear_in(h_t)
+            h_t, h_s = self.dot_inputs(h_t, h_s)
             h_s_ = h_s.transpose(1, 2)
             # (batch, t_len, d) x (batch, d, s_len) --> (batch, t_len, s_len)
             return torch.bmm(h_t, h_s_)
         else:
             dim = self.dim
-            wq = self.linear_query(h_t.view(-1, dim))
-            wq = wq.view(tgt_batch, tgt_len, 1, dim)
-            wq = wq.expand(tgt_batch, tgt_len, src_len, dim)
-
-            uh = self.linear_context(h_s.contiguous().view(-1, dim))
-            uh = uh.view(src_batch, 1, src_len, dim)
-            uh = uh.expand(src_batch, tgt_len, src_len, dim)
+            # (batch, t_len, d)
+            wq = self.linear_query(h_t.view(-1, dim)).view(tgt_batch, tgt_len, dim)
+
+            if h_s_proj is None:
+                uh = self.linear_context(h_s.contiguous().view(-1, dim))
+            else:
+                uh = h_s_proj
+            # (batch, s_len, d)
+            uh = uh.view(src_batch, src_len, dim)
+
+            chunk_size = getattr(self.args, 'attn_chunk_size', None)
+            # the number of tiles would be a constant of a traced graph, e.g. by torch.onnx.export
+            if chunk_size is None or torch.jit.is_tracing() or tgt_batch * tgt_len * src_len * dim <= chunk_size:
+                return self.mlp_score(wq, uh)
+            # tiles of the (batch, t_len, s_len, d) tensor with at most chunk_size elements (batch x d when a single pair is larger)
+            if tgt_batch * src_len * dim <= chunk_size:
+                tgt_step, src_step = chunk_size // (tgt_batch * src_len * dim), src_len
+            else:
+                tgt_step, src_step = 1, max(1, chunk_size // (tgt_batch * dim))
+            score_tile = self.mlp_score
+            if torch.is_grad_enabled():
+                # only the inputs of a tile are saved for backward and tanh is computed again, the peak memory is bounded in training too
+                score_tile = functools.partial(checkpoint, self.mlp_score, use_reentrant=False)
+            scores = []
+            for i in range(0, tgt_len, tgt_step):
+                scores.append(torch.cat([score_tile(wq[:, i:i + tgt_step], uh[:, j:j + src_step]) for j in range(0, src_len, src_step)], dim=2))
+            return torch.cat(scores, dim=1)
+
+    def dot_inputs(self, h_t, h_s):
+        """
+        the query and key of dot / general, the scores are their bmm.
+        """
+        if self.attn_hidden > 0:
+            h_t = self.transform_in(h_t)
+            h_s = self.transform_in(h_s)
+        if self.attn_type == "general":
+            h_t = self.linear_in(h_t)
+        return h_t, h_s
 
-            # (batch, t_len, s_len, d)
-            wquh = self.tanh(wq + uh)
+    def mlp_score(self, wq, uh):
+        """
+        wq (FloatTensor): batch x tgt_len x dim, linear_query(h_t)
+        uh (FloatTensor): batch x src_len x dim, linear_context(h_s)
+        returns scores (FloatTensor): batch x tgt_len x src_len: v^T tanh(wq + uh) of every pair
+        """
+        # (batch, t_len, s_len, d)
+        wquh = self.tanh(wq.unsqueeze(2) + uh.unsqueeze(1))
+        # reduce every pair on its own instead of the gemv of self.v, so the scores do not depend on the tiles
+        return (wquh * self.v_weight()).sum(-1)
 
-            return self.v(wquh.view(-1, dim)).view(tgt_batch, tgt_len, src_len)
+    def v_weight(self):
+        """
+        the weight of self.v as a (dim) vector, also when quantize_dynamic (see export.quantize) replaced self.v
+        by a dynamic quantized Linear, whose weight is a method returning a quantized tensor.
+        """
+        weight = self.v.weight
+        if callable(weight):
+            weight = weight().dequantize()
+        return weight.view(-1)
 
-    def forward(self, input, context, context_lengths=None, context_max_len=None):
+    def forward(self, input, context, context_lengths=None, context_max_len=None, context_proj=None):
         """
         input (FloatTensor): batch x tgt_len x dim: decoder's rnn's output.
         context (FloatTensor): batch x src_len x dim: src hidden states
+        context_proj (FloatTensor): batch x src_len x dim: linear_context(context), e.g. from TableEncodingCache
         """
 
         # one step input
@@ -124,21 +172,27 @@ class GlobalAttention(nn.Module):
         aeq(dim, dim_)
         aeq(self.dim, dim)
 
-        # compute attention scores, as in Luong et al.
-        align = self.score(input, context)
-
-        if context_lengths is not None:
-            mask = self.sequence_mask(context_lengths, context_max_len)
-            mask = mask.unsqueeze(1)
-            # (bz, max_len) -> (bz, 1, max_len), so mask can broadcast
-            align.data.masked_fill_(1 - mask, -float('inf'))
-
-        # Softmax to normalize attention weights
-        align_vectors = torch.softmax(align, dim=-1)
-
-        # each context vector c_t is the weighted average
-        # over all the source hidden states
-        c = torch.bmm(align_vectors, context)
+        if self.attn_type in ["general", "dot"]:
+            # scores, mask, softmax and the weighted average in one masked_attention
+            query, key = self.dot_inputs(input, context)
+            c, align_vectors = masked_attention(query, key, context, lengths=context_lengths)
+        else:
+            # compute attention scores, as in Luong et al.
+            align = self.score(input, context, h_s_proj=context_proj)
+
+            if context_lengths is not None:
+                mask = self.sequence_mask(context_lengths, context_max_len)
+                mask = mask.unsqueeze(1)
+                # (bz, max_len) -> (bz, 1, max_len), so mask can broadcast
+                # out of place on align, masking align.data is lost when traced, e.g. by torch.onnx.export
+                align = align.masked_fill(~mask, -float('inf'))
+
+            # Softmax to normalize attention weights
+            align_vectors = torch.softmax(align, dim=-1)
+
+            # each context vector c_t is the weighted average
+            # over all the source hidden states
+            c = torch.bmm(align_vectors, context)
         # concatenate
         concat_c = torch.cat([c, input], -1)
         # linear_out
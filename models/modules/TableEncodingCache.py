@@ -0,0 +1,49 @@
+# coding: utf-8
+
+import hashlib
+from cache import LRUCache
+
+
+class TableEncodingCache(object):
+    """
+    cache the encoded columns of tables for inference, keyed by (table_id, header digest, checkpoint_id).
+    the header digest is taken from the column ids and markers, so a changed header or vocab is a miss,
+    and the checkpoint_id keeps the encodings of different weights apart.
+    """
+    def __init__(self, max_size=1000):
+        """
+        :param max_size: number of tables, the least recently used ones are evicted.
+        """
+        self.entries = LRUCache(max_size)
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def get_key(table_id, columns_split, columns_split_marker, checkpoint_id):
+        """
+        :param columns_split: (columns_split_len), the column ids of a single table without padding.
+        :param columns_split_marker: (columns_split_marker_len), the markers without padding.
+        """
+        digest = hashlib.sha1(columns_split.cpu().numpy().tobytes() + b'|' + columns_split_marker.cpu().numpy().tobytes()).hexdigest()
+        return table_id, digest, checkpoint_id
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries.put(key, entry)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits, self.misses = 0, 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total > 0 else 0.0}
+
+    def __len__(self):
+        return len(self.entries)
@@ -38,12 +38,12 @@ class TableRNNEncoder(nn.Module):
         tbl_split = tbl_split.transpose(0, 1).contiguous()
         if self.split_type == 'outcell':
             batch_index = torch.LongTensor(range(tbl_split.data.size(1))).unsqueeze_(
-                0).cuda().expand_as(tbl_split.data)
+                0).to(tbl_split.device).expand_as(tbl_split.data)
             enc_split = tbl_context[tbl_split.data, batch_index, :]
             enc_left, enc_right = enc_split[:-1], enc_split[1:]
         elif self.split_type == 'incell':
             batch_index = torch.LongTensor(range(tbl_split.data.size(1))).unsqueeze_(
-                0).cuda().expand(tbl_split.data.size(0) - 1, tbl_split.data.size(1))
+                0).to(tbl_split.device).expand(tbl_split.data.size(0) - 1, tbl_split.data.size(1))
             split_left = (tbl_split.data[:-1] +
                           1).clamp(0, tbl_context.size(0) - 1)
             enc_left = tbl_context[split_left, batch_index, :]
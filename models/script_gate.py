@@ -0,0 +1,162 @@
+# coding: utf-8
+
+import torch
+from torch import nn
+from typing import Tuple
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+
+class ScriptAttention(nn.Module):
+    """
+    the mlp GlobalAttention of Gate for inference, same weights, only tensors in forward so it can be scripted.
+    """
+    def __init__(self, attention):
+        super(ScriptAttention, self).__init__()
+        assert attention.attn_type == 'mlp' and attention.attn_hidden == 0 and attention.linear_out is not None
+        self.linear_context = attention.linear_context
+        self.linear_query = attention.linear_query
+        self.v = attention.v
+        self.linear_out = attention.linear_out
+
+    def forward(self, input, context, context_lengths):
+        """
+        :param input: (batch_size, tgt_len, dim)
+        :param context: (batch_size, src_len, dim)
+        :param context_lengths: (batch_size)
+        :return: attn_h (batch_size, tgt_len, dim), align_vectors (batch_size, tgt_len, src_len)
+        """
+        # (batch_size, tgt_len, 1, dim) + (batch_size, 1, src_len, dim)
+        wquh = torch.tanh(self.linear_query(input).unsqueeze(2) + self.linear_context(context).unsqueeze(1))
+        align = self.v(wquh).squeeze(-1)
+        mask = torch.arange(context.size(1), device=context.device).unsqueeze(0) < context_lengths.unsqueeze(1)
+        align = align.masked_fill(~mask.unsqueeze(1), float('-inf'))
+        align_vectors = torch.softmax(align, dim=-1)
+        c = torch.bmm(align_vectors, context)
+        attn_h = self.linear_out(torch.cat([c, input], -1))
+        return attn_h, align_vectors
+
+
+class ScriptBiRNN(nn.Module):
+    """
+    runBiRNN for inference, pack_padded_sequence sorts and restores the batch itself.
+    """
+    def __init__(self, rnn):
+        super(ScriptBiRNN, self).__init__()
+        assert not rnn.batch_first
+        self.rnn = rnn
+
+    def forward(self, embed, lengths, total_length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :param embed: (max_len, batch_size, word_dim)
+        :return: out (total_length, batch_size, 2 * hidden_size), h_n (num_layers * 2, batch_size, hidden_size)
+        """
+        packed = pack_padded_sequence(embed, lengths.cpu(), enforce_sorted=False)
+        out, (h_n, _) = self.rnn(packed)
+        out, _ = pad_packed_sequence(out, total_length=total_length)
+        return out, h_n
+
+
+class ScriptTableEncoder(nn.Module):
+    """
+    TableRNNEncoder with split_type 'incell' and merge_type 'cat' for inference.
+    """
+    def __init__(self, rnn, hidden_size):
+        super(ScriptTableEncoder, self).__init__()
+        self.rnn = ScriptBiRNN(rnn)
+        self.hidden_size = hidden_size
+
+    def forward(self, embed, lengths, split_marker, total_length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :param split_marker: (batch_size, split_marker_max_len)
+        :return: (split_marker_max_len - 1, batch_size, 2 * hidden_size), h_n
+        """
+        context, h_n = self.rnn(embed, lengths, total_length)
+        marker = split_marker.transpose(0, 1)
+        batch_index = torch.arange(marker.size(1), device=marker.device).unsqueeze(0).expand(marker.size(0) - 1, marker.size(1))
+        enc_left = context[(marker[:-1] + 1).clamp(0, context.size(0) - 1), batch_index]
+        enc_right = context[(marker[1:] - 1).clamp(0, context.size(0) - 1), batch_index]
+        return torch.cat([enc_right[:, :, :self.hidden_size], enc_left[:, :, self.hidden_size:]], 2), h_n
+
+
+class ScriptGate(nn.Module):
+    """
+    Gate for inference with the weights of a trained Gate and the same outputs, forward only takes tensors so it can be
+    scripted by torch.jit.script, saved and loaded by torch.jit.load without the model classes.
+    runBiRNN and TableRNNEncoder are replaced by ScriptBiRNN and ScriptTableEncoder.
+    """
+    def __init__(self, gate):
+        super(ScriptGate, self).__init__()
+        assert gate.table_encoder.split_type == 'incell' and gate.table_encoder.merge_type == 'cat'
+        self.hidden_size = gate.hidden_size
+        self.cell_info = bool(gate.args.cell_info)
+        self.attn_concat = bool(gate.args.attn_concat)
+        self.token_embedding = gate.token_embedding
+        self.pos_tag_embedding = gate.pos_tag_embedding
+        self.token_rnn = ScriptBiRNN(gate.token_lstm)
+        self.col_encoder = ScriptTableEncoder(gate.col_lstm, gate.hidden_size)
+        self.cell_encoder = ScriptTableEncoder(gate.cell_lstm, gate.hidden_size)
+        self.gate = gate.gate
+        self.col_pointer_network = ScriptAttention(gate.col_pointer_network)
+        self.cell_pointer_network = ScriptAttention(gate.cell_pointer_network)
+
+    def forward(self, tokenize, tokenize_len, pos_tag, columns_split, columns_split_len, columns_split_marker, columns_split_marker_len,
+                cells_split, cells_split_len, cells_split_marker, cells_split_marker_len) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        the tensors of the first 6 groups of inputs of Gate, see flatten_inputs.
+        :return: gate_output, col_align_score, pointer_align_scores, same as Gate.
+        """
+        batch_size, tokenize_max_len = tokenize.size(0), tokenize.size(1)
+        token_embed = (self.token_embedding(tokenize) + self.pos_tag_embedding(pos_tag)).transpose(0, 1)
+        # (tokenize_max_len, batch_size, 2 * hidden_size)
+        token_out, _ = self.token_rnn(token_embed, tokenize_len, tokenize_max_len)
+        # (columns_split_marker_max_len - 1, batch_size, 2 * hidden_size), _
+        col_out, col_h_n = self.col_encoder(self.token_embedding(columns_split).transpose(0, 1), columns_split_len, columns_split_marker, columns_split.size(1))
+        cell_out, cell_h_n = self.cell_encoder(self.token_embedding(cells_split).transpose(0, 1), cells_split_len, cells_split_marker, cells_split.size(1))
+        token_out = token_out.transpose(0, 1)
+        col_contex, col_align_score = self.col_pointer_network(token_out, col_out.transpose(0, 1), columns_split_marker_len - 1)
+        cell_contex, cell_align_score = self.cell_pointer_network(token_out, cell_out.transpose(0, 1), cells_split_marker_len - 1)
+        if not self.attn_concat:
+            # the last hidden of both directions, same as fix_hidden
+            col_contex = torch.cat([col_h_n[0::2], col_h_n[1::2]], 2).transpose(0, 1).expand(batch_size, tokenize_max_len, 2 * self.hidden_size)
+            cell_contex = torch.cat([cell_h_n[0::2], cell_h_n[1::2]], 2).transpose(0, 1).expand(batch_size, tokenize_max_len, 2 * self.hidden_size)
+        if self.cell_info:
+            gate_input = torch.cat([token_out, col_contex, cell_contex], -1)
+        else:
+            gate_input = torch.cat([token_out, col_contex], -1)
+        # (batch_size, tokenize_max_len, 3)
+        gate_output = self.gate(gate_input)
+        gate_out_col = gate_output[:, :, 1].unsqueeze(-1) * col_align_score
+        if self.cell_info:
+            gate_out_cell = gate_output[:, :, 2].unsqueeze(-1) * cell_align_score
+        else:
+            gate_out_cell = gate_output[:, :, 2].unsqueeze(-1)
+        pointer_align_scores = torch.cat([gate_output[:, :, 0].unsqueeze(-1), gate_out_col, gate_out_cell], dim=-1)
+        return gate_output, col_align_score, pointer_align_scores
+
+
+def flatten_inputs(inputs):
+    """
+    the inputs of Gate from BindingDataset to the arguments of ScriptGate.forward.
+    """
+    return tuple(inputs[0]) + (inputs[1][0], ) + tuple(inputs[2]) + tuple(inputs[3]) + tuple(inputs[4]) + tuple(inputs[5])
+
+
+class FlatBertGate(nn.Module):
+    """
+    BertGate with the tensors of its inputs as arguments, for torch.onnx.export, the weights are shared.
+    """
+    def __init__(self, bert_gate):
+        super(FlatBertGate, self).__init__()
+        self.bert_gate = bert_gate
+
+    def forward(self, tokenize, tokenize_len, tokenize_marker, tokenize_marker_len,
+                columns_split, columns_split_len, columns_split_marker, columns_split_marker_len):
+        return self.bert_gate([[tokenize, tokenize_len, tokenize_marker, tokenize_marker_len],
+                               [columns_split, columns_split_len, columns_split_marker, columns_split_marker_len]])
+
+
+def flatten_bert_inputs(inputs):
+    """
+    the inputs of BertGate from BindingDataset to the arguments of FlatBertGate.forward, the cells are not used by BertGate.
+    """
+    return tuple(inputs[0]) + tuple(inputs[1])
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import itertools
+import numpy as np
+
+
+class RaggedArray(object):
+    """
+    a list of lists saved as a flat array and offsets: m_lists[i] == values[offsets[i]:offsets[i + 1]].
+    replaces change2idx and pad, the padded array is built by numpy in one step.
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+        self.lengths = offsets[1:] - offsets[:-1]
+
+    @classmethod
+    def from_lists(cls, m_lists, inner_shape=(), dtype=np.int64):
+        """
+        :param m_lists: list of lists of ints, or of lists with inner_shape, e.g. [start, end] with inner_shape (2,).
+        """
+        offsets = np.zeros(len(m_lists) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, m_lists), dtype=np.int64, count=len(m_lists)), out=offsets[1:])
+        flat = itertools.chain.from_iterable(m_lists)
+        if len(inner_shape) == 0:
+            values = np.fromiter(flat, dtype=dtype, count=offsets[-1])
+        else:
+            values = np.array(list(flat), dtype=dtype).reshape((-1,) + tuple(inner_shape))
+        return cls(values, offsets)
+
+    @classmethod
+    def from_tokens(cls, m_lists, vocab, oov_token=0, name='from_tokens', verbose=True):
+        """
+        same as change2idx, the lookups run in C by map(vocab.get), oov is counted by numpy.
+        :param verbose: print the oov count.
+        """
+        offsets = np.zeros(len(m_lists) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, m_lists), dtype=np.int64, count=len(m_lists)), out=offsets[1:])
+        flat = itertools.chain.from_iterable(m_lists)
+        values = np.fromiter(map(vocab.get, flat, itertools.repeat(-1)), dtype=np.int64, count=offsets[-1])
+        oov = values == -1
+        values[oov] = oov_token
+        if verbose:
+            print('{}: oov_count - {}, total_count - {}'.format(name, int(oov.sum()), len(values)))
+        return cls(values, offsets)
+
+    def to_padded(self, max_len, pad_token=0):
+        """
+        :return: array (len(self), max_len, *inner_shape), lists longer than max_len are truncated.
+        """
+        num = len(self.lengths)
+        padded = np.full((num, max_len) + self.values.shape[1:], pad_token, dtype=self.values.dtype)
+        rows = np.repeat(np.arange(num), self.lengths)
+        cols = np.arange(len(self.values)) - np.repeat(self.offsets[:-1], self.lengths)
+        keep = cols < max_len
+        padded[rows[keep], cols[keep]] = self.values[keep]
+        return padded
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def clip_lengths(len_list, max_len):
+    return np.minimum(np.array(len_list, dtype=np.int64), max_len)
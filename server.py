@@ -0,0 +1,210 @@
+# coding: utf-8
+
+import re
+import json
+import time
+import asyncio
+import logging
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from config import Args
+from binder import Binder
+from store import JsonlStore
+from utils import get_annotate, get_wikisql_tables_path, set_seed, annotation_cache
+
+logger = logging.getLogger('binding')
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 422: 'Unprocessable Entity'}
+
+
+def simple_annotate(sentence, lower=True):
+    """
+    a local stand-in for get_annotate without CoreNLP: words and punctuations are tokens, every pos_tag is 'NN'.
+    :return: tokenize, original, pos_tag, after, same as get_annotate.
+    """
+    matches = list(re.finditer(r'\w+|[^\w\s]', sentence))
+    original = [m.group().lower() if lower else m.group() for m in matches]
+    after = [sentence[m.end():matches[index + 1].start()] if index + 1 < len(matches) else sentence[m.end():] for index, m in enumerate(matches)]
+    return list(original), original, ['NN'] * len(original), after
+
+
+class MicroBatcher(object):
+    """
+    coalesce concurrent requests into batches, a batch is run when it has max_batch_size requests or max_delay seconds
+    after its first request. run_batch runs in one worker thread, so the event loop keeps accepting requests meanwhile.
+    """
+    def __init__(self, run_batch, max_batch_size=32, max_delay=0.005, stats_size=10000):
+        """
+        :param run_batch: [request] -> [result], e.g. Binder.bind_batch.
+        :param stats_size: number of the latest requests and batches kept for stats.
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = collections.deque(maxlen=stats_size)
+        self.batch_sizes = collections.deque(maxlen=stats_size)
+        self.queue, self.task = None, None
+
+    def start(self):
+        # the queue belongs to the running loop
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        # write the annotations of the last requests, from the thread that annotated them
+        await asyncio.get_running_loop().run_in_executor(self.executor, annotation_cache.commit)
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future, time.perf_counter()))
+        return await future
+
+    async def get_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.get_batch()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [request for request, _, _ in batch])
+            except Exception as e:
+                logger.exception('batch of {} requests failed'.format(len(batch)))
+                results = [{'error': str(e)}] * len(batch)
+            end = time.perf_counter()
+            self.batch_sizes.append(len(batch))
+            for (_, future, start), result in zip(batch, results):
+                self.latencies.append(end - start)
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        """
+        :return: p50 and p99 latency in ms and the mean batch size of the latest requests.
+        """
+        latencies = np.array(self.latencies) * 1000
+        return {'requests': len(self.latencies), 'batches': len(self.batch_sizes),
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0.,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) > 0 else 0.,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.,
+                'max_batch_size': self.max_batch_size, 'max_delay_ms': self.max_delay * 1000}
+
+
+class BindingServer(object):
+    """
+    a local HTTP/1.1 server on asyncio, the requests are run by a Binder in micro batches.
+        POST /bind {"question": _, "table": {"id": _, "header": [...], "rows": [[...]]}} or {"question": _, "table_id": _}
+            -> {"tokens": [...], "bindings": ["<unk>", "Column_0", "Value_1", ...]}
+        GET /stats -> MicroBatcher.stats
+    """
+    def __init__(self, binder, tables=None, max_batch_size=32, max_delay=0.005):
+        """
+        :param tables: {table_id: table}, e.g. JsonlStore of the wikisql tables, for the requests with a table_id.
+        """
+        self.binder = binder
+        self.tables = tables
+        self.batcher = MicroBatcher(binder.bind_batch, max_batch_size=max_batch_size, max_delay=max_delay)
+        self.server = None
+
+    async def route(self, method, path, body):
+        """
+        :return: status, result
+        """
+        if method == 'GET' and path == '/stats':
+            return 200, self.batcher.stats()
+        if method != 'POST' or path != '/bind':
+            return 404, {'error': 'not found: {} {}'.format(method, path)}
+        try:
+            request = json.loads(body)
+            question = request['question']
+            # only the tables of the server are trusted, an inline table is keyed by its content, see utils.table_key
+            trusted = 'table' not in request
+            table = request['table'] if not trusted else self.tables[request['table_id']]
+            assert isinstance(question, str) and table['id'] is not None and len(table['header']) > 0 and isinstance(table['rows'], list)
+        except (ValueError, KeyError, TypeError, AssertionError) as e:
+            return 400, {'error': 'bad request: {}'.format(repr(e))}
+        res = await self.batcher.submit((question, table, trusted))
+        return (422 if 'error' in res else 200), res
+
+    async def handle(self, reader, writer):
+        # keep-alive connections, one request after another
+        try:
+            while True:
+                request_line = await reader.readline()
+                if len(request_line) == 0:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, value = line.decode('latin-1').split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, res = await self.route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                data = json.dumps(res).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, REASONS[status], len(data), 'keep-alive' if keep_alive else 'close').encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info('serving on {}'.format(', '.join(str(sock.getsockname()) for sock in self.server.sockets)))
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+
+def serve(checkpoint_path, args, host='127.0.0.1', port=8000, tables_mode='dev', annotate=get_annotate, max_batch_size=32, max_delay=0.005):
+    """
+    load a checkpoint and serve it until interrupted.
+    :param tables_mode: the wikisql tables for the requests with a table_id, None to only accept tables in the requests.
+    :param annotate: get_annotate, or simple_annotate to run without CoreNLP.
+    """
+    binder = Binder.from_checkpoint(checkpoint_path, args, annotate=annotate)
+    tables = JsonlStore(get_wikisql_tables_path(tables_mode), 'id') if tables_mode is not None else None
+    server = BindingServer(binder, tables=tables, max_batch_size=max_batch_size, max_delay=max_delay)
+
+    async def _serve():
+        await server.start(host, port)
+        async with server.server:
+            await server.server.serve_forever()
+    asyncio.run(_serve())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = Args()
+    set_seed(args.seed)
+    serve('./res/gate/epoch100', args)
+    # serve('./res/gate/epoch100', args, annotate=simple_annotate)
@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import os
+import json
+import mmap
+from cache import LRUCache
+
+
+class JsonlStore(object):
+    """
+    read the records of a jsonl file by key, instead of loading the whole file like read_json.
+    a byte offset index {key: [offset, length]} is built once and saved next to the file,
+    records are parsed from a mmap of the file on demand and the decoded ones are kept in a LRUCache.
+    """
+    def __init__(self, path, key, cache_size=1000):
+        self.path = path
+        self.key = key
+        self.index_path = path + '.' + key + '.idx'
+        self.records = LRUCache(cache_size)
+        self.offsets = self._load_index()
+        self.file, self.mmap, self.pid = None, None, None
+
+    def _load_index(self):
+        stat = os.stat(self.path)
+        # rebuild the index when the file changed
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+                return index['offsets']
+        print('building index {}'.format(self.index_path))
+        offsets, offset = {}, 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    offsets[json.loads(line)[self.key]] = [offset, len(line)]
+                offset += len(line)
+        with open(self.index_path, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'offsets': offsets}, f)
+        return offsets
+
+    def _get_mmap(self):
+        # open again in forked processes
+        if self.mmap is None or self.pid != os.getpid():
+            self.file = open(self.path, 'rb')
+            self.mmap, self.pid = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ), os.getpid()
+        return self.mmap
+
+    def __getitem__(self, key):
+        record = self.records.get(key)
+        if record is None:
+            offset, length = self.offsets[key]
+            record = json.loads(self._get_mmap()[offset:offset + length].decode('utf-8'))
+            self.records.put(key, record)
+        return record
+
+    def get(self, key, default=None):
+        if key not in self.offsets:
+            return default
+        return self[key]
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        # mmap can not be pickled, e.g. for the initargs of a spawned process pool
+        state = self.__dict__.copy()
+        state['file'], state['mmap'], state['pid'] = None, None, None
+        return state
@@ -0,0 +1,7 @@
+# coding: utf-8
+
+import os
+import sys
+
+# the modules of the repo are imported from its root, same as running main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,140 @@
+# coding: utf-8
+
+import random
+import torch
+from unittest import mock
+from pytorch_pretrained_bert import BertTokenizer
+from pytorch_pretrained_bert.modeling import BertModel, BertConfig
+from config import Args
+from binder import Binder
+from server import simple_annotate
+from models.bert_gate import BertGate
+from utils import UNK_WORD, BOS_WORD
+
+# the words of the tables and questions of make_table and make_question
+WORDS = ['w{}'.format(index) for index in range(40)]
+# max lengths of the train data, see load_data_from_train
+MAX_LENS = {'tokenize': 12, 'columns_token': 20, 'columns_split_marker': 6, 'cells_token': 40, 'cells_split_marker': 12,
+            'bert_tokenize': 24, 'bert_tokenize_marker': 12, 'bert_columns_split': 30, 'bert_columns_split_marker': 6,
+            'bert_cells_split': 60, 'bert_cells_split_marker': 12}
+
+
+def make_args(cell_info=False, attn_concat=True, bert_model=None, vocab_size=50, pos_tag_num=6):
+    """
+    args of a small randomly initialized model on cpu, no data files are needed.
+    """
+    args = Args()
+    args.device, args.cuda = torch.device('cpu'), False
+    args.model, args.bert_model, args.cell_info, args.attn_concat, args.crf = 'gate', bert_model, cell_info, attn_concat, False
+    args.vocab_size, args.pos_tag_vocab = vocab_size, dict((str(i), i) for i in range(pos_tag_num))
+    args.word_dim, args.hidden_size = 16, 8
+    return args
+
+
+def make_split(rng, num, vocab_size, sep_id=1):
+    """
+    ids of num columns (or cells) of 1 to 3 tokens joined by the separator, and the markers of the separators, same as get_split.
+    """
+    ids, marker = [sep_id], [0]
+    for _ in range(num):
+        ids += [rng.randrange(2, vocab_size) for _ in range(rng.randint(1, 3))]
+        ids.append(sep_id)
+        marker.append(len(ids) - 1)
+    return ids, marker
+
+
+def pad(m_lists):
+    """
+    :return: padded LongTensor, lengths
+    """
+    max_len = max(map(len, m_lists))
+    return torch.LongTensor([m_list + [0] * (max_len - len(m_list)) for m_list in m_lists]), torch.LongTensor(list(map(len, m_lists)))
+
+
+def make_gate_inputs(args, batch_size=6, seed=0, max_tokens=12):
+    """
+    random inputs of Gate with the layout of BindingDataset trimmed by trim_batch, the lengths are not sorted.
+    """
+    rng = random.Random(seed)
+    tokenize, pos_tag, columns, columns_marker, cells, cells_marker = [], [], [], [], [], []
+    for _ in range(batch_size):
+        length = rng.randint(1, max_tokens)
+        tokenize.append([rng.randrange(2, args.vocab_size) for _ in range(length)])
+        pos_tag.append([rng.randrange(len(args.pos_tag_vocab)) for _ in range(length)])
+        split, marker = make_split(rng, rng.randint(1, 5), args.vocab_size)
+        columns.append(split), columns_marker.append(marker)
+        split, marker = make_split(rng, rng.randint(1, 4), args.vocab_size)
+        cells.append(split), cells_marker.append(marker)
+    tokenize, tokenize_len = pad(tokenize)
+    columns_split, columns_split_len = pad(columns)
+    columns_split_marker, columns_split_marker_len = pad(columns_marker)
+    cells_split, cells_split_len = pad(cells)
+    cells_split_marker, cells_split_marker_len = pad(cells_marker)
+    return [[tokenize, tokenize_len], [pad(pos_tag)[0]], [columns_split, columns_split_len], [columns_split_marker, columns_split_marker_len],
+            [cells_split, cells_split_len], [cells_split_marker, cells_split_marker_len], [torch.arange(batch_size)]]
+
+
+def make_bert_inputs(args, batch_size=6, seed=0, max_tokens=8):
+    """
+    random inputs of BertGate with the layout of BindingDataset, every token has 1 or 2 sub_tokens, the lengths are not sorted.
+    """
+    rng = random.Random(seed)
+    tokenize, tokenize_marker, columns, columns_marker = [], [], [], []
+    for _ in range(batch_size):
+        ids, marker = [], []
+        for _ in range(rng.randint(1, max_tokens)):
+            ids += [rng.randrange(2, args.vocab_size) for _ in range(rng.randint(1, 2))]
+            marker.append(len(ids) - 1)
+        tokenize.append(ids), tokenize_marker.append(marker)
+        split, marker = make_split(rng, rng.randint(1, 5), args.vocab_size)
+        columns.append(split), columns_marker.append(marker)
+    return [list(pad(tokenize)) + list(pad(tokenize_marker)), list(pad(columns)) + list(pad(columns_marker))]
+
+
+def make_bert_gate(args):
+    """
+    a BertGate with a small random bert_model instead of the pretrained one.
+    """
+    config = BertConfig(vocab_size_or_config_json_file=args.vocab_size, hidden_size=16, num_hidden_layers=2, num_attention_heads=2, intermediate_size=32)
+    with mock.patch.object(BertModel, 'from_pretrained', lambda name: BertModel(config)):
+        return BertGate(args)
+
+
+def make_table(rng, table_id, columns_num=3, rows_num=4):
+    header = ['{} {}'.format(rng.choice(WORDS), rng.choice(WORDS)) for _ in range(columns_num)]
+    rows = [[rng.choice(WORDS) for _ in range(columns_num)] for _ in range(rows_num)]
+    return {'id': table_id, 'header': header, 'rows': rows}
+
+
+def make_question(rng, table, max_words=9):
+    """
+    random words and a cell of table, the pointer networks need at least one cell in the question.
+    """
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, max_words))]
+    words.insert(rng.randint(0, len(words)), rng.choice(sum(table['rows'], [])))
+    return ' '.join(words) + ' ?'
+
+
+def make_bert_vocab_file(path):
+    """
+    a wordpiece vocab of the first half of WORDS, the others are split into 'w' and their digits.
+    """
+    pieces = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '?', 'w'] + WORDS[:20] + ['##{}'.format(digit) for digit in range(10)]
+    path.write_text('\n'.join(pieces) + '\n', encoding='utf-8')
+    return str(path)
+
+
+def make_binder(model, bert_vocab_file=None, table_cache=None):
+    """
+    a Binder of model with simple_annotate, the vocab of WORDS and MAX_LENS as the train data.
+    :param bert_vocab_file: the vocab of the tokenizer of BertGate, see make_bert_vocab_file.
+    :param table_cache: a TableEncodingCache for Gate.
+    """
+    args = model.args
+    args.vocab = dict((word, index) for index, word in enumerate([UNK_WORD, BOS_WORD, '?'] + WORDS))
+    assert len(args.vocab) <= args.vocab_size
+    data_from_train = tuple(MAX_LENS[name] for name in ['tokenize', 'columns_token', 'columns_split_marker', 'cells_token', 'cells_split_marker']) + \
+        (args.pos_tag_vocab, ) + tuple(MAX_LENS[name] for name in ['bert_tokenize', 'bert_tokenize_marker', 'bert_columns_split', 'bert_columns_split_marker',
+                                                                    'bert_cells_split', 'bert_cells_split_marker'])
+    with mock.patch.object(BertTokenizer, 'from_pretrained', lambda name: BertTokenizer(bert_vocab_file)):
+        return Binder(model, args, data_from_train, annotate=simple_annotate, table_cache=table_cache, checkpoint_id='test')
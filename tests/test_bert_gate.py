@@ -0,0 +1,32 @@
+# coding: utf-8
+
+import torch
+import pytest
+from helpers import make_args, make_bert_gate, make_bert_inputs
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return make_bert_gate(make_args(bert_model='bert-base-uncased')).eval()
+
+
+def test_inputs_ignore_bert_features_flag(model):
+    # a model trained from BertFeatureDataset is saved with args.bert_features = True
+    inputs = make_bert_inputs(model.args)
+    with torch.no_grad():
+        expected = model(inputs)
+        model.args.bert_features = True
+        outputs = model(inputs)
+    for output, expect in zip(outputs, expected):
+        assert torch.equal(output, expect)
+
+
+def test_features(model):
+    inputs = make_bert_inputs(model.args)
+    with torch.no_grad():
+        expected = model(inputs)
+        bert_tokens_sum, bert_columns_split_sum = model.encode(inputs)
+        outputs = model(features=[bert_tokens_sum, inputs[0][1], bert_columns_split_sum, inputs[1][3]])
+    for output, expect in zip(outputs, expected):
+        assert torch.equal(output, expect)
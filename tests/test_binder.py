@@ -0,0 +1,40 @@
+# coding: utf-8
+
+import copy
+import random
+import torch
+from models.gate import Gate
+from models.modules.TableEncodingCache import TableEncodingCache
+from server import simple_annotate
+from helpers import make_args, make_binder, make_table, make_question
+from utils import build_info, table_key
+
+
+def test_inline_tables_with_the_same_id():
+    bob, alice = {'id': 't', 'header': ['name'], 'rows': [['bob']]}, {'id': 't', 'header': ['name'], 'rows': [['alice']]}
+    assert build_info('is bob here', bob, annotate=simple_annotate)['cells'] == ['bob']
+    info = build_info('is alice here', alice, annotate=simple_annotate)
+    assert info['cells'] == ['alice']
+    assert info['table_id'] == table_key(alice) != table_key(bob)
+
+
+def test_trusted_table_is_keyed_by_id():
+    table = {'id': '1-10015132-11', 'header': ['player'], 'rows': [['bob']]}
+    info = build_info('is bob here', table, annotate=simple_annotate, trusted=True)
+    assert info['table_id'] == '1-10015132-11' and info['cells'] == ['bob']
+
+
+def test_binder_table_cache():
+    args = make_args(cell_info=True)
+    torch.manual_seed(0)
+    model = Gate(args).eval()
+    # deepcopy does not copy the table_cache
+    binder, cached = make_binder(copy.deepcopy(model)), make_binder(model, table_cache=TableEncodingCache())
+    rng = random.Random(0)
+    tables = [make_table(rng, 't{}'.format(index)) for index in range(3)]
+    requests = [(make_question(rng, table), table) for table in tables for _ in range(4)]
+    assert [cached.bind(question, table) for question, table in requests] == [binder.bind(question, table) for question, table in requests]
+    assert cached.bind_batch(requests) == binder.bind_batch(requests)
+    # every table is encoded once, then looked up by every single question and once by the batch
+    stats = model.table_cache.stats()
+    assert stats['size'] == stats['misses'] == len(tables) and stats['hits'] == len(requests) - len(tables) + len(tables)
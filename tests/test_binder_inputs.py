@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import random
+import torch
+import pytest
+from models.gate import Gate
+from dataloader import BindingDataset, trim_batch
+from helpers import make_args, make_binder, make_bert_gate, make_bert_vocab_file, make_table, make_question, MAX_LENS
+
+
+def check_build_inputs(binder, seed=0):
+    rng = random.Random(seed)
+    table = make_table(rng, 't', columns_num=4, rows_num=6)
+    # short questions, and questions longer than tokenize_max_len and the bert max lengths, which are truncated
+    questions = [make_question(rng, table, max_words=max_words) for max_words in [1, 4, 9] for _ in range(5)]
+    questions += [make_question(rng, table, max_words=MAX_LENS['bert_tokenize'] + 5) for _ in range(5)]
+    assert max(len(question.split()) for question in questions) > MAX_LENS['bert_tokenize']
+    for question in questions:
+        info = binder.featurize([(question, table)])[0]
+        dataset = BindingDataset('bind', args=binder.args, data_from_train=binder.data_from_train, infos=[info])
+        expected = trim_batch(dataset[:1], dataset)[0]
+        inputs = binder.build_inputs(info)
+        assert len(inputs) == len(expected)
+        for group, expected_group in zip(inputs, expected):
+            assert len(group) == len(expected_group)
+            for tensor, expected_tensor in zip(group, expected_group):
+                assert tensor.dtype == expected_tensor.dtype and torch.equal(tensor, expected_tensor), question
+
+
+@pytest.mark.parametrize('crf', [False, True])
+@pytest.mark.parametrize('cell_info', [False, True])
+def test_gate(cell_info, crf):
+    args = make_args(cell_info=cell_info)
+    binder = make_binder(Gate(args).eval())
+    # only the inputs are built, the crf of the model is not needed
+    args.crf = crf
+    check_build_inputs(binder)
+
+
+@pytest.mark.parametrize('crf', [False, True])
+def test_bert_gate(tmp_path, crf):
+    args = make_args(bert_model='bert-base-uncased')
+    binder = make_binder(make_bert_gate(args).eval(), bert_vocab_file=make_bert_vocab_file(tmp_path / 'vocab.txt'))
+    args.crf = crf
+    check_build_inputs(binder)
@@ -0,0 +1,44 @@
+# coding: utf-8
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from cache import AnnotationCache
+
+
+def test_pending_puts_do_not_lock_other_writers(tmp_path):
+    path = str(tmp_path / 'annotation.db')
+    first, second = AnnotationCache(path, commit_interval=100), AnnotationCache(path, commit_interval=1)
+    first.put('corenlp', 'a', True, ['a'])
+    # the first cache has an uncommitted put, the second one still commits
+    second.put('corenlp', 'b', True, ['b'])
+    assert first.get('corenlp', 'a', True) == ['a'] and first.get('corenlp', 'b', True) == ['b']
+    first.commit()
+    assert AnnotationCache(path).get('corenlp', 'a', True) == ['a']
+
+
+def put_texts(args):
+    path, worker = args
+    cache = AnnotationCache(path, commit_interval=7)
+    for index in range(50):
+        cache.put('corenlp', '{}-{}'.format(worker, index), True, [worker, index])
+    cache.commit()
+
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / 'annotation.db')
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        pool.map(put_texts, [(path, worker) for worker in range(4)])
+    cache = AnnotationCache(path)
+    assert all(cache.get('corenlp', '{}-{}'.format(worker, index), True) == [worker, index] for worker in range(4) for index in range(50))
+
+
+def test_threads(tmp_path):
+    path = str(tmp_path / 'annotation.db')
+    cache = AnnotationCache(path, commit_interval=100)
+    # the main thread connects first, then the worker thread of a server puts and the main thread commits at exit
+    assert cache.get('corenlp', 'a', True) is None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(cache.put, 'corenlp', 'a', True, ['a']).result()
+        assert executor.submit(cache.get, 'corenlp', 'b', True).result() is None
+    cache.commit()
+    assert AnnotationCache(path).get('corenlp', 'a', True) == ['a']
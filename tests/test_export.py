@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import torch
+import pytest
+from unittest import mock
+from export import quantize
+from utils import load_model, is_quantized
+from models.modules.GlobalAttention import GlobalAttention
+from models.gate import Gate
+from helpers import make_args, make_gate_inputs
+
+
+@pytest.mark.parametrize('cell_info', [False, True])
+def test_quantized_gate_forward(cell_info):
+    args = make_args(cell_info=cell_info)
+    torch.manual_seed(0)
+    gate = Gate(args).eval()
+    quantized = quantize(gate)
+    inputs = make_gate_inputs(args)
+    with torch.no_grad():
+        expected = gate(inputs)
+        actual = quantized(inputs)
+        # the tiled mlp scores of the quantized pointer networks, quantize copied args with the model
+        quantized.args.attn_chunk_size = 64
+        with mock.patch.object(GlobalAttention, 'mlp_score', autospec=True, side_effect=GlobalAttention.mlp_score) as mlp_score:
+            tiled = quantized(inputs)
+    # more tiles than pointer networks
+    assert mlp_score.call_count > 2
+    for e, a, t in zip(expected, actual, tiled):
+        assert e.size() == a.size()
+        assert torch.equal(a, t)
+    tokenize_len = inputs[0][1]
+    for index in range(tokenize_len.size(0)):
+        length = int(tokenize_len[index])
+        assert torch.allclose(expected[2][index, :length], actual[2][index, :length], atol=5e-2)
+
+
+def test_load_quantized_on_cpu(tmp_path):
+    args = make_args()
+    torch.manual_seed(0)
+    gate = Gate(args).eval()
+    path = str(tmp_path / 'gate_int8')
+    torch.save(quantize(gate), path)
+    # the device of a gpu host, the quantized kernels only run on cpu
+    caller_args = make_args()
+    caller_args.device, caller_args.cuda = torch.device('cuda:0'), True
+    model = load_model(path, caller_args.device, args=caller_args)
+    assert is_quantized(model) and not is_quantized(gate)
+    assert model.args.device == caller_args.device == torch.device('cpu') and not model.args.cuda and not caller_args.cuda
+    inputs = make_gate_inputs(args)
+    with torch.no_grad():
+        assert torch.equal(model(inputs)[2], quantize(gate)(inputs)[2])
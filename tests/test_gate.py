@@ -0,0 +1,62 @@
+# coding: utf-8
+
+import io
+import copy
+import torch
+import pytest
+from export import quantize
+from models.gate import Gate
+from models.modules.TableEncodingCache import TableEncodingCache
+from helpers import make_args, make_gate_inputs
+
+
+@pytest.fixture
+def gate():
+    torch.manual_seed(0)
+    return Gate(make_args()).eval()
+
+
+def test_table_cache(gate):
+    inputs = make_gate_inputs(gate.args)
+    table_ids = ['t{}'.format(index) for index in range(inputs[0][0].size(0))]
+    table_cache = TableEncodingCache()
+    with torch.no_grad():
+        expected = gate(inputs)
+        gate.set_table_cache(table_cache, 'checkpoint')
+        missed = gate(inputs, table_ids=table_ids)
+        hit = gate(inputs, table_ids=table_ids)
+    for outputs in [missed, hit]:
+        for output, expect in zip(outputs, expected):
+            assert torch.allclose(output, expect, atol=1e-6)
+    assert table_cache.stats()['misses'] == table_cache.stats()['hits'] == len(table_ids)
+
+
+def test_table_cache_needs_checkpoint_id(gate):
+    with pytest.raises(AssertionError):
+        gate.set_table_cache(TableEncodingCache(), None)
+    gate.set_table_cache(None, None)
+
+
+def test_table_cache_is_not_saved(gate):
+    table_cache = TableEncodingCache()
+    gate.set_table_cache(table_cache, 'checkpoint')
+    buffer = io.BytesIO()
+    torch.save(gate, buffer)
+    buffer.seek(0)
+    for model in [torch.load(buffer, weights_only=False), copy.deepcopy(gate), quantize(gate)]:
+        assert model.table_cache is None and model.checkpoint_id is None
+    # the model in use keeps its table_cache
+    assert gate.table_cache is table_cache and gate.checkpoint_id == 'checkpoint'
+
+
+def test_table_cache_entries_are_copies(gate):
+    inputs = make_gate_inputs(gate.args)
+    gate.set_table_cache(TableEncodingCache(), 'checkpoint')
+    # eval mode with grad enabled
+    gate(inputs, table_ids=['t{}'.format(index) for index in range(inputs[0][0].size(0))])
+    for key in list(gate.table_cache.entries.items):
+        out, context_proj, hidden = gate.table_cache.entries.items[key]
+        for tensor in (out, context_proj) + hidden:
+            assert not tensor.requires_grad and tensor.grad_fn is None
+            # not a view of the encoded batch
+            assert tensor._base is None and tensor.untyped_storage().nbytes() == tensor.numel() * tensor.element_size()
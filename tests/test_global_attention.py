@@ -0,0 +1,38 @@
+# coding: utf-8
+
+import torch
+import pytest
+from models.modules.GlobalAttention import GlobalAttention
+from helpers import make_args
+
+BATCH_SIZE, TGT_LEN, SRC_LEN, DIM = 3, 5, 7, 8
+
+
+def run(attention, input, context, context_lengths, chunk_size):
+    attention.args.attn_chunk_size = chunk_size
+    input, context = input.clone().requires_grad_(), context.clone().requires_grad_()
+    attention.zero_grad()
+    attn_h, align_vectors = attention(input, context, context_lengths=context_lengths, context_max_len=SRC_LEN)
+    (attn_h.pow(2).sum() + align_vectors.pow(2).sum()).backward()
+    grads = [input.grad, context.grad] + [parameter.grad for parameter in attention.parameters()]
+    return attn_h.detach(), align_vectors.detach(), grads
+
+
+# 1 element, part of a target row (3 of 7 sources), one target row, two target rows, untiled
+@pytest.mark.parametrize('chunk_size', [1, BATCH_SIZE * 3 * DIM, BATCH_SIZE * SRC_LEN * DIM, 2 * BATCH_SIZE * SRC_LEN * DIM, None])
+def test_tiled_mlp_score(chunk_size):
+    torch.manual_seed(0)
+    attention = GlobalAttention(make_args(), DIM, attn_type='mlp')
+    input, context = torch.randn(BATCH_SIZE, TGT_LEN, DIM), torch.randn(BATCH_SIZE, SRC_LEN, DIM)
+    context_lengths = torch.LongTensor([7, 2, 5])
+    with torch.no_grad():
+        attention.args.attn_chunk_size = None
+        expected_score = attention.score(input, context)
+        attention.args.attn_chunk_size = chunk_size
+        assert torch.equal(attention.score(input, context), expected_score)
+    expected = run(attention, input, context, context_lengths, None)
+    # the tiles go through checkpoint when grad is enabled
+    attn_h, align_vectors, grads = run(attention, input, context, context_lengths, chunk_size)
+    assert torch.equal(attn_h, expected[0]) and torch.equal(align_vectors, expected[1])
+    for grad, expect in zip(grads, expected[2]):
+        assert torch.allclose(grad, expect, atol=1e-5)
@@ -0,0 +1,42 @@
+# coding: utf-8
+
+import numpy as np
+import torch
+import pytest
+from export import export_onnx_model
+from models.gate import Gate
+from binding_runtime import BindingRuntime
+from helpers import make_args, make_gate_inputs, make_bert_gate, make_bert_inputs
+
+# (batch_size, max_tokens) of the batches after the one traced by the export
+BATCHES = [(1, 3), (4, 12), (9, 20), (2, 1)]
+
+
+def check_runtime(model, runtime, make_inputs):
+    for seed, (batch_size, max_tokens) in enumerate(BATCHES, 1):
+        inputs = make_inputs(model.args, batch_size=batch_size, seed=seed, max_tokens=max_tokens)
+        with torch.no_grad():
+            expected = model(inputs)
+        outputs = runtime.run(inputs)
+        for output, expect in zip(outputs, expected):
+            assert output.shape == tuple(expect.size())
+            assert np.allclose(output, expect.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize('cell_info', [False, True])
+def test_gate(tmp_path, cell_info):
+    args = make_args(cell_info=cell_info)
+    torch.manual_seed(0)
+    model = Gate(args).eval()
+    path = export_onnx_model(model, make_gate_inputs(args), str(tmp_path / 'gate.onnx'))
+    check_runtime(model, BindingRuntime(path), make_gate_inputs)
+
+
+def test_bert_gate(tmp_path):
+    args = make_args(bert_model='bert-base-uncased')
+    torch.manual_seed(0)
+    model = make_bert_gate(args).eval()
+    path = export_onnx_model(model, make_bert_inputs(args), str(tmp_path / 'bert_gate.onnx'))
+    # a model trained from BertFeatureDataset, FlatBertGate still passes the raw inputs
+    model.args.bert_features = True
+    check_runtime(model, BindingRuntime(path), make_bert_inputs)
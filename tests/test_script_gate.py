@@ -0,0 +1,26 @@
+# coding: utf-8
+
+import torch
+import pytest
+from models.gate import Gate
+from models.script_gate import ScriptGate, flatten_inputs
+from helpers import make_args, make_gate_inputs
+
+
+@pytest.mark.parametrize('attn_concat', [True, False])
+@pytest.mark.parametrize('cell_info', [False, True])
+def test_scripted_gate_matches_gate(cell_info, attn_concat):
+    args = make_args(cell_info=cell_info, attn_concat=attn_concat)
+    torch.manual_seed(0)
+    gate = Gate(args).eval()
+    scripted = torch.jit.script(ScriptGate(gate))
+    for seed in range(3):
+        inputs = make_gate_inputs(args, batch_size=7, seed=seed)
+        # the lengths are not sorted, pack_padded_sequence of ScriptBiRNN sorts them itself
+        assert not torch.equal(inputs[0][1], inputs[0][1].sort(descending=True)[0])
+        with torch.no_grad():
+            expected = gate(inputs)
+            outputs = scripted(*flatten_inputs(inputs))
+        for output, expect in zip(outputs, expected):
+            assert output.size() == expect.size()
+            assert torch.allclose(output, expect, atol=1e-5)
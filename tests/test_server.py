@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import json
+import random
+import asyncio
+import torch
+import pytest
+from models.gate import Gate
+from server import BindingServer
+from helpers import make_args, make_binder, make_table, make_question
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = b'' if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+    writer.write('{} {} HTTP/1.1\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(method, path, len(data)).encode('latin-1') + data)
+    await writer.drain()
+    head, _, res = (await reader.read()).partition(b'\r\n\r\n')
+    writer.close()
+    return int(head.split()[1]), json.loads(res)
+
+
+def check_bindings(res, question, table):
+    assert res['tokens'] == question.split()
+    assert len(res['bindings']) == len(res['tokens'])
+    for binding in res['bindings']:
+        kind, _, index = binding.partition('_')
+        # all the values share one score without cell_info
+        assert binding in ('<unk>', 'Value') or (kind == 'Column' and int(index) < len(table['header'])) or \
+            (kind == 'Value' and int(index) < len(table['rows']) * len(table['header']))
+
+
+@pytest.mark.parametrize('cell_info', [False, True])
+def test_server(cell_info):
+    args = make_args(cell_info=cell_info)
+    torch.manual_seed(0)
+    binder = make_binder(Gate(args).eval())
+    rng = random.Random(0)
+    tables = dict(('t{}'.format(index), make_table(rng, 't{}'.format(index))) for index in range(4))
+    requests = []
+    for index in range(40):
+        table = tables[rng.choice(sorted(tables))]
+        question = make_question(rng, table)
+        # inline tables and tables of the server
+        requests.append(({'question': question, 'table': table} if index % 2 else {'question': question, 'table_id': table['id']}, question, table))
+
+    async def run():
+        server = BindingServer(binder, tables=tables, max_batch_size=8, max_delay=0.05)
+        await server.start('127.0.0.1', 0)
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            results = await asyncio.gather(*[request(port, 'POST', '/bind', body) for body, _, _ in requests])
+            bad = [await request(port, 'POST', '/bind', body) for body in [b'{', {'table_id': 't0'}, {'question': 'w1 ?', 'table_id': 'missing'}]]
+            # no cell of the table in the question
+            unbound = await request(port, 'POST', '/bind', {'question': 'nothing here', 'table_id': 't0'})
+            not_found = await request(port, 'GET', '/missing')
+            stats = await request(port, 'GET', '/stats')
+        finally:
+            await server.stop()
+        return results, bad, unbound, not_found, stats
+
+    results, bad, unbound, not_found, stats = asyncio.run(run())
+    for (status, res), (_, question, table) in zip(results, requests):
+        assert status == 200
+        check_bindings(res, question, table)
+    assert any(binding.startswith('Column_') for _, res in results for binding in res['bindings'])
+    # the same bindings as a single request to the binder
+    assert [res for _, res in results[:5]] == [binder.bind(question, table) for _, question, table in requests[:5]]
+    assert all(status == 400 and 'error' in res for status, res in bad)
+    assert unbound[0] == 422 and 'error' in unbound[1]
+    assert not_found[0] == 404
+    status, stats = stats
+    assert status == 200 and stats['requests'] == len(requests) + 1
+    assert stats['mean_batch_size'] > 1 and 0 < stats['p50_ms'] <= stats['p99_ms']
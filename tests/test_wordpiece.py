@@ -0,0 +1,33 @@
+# coding: utf-8
+
+import random
+import pytest
+from pytorch_pretrained_bert import BertTokenizer
+from wordpiece import FastWordPieceTokenizer
+
+PIECES = ['a', 'b', 'ab', 'abc', 'ba', 'c', 'ca', 'cab', '##a', '##b', '##c', '##ab', '##bc', '##ca', '##abc', 'e', '##e', 'ce', '.', ',', '?', '(', ')']
+# accents are stripped by the basic tokenizer, 'é' is 'e', 'd' is not in the vocab, '!' and '-' are split but unknown
+CHARS = 'abcABCdé.,?()!- '
+
+
+@pytest.fixture(scope='module')
+def tokenizers(tmp_path_factory):
+    vocab_file = tmp_path_factory.mktemp('vocab') / 'vocab.txt'
+    vocab_file.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + PIECES) + '\n', encoding='utf-8')
+    bert_tokenizer = BertTokenizer(str(vocab_file))
+    return bert_tokenizer, FastWordPieceTokenizer.from_bert_tokenizer(bert_tokenizer, cache_size=50)
+
+
+def test_same_as_bert_tokenizer(tokenizers):
+    bert_tokenizer, tokenizer = tokenizers
+    rng = random.Random(0)
+    texts = [''.join(rng.choice(CHARS) for _ in range(rng.randint(0, 30))) for _ in range(2000)]
+    # over-long words are unknown
+    texts += ['ab' * 50, 'ab' * 50 + 'a', 'x ' + 'c' * 101 + ' ab']
+    # repeated texts and words go through the memo
+    texts += rng.sample(texts, 200)
+    for text in texts:
+        tokens, ids = tokenizer.tokenize_with_ids(text)
+        expected = bert_tokenizer.tokenize(text)
+        assert tokens == expected, text
+        assert ids == bert_tokenizer.convert_tokens_to_ids(expected), text
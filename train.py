@@ -13,8 +13,9 @@ from torch import nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from models.policy_grad import Policy
+from dataloader import BertFeatureDataset
 from tensorboardX import SummaryWriter
-from utils import count_of_diff, translate_m_lists, sequence_mask
+from utils import count_of_diff, translate_m_lists, sequence_mask, unwrap_model
 from sklearn.utils.multiclass import unique_labels
 from sklearn.metrics import f1_score, classification_report, confusion_matrix, accuracy_score
 
@@ -22,6 +23,32 @@ np.set_printoptions(threshold=np.inf)
 logger = logging.getLogger('binding')
 
 
+def to_device(inputs, device):
+    # the batches are pinned by the dataloader on gpu, so the copies do not block
+    return [[inp.to(device, non_blocking=True) for inp in input] for input in inputs]
+
+
+def autocast(args):
+    """
+    run the forward in args.amp_dtype when args.amp, the losses and the crf are computed in float32.
+    """
+    return torch.autocast(device_type=args.device.type, dtype=args.amp_dtype, enabled=args.amp)
+
+
+def get_grad_scaler(args):
+    # bfloat16 has the range of float32, only float16 needs loss scaling
+    return torch.amp.GradScaler(args.device.type, enabled=args.amp and args.amp_dtype == torch.float16)
+
+
+def feed_forward(model, inputs, data_loader):
+    """
+    the batches of BertFeatureDataset are the pooled features of BertGate, not its inputs.
+    """
+    if isinstance(data_loader.dataset, BertFeatureDataset):
+        return model(features=inputs[0])
+    return model(inputs)
+
+
 def train(train_loader, dev_loader, args, model):
     s_time = time.time()
     print('start train... {}'.format(time.strftime('%H:%M:%S',time.localtime(time.time()))))
@@ -34,42 +61,44 @@ def train(train_loader, dev_loader, args, model):
     # todo: init_parameters and adjust learning rate
     # model.apply(init_parameters)
     if args.load_w2v:
-        small_lr_layers = set(map(id, model.module.token_embedding.parameters()))
+        small_lr_layers = set(map(id, unwrap_model(model).token_embedding.parameters()))
         normal_lr_layers = list(filter(lambda p: id(p) not in small_lr_layers, model.parameters()))
-        optimizer = torch.optim.Adam([{'params': model.module.token_embedding.parameters(), 'lr': args.small_lr}, {'params': normal_lr_layers}], lr=args.lr, weight_decay=args.weight_decay)
+        optimizer = torch.optim.Adam([{'params': unwrap_model(model).token_embedding.parameters(), 'lr': args.small_lr}, {'params': normal_lr_layers}], lr=args.lr, weight_decay=args.weight_decay)
     else:
         if args.bert_model is None:
             optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
         else:
-            small_lr_layers = set(map(id, model.module.bert_model.parameters()))
+            small_lr_layers = set(map(id, unwrap_model(model).bert_model.parameters()))
             normal_lr_layers = list(filter(lambda p: id(p) not in small_lr_layers, model.parameters()))
-            optimizer = torch.optim.Adam([{'params': model.module.bert_model.parameters(), 'lr': args.small_lr}, {'params': normal_lr_layers}], lr=args.lr, weight_decay=args.weight_decay)
+            optimizer = torch.optim.Adam([{'params': unwrap_model(model).bert_model.parameters(), 'lr': args.small_lr}, {'params': normal_lr_layers}], lr=args.lr, weight_decay=args.weight_decay)
     model.train()
+    scaler = get_grad_scaler(args)
     best_correct = 0
     criterion = torch.nn.CrossEntropyLoss(ignore_index=-100)
     for epoch in range(1, args.epochs + 1):
         for data in train_loader:
             inputs, (labels, _), _ = data
-            for input in inputs:
-                for index, inp in enumerate(input):
-                    input[index] = inp.to(args.device)
+            inputs = to_device(inputs, args.device)
             # print(inputs[0][1])
-            labels = labels.to(args.device)
+            labels = labels.to(args.device, non_blocking=True)
             # zero_grad
             model.zero_grad()
             optimizer.zero_grad()
-            if args.crf:
-                loss = model(inputs, labels)
-            else:
-                # feed forward
-                _, _, logit = model(inputs)
-                # loss = criterion(logit.permute(0, 2, 1).contiguous(), label)
-                loss = 0
-                for ti in range(logit.size()[1]):
-                    loss += criterion(logit[:, ti], labels[:, ti])
+            with autocast(args):
+                if args.crf:
+                    loss = model(inputs, labels)
+                else:
+                    # feed forward
+                    _, _, logit = feed_forward(model, inputs, train_loader)
+                    logit = logit.float()
+                    # loss = criterion(logit.permute(0, 2, 1).contiguous(), label)
+                    loss = 0
+                    for ti in range(logit.size()[1]):
+                        loss += criterion(logit[:, ti], labels[:, ti])
             print('loss'), print(loss)
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             # sys.exit()
         if epoch % args.log_trian_interval == 0:
             _, _ = eval(train_loader, args, model, epoch=epoch, s_time=s_time)
@@ -92,16 +121,16 @@ def eval(data_loader, args, model, epoch=None, s_time=time.time()):
     correct, total = 0, 0
     for data in data_loader:
         inputs, (labels, _), _ = data
-        for input in inputs:
-            for index, inp in enumerate(input):
-                input[index] = inp.to(args.device)
-        labels = labels.to(args.device)
+        inputs = to_device(inputs, args.device)
+        labels = labels.to(args.device, non_blocking=True)
         # feed forward
-        _, _, logit = model(inputs)
+        with autocast(args):
+            _, _, logit = feed_forward(model, inputs, data_loader)
+        logit = logit.float()
         if args.crf:
             tokenize_len = inputs[0][1].to(args.device)
-            mask = sequence_mask(tokenize_len, max_len=args.tokenize_max_len)
-            pred = model.module.crf.viterbi_tags(logit, mask)
+            mask = sequence_mask(tokenize_len, max_len=logit.size(1))
+            pred = unwrap_model(model).crf.viterbi_tags(logit, mask)
             pred = [p[0] for p in pred]
         else:
             logit = torch.max(logit, 2)[1]
@@ -130,12 +159,12 @@ def eval(data_loader, args, model, epoch=None, s_time=time.time()):
 
 def train_rl(train_loader, dev_loader, args, model):
     print('start train_rl... {}'.format(time.strftime('%H:%M:%S', time.localtime(time.time()))))
-    if args.cuda:
-        model.cuda()
+    model.to(args.device)
     # model.apply(init_parameters)
     # large_lr_layers = list(map(id, model.fc.parameters()))
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     model.train()
+    scaler = get_grad_scaler(args)
     policy = Policy(args=args)
     # test for baseline model
     best_correct_ratio = eval_rl(dev_loader, args, model, epoch=0)
@@ -143,21 +172,25 @@ def train_rl(train_loader, dev_loader, args, model):
         for data in train_loader:
             # unpack data
             inputs, (label, _), sql_labels = data
+            # the lengths stay on cpu for Policy
+            tokenize_len = inputs[0][1]
+            inputs = to_device(inputs, args.device)
             # zero_grad
             model.zero_grad()
             optimizer.zero_grad()
             # feed forward
-            _, _, logit = model(inputs)
-            tokenize_len = inputs[0][1]
-            m_log_probs, m_rewards = policy.select_m_actions(logit, tokenize_len, sql_labels)
+            with autocast(args):
+                _, _, logit = model(inputs)
+            m_log_probs, m_rewards = policy.select_m_actions(logit.float(), tokenize_len, sql_labels)
             loss = torch.sum(-m_log_probs.mul(m_rewards))
             # loss /= logit.size(0)
             # logger.info('reward_mean')
             # logger.info(m_rewards.mean())
             # logger.info('loss_mean')
             # logger.info(loss / logit.size(0))
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
         if epoch % args.log_trian_interval == 0:
             _ = eval_rl(train_loader, args, model, epoch)
         if epoch % args.log_test_interval == 0:
@@ -176,10 +209,13 @@ def eval_rl(data_loader, args, model, epoch):
     t_error_1, t_error_2, t_error_3, t_error_4 = 0, 0, 0, 0
     for data in data_loader:
         inputs, (label, _), sql_labels = data
-        # feed forward
-        _, _, logit = model(inputs)
+        # the lengths stay on cpu for Policy
         tokenize_len = inputs[0][1]
-        actions, reward, b_error_1, b_error_2, b_error_3, b_error_4 = policy.select_max_action(logit, tokenize_len, sql_labels)
+        inputs = to_device(inputs, args.device)
+        # feed forward
+        with autocast(args):
+            _, _, logit = model(inputs)
+        actions, reward, b_error_1, b_error_2, b_error_3, b_error_4 = policy.select_max_action(logit.float(), tokenize_len, sql_labels)
         rewards_epoch += reward.sum()
         total_batch += reward.size(0)
         t_error_1 += b_error_1
@@ -200,10 +236,13 @@ def test(data_loader, args, model, sep=''):
     policy = Policy(args=args)
     for data in data_loader:
         inputs, (label, _), sql_labels = data
-        # feed forward
-        _, _, logit = model(inputs)
+        # the lengths stay on cpu for Policy
         tokenize_len = inputs[0][1]
-        actions, _, _, _, _, _ = policy.select_max_action(logit, tokenize_len, sql_labels)
+        inputs = to_device(inputs, args.device)
+        # feed forward
+        with autocast(args):
+            _, _, logit = model(inputs)
+        actions, _, _, _, _, _ = policy.select_max_action(logit.float(), tokenize_len, sql_labels)
         questions = translate_m_lists(inputs[0][0].data.cpu().numpy(), the_dict=args.index2word, sep=sep)
         batch_sel_col, batch_conds_cols, batch_conds_values = sql_labels
         batch_sel_col, batch_conds_cols, batch_conds_values = batch_sel_col.data.cpu().numpy().tolist(), batch_conds_cols.data.cpu().numpy().tolist(), batch_conds_values.data.cpu().numpy().tolist()
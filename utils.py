@@ -1,28 +1,70 @@
 # coding: utf-8
 
+import os
 import json
 import copy
+import hashlib
 import torch
 import random
 import functools
+import multiprocessing
 import numpy as np
 from torch import nn
 from functools import reduce
 from gensim.models import KeyedVectors
 from stanza.nlp.corenlp import CoreNLPClient
 from pytorch_pretrained_bert import BertTokenizer, BertModel
-from config import Args, data_path, wikisql_path, preprocess_path, word_embedding_path, anonymous_path, bert_path
+from cache import LRUCache, AnnotationCache
+from store import JsonlStore
+from wordpiece import FastWordPieceTokenizer
+from config import Args, data_path, wikisql_path, preprocess_path, word_embedding_path, anonymous_path, bert_path, annotation_cache_path, vocab_path
 
 client = None
+# annotate results of preprocess, see get_annotate
+annotation_cache = AnnotationCache(annotation_cache_path)
+# table_id -> cell index, see build_cell_index
+cell_index_cache = LRUCache(max_size=1000)
 UNK_WORD = '<unk>'
 SPLIT_WORD = '[SEP]'
 PAD_WORD = '<blank>'
 BOS_WORD = '<s>'
 EOS_WORD = '</s>'
+CELL_END = ''
+# change it when the way of building vocab changes
+VOCAB_VERSION = 1
 special_token_list = [UNK_WORD, PAD_WORD, BOS_WORD, EOS_WORD, SPLIT_WORD]
 special_token_vocab = dict(list(zip(special_token_list, list(range(len(special_token_list))))))
 
 
+def file_digest(path, block_size=1 << 20):
+    """
+    sha1 of the content of a file.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def dict_digest(obj):
+    """
+    sha1 of a json serializable object, keys of dicts are sorted.
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def module_digest(module):
+    """
+    sha1 of the parameters and buffers of a module.
+    """
+    sha1 = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha1.update(name.encode('utf-8'))
+        sha1.update(tensor.detach().float().cpu().numpy().tobytes())
+    return sha1.hexdigest()
+
+
 def read_json(path, key):
     all_infos = {}
     with open(path) as f:
@@ -54,6 +96,14 @@ def get_bert_path(mode):
 
 def get_annotate(sentence, lower=True):
     # notice return 4 infos
+    res = annotation_cache.get('corenlp', sentence, lower)
+    if res is None:
+        res = _get_annotate(sentence, lower=lower)
+        annotation_cache.put('corenlp', sentence, lower, res)
+    return tuple(res)
+
+
+def _get_annotate(sentence, lower=True):
     # todo: handle [Salmonella spp.] -> ['salmonella', 'spp.', '.']
     global client
     if client is None:
@@ -78,14 +128,83 @@ def get_ngram(s_list):
     return ngram
 
 
-def get_split(iter, lower, tokenizer=None):
+def find_ngram(s_list, key):
+    """
+    same as get_ngram(s_list)[key] without building all the ngrams: the longest, then the last, ngram equal to key.
+    :return: [start_index, end_index + 1], raise KeyError if not found.
+    """
+    res = None
+    for i in range(len(s_list)):
+        joined = ''
+        for j in range(i, len(s_list)):
+            joined += s_list[j].lower()
+            if not key.startswith(joined):
+                break
+            if len(joined) == len(key) and (res is None or j + 1 - i >= res[1] - res[0]):
+                res = [i, j + 1]
+    if res is None:
+        raise KeyError(key)
+    return res
+
+
+def build_cell_index(table):
+    """
+    build a char trie of the normalized (lower, without spaces) cells, only need once for every table.
+    the end node of a cell keeps (first position in rows, cell.lower()) in CELL_END.
+    """
+    cell_index, seen = {}, set()
+    for s_list in table['rows']:
+        for word in s_list:
+            cell = str(word)
+            key = cell.lower().replace(' ', '')
+            if cell in seen or len(key) == 0:
+                continue
+            seen.add(cell)
+            node = cell_index
+            for c in key:
+                node = node.setdefault(c, {})
+            node.setdefault(CELL_END, []).append((len(seen), cell.lower()))
+    return cell_index
+
+
+def match_cells(s_list, cell_index):
+    """
+    get the cells equal to any ngram of s_list, walk the trie from every start token.
+    cost is proportional to len(s_list) * the length of the longest cell, not to the size of the table.
+    :return: matched cells, in the order of rows.
+    """
+    matched = []
+    for i in range(len(s_list)):
+        node = cell_index
+        for token in s_list[i:]:
+            for c in token.lower():
+                node = node.get(c)
+                if node is None:
+                    break
+            if node is None:
+                break
+            if CELL_END in node:
+                matched.extend(node[CELL_END])
+    return [cell for _, cell in sorted(set(matched))]
+
+
+def get_cell_index(table_id, table_info):
+    cell_index = cell_index_cache.get(table_id)
+    if cell_index is None:
+        cell_index = build_cell_index(table_info[table_id])
+        cell_index_cache.put(table_id, cell_index)
+    return cell_index
+
+
+def get_split(iter, lower, tokenizer=None, annotate=get_annotate):
     """
     get split and split_marker.
+    :param annotate: get_annotate, or a function with the same outputs.
     """
     if len(iter) == 0: return [], 0, [], 0
     if tokenizer is None:
         # if lower is False: [['Player'], ['No', '.'], ['Nationality'], ['Position'], ['Years', 'in', 'Toronto'], ['School', '/', 'Club', 'Team']]
-        columns = list(map(lambda column: get_annotate(column, lower)[0], iter))
+        columns = list(map(lambda column: annotate(column, lower)[0], iter))
     else:
         columns = list(map(lambda column: tokenizer.tokenize(column), iter))
     # ['<|>', 'Player', '<|>', 'No', '.', '<|>', 'Nationality', '<|>', 'Position', '<|>', 'Years', 'in', 'Toronto', '<|>', 'School', '/', 'Club', 'Team', '<|>']
@@ -97,119 +216,231 @@ def get_split(iter, lower, tokenizer=None):
     return columns_split, columns_split_len, columns_split_marker, columns_split_marker_len
 
 
-def preprocess(mode, lower=True):
+def preprocess_info(info, label_info, table_info, lower=True, annotate=get_annotate):
+    """
+    preprocess a single line of wikisql.
+    :param annotate: get_annotate, or a function with the same outputs.
+    :return: the preprocessed info, or None if the line should be skipped.
+    """
+    UNK_TERM = {'CoreTerm', 'UnknownTerm', 'AdjectiveTerm', 'VisualTerm'}
+    info['tokenize'], info['original'], info['pos_tag'], info['after'] = annotate(info['question'], lower=lower)
+    assert len(info['tokenize']) == len(info['original']) == len(info['pos_tag']) == len(info['after'])
+    # get cells, filter cells by the ngrams of question
+    # the first way: need handle "cells": ["1", "8", "8abx15", "5"]
+    # cells = [cell.lower() for cell in cells if cell.lower() in info['question'].lower()]
+    # the second way
+    # todo: (1980.0 in question, 1980 in cell; 14 in question, +14/14. in cell)
+    # must to lower() for match value in cells and question
+    info['cells'] = match_cells(info['original'], get_cell_index(info['table_id'], table_info))
+    # change conds_values to index_list
+    # todo: handle Exception
+    try:
+        info['sql_index'] = copy.deepcopy(info['sql'])
+        for cond in info['sql_index']['conds']:
+            cond[2] = find_ngram(info['original'], str(cond[2]).lower().replace(' ', ''))
+    except Exception as e:
+        print(e)
+        return None
+    # try get label
+    info['label'] = []
+    if info['question'] in label_info:
+        the_label_info = label_info[info['question']]['Idx2label']
+        the_label_info = sorted(the_label_info.items(), key=lambda x: int(x[0]))
+        # ["CoreTerm_who_SpellCorrectedString, ExactMatch, _BE", ...]
+        the_label_info = [list(x[1][0].keys())[0] for x in the_label_info]
+        # need check word tokenize
+        if len(info['tokenize']) == len(the_label_info):
+            try:
+                for index, label in enumerate(the_label_info):
+                    if info['tokenize'][index] == '?':
+                        info['label'].append(UNK_WORD)
+                        continue
+                    label_split = label.split('_')
+                    if label_split[0] in UNK_TERM:
+                        info['label'].append(UNK_WORD)
+                    elif label_split[0] == 'ValueTerm':
+                        value = '_'.join(label_split[1:-2]).lower()
+                        info['label'].append('Value_' + str(info['cells'].index(value)))
+                    # todo: NumberRangeTerm need to handle some special situations, use SQL?
+                    elif label_split[0] == 'NumberRangeTerm':
+                        try:
+                            value = '_'.join(label_split[1:-2]).lower()
+                            info['label'].append('Value_' + str(info['cells'].index(value)))
+                        except Exception as e:
+                            value = '_'.join(label_split[1:-2]).lower()
+                            if 'than' in value:
+                                value = value.split(' than ')[1]
+                                if value.endswith('.0'):
+                                    value = value[:-2]
+                                info['label'].append('Value_' + str(info['cells'].index(value)))
+                            else:
+                                raise Exception("Value Not Handle", value)
+                    elif label_split[0] == 'ColumnTerm':
+                        column = '_'.join(label_split[1:-2])
+                        info['label'].append('Column_' + str(table_info[info['table_id']]['header'].index(column)))
+                    else:
+                        raise Exception("Label Not Handle", label)
+                assert len(info['label']) == len(info['tokenize'])
+            except Exception as e:
+                print(e)
+                print(info['question'])
+                info['label'] = []
+    # get columns/cells split and split_marker
+    info['columns_split'], info['columns_split_len'], info['columns_split_marker'], info['columns_split_marker_len'] = get_split(table_info[info['table_id']]['header'], lower=lower, annotate=annotate)
+    info['cells_split'], info['cells_split_len'], info['cells_split_marker'], info['cells_split_marker_len'] = get_split(info['cells'], lower=lower, annotate=annotate)
+    return info
+
+
+def table_key(table, trusted=False):
+    """
+    the key of a table in cell_index_cache and TableEncodingCache: its id when trusted,
+    else the digest of its header and rows, so two different tables with the same id never share the cached entries.
+    """
+    if trusted:
+        return table['id']
+    return 'table:' + dict_digest([table['header'], table['rows']])
+
+
+def build_info(question, table, lower=True, tokenizer=None, annotate=get_annotate, trusted=False):
+    """
+    the record of preprocess_info (and add_bert_info) for a new question, without sql and label, built in memory.
+    :param table: a table of wikisql, {'id': _, 'header': [...], 'rows': [[...], ...]}.
+    :param tokenizer: FastWordPieceTokenizer for BertGate, None to leave the bert features empty.
+    :param annotate: get_annotate, or a function with the same outputs, e.g. a stand-in without CoreNLP.
+    :param trusted: the table comes from the wikisql tables and its id is the key of the caches,
+                    other tables (e.g. sent by a client) are keyed by the digest of header and rows, see table_key.
+    """
+    table_id = table_key(table, trusted=trusted)
+    info = {'question': question, 'table_id': table_id, 'sql': {'sel': 0, 'conds': []}, 'sql_index': {'sel': 0, 'conds': []}, 'label': []}
+    info['tokenize'], info['original'], info['pos_tag'], info['after'] = annotate(question, lower=lower)
+    info['cells'] = match_cells(info['original'], get_cell_index(table_id, {table_id: table}))
+    info['columns_split'], info['columns_split_len'], info['columns_split_marker'], info['columns_split_marker_len'] = get_split(table['header'], lower=lower, annotate=annotate)
+    info['cells_split'], info['cells_split_len'], info['cells_split_marker'], info['cells_split_marker_len'] = get_split(info['cells'], lower=lower, annotate=annotate)
+    if tokenizer is not None:
+        add_bert_info(info, table['header'], tokenizer, lower=lower)
+    else:
+        for name in ['bert_tokenize', 'bert_tokenize_marker', 'bert_columns_split', 'bert_columns_split_marker', 'bert_cells_split', 'bert_cells_split_marker',
+                     'bert_indexed_tokenize', 'bert_indexed_columns', 'bert_indexed_cells']:
+            info[name] = []
+    return info
+
+
+def _init_preprocess_worker(label_info, table_info):
+    # every worker needs its own CoreNLP client, do not share the one from the parent process
+    global client, _worker_label_info, _worker_table_info
+    client = None
+    _worker_label_info, _worker_table_info = label_info, table_info
+
+
+def _preprocess_chunk(chunk):
+    lines, lower = chunk
+    res = []
+    for line in lines:
+        info = preprocess_info(json.loads(line.strip()), _worker_label_info, _worker_table_info, lower=lower)
+        if info is not None:
+            res.append(json.dumps(info))
+    # pool workers exit without atexit, commit the annotation cache for every chunk
+    annotation_cache.commit()
+    return res
+
+
+def read_chunks(f, chunk_size):
+    """
+    split lines of f to chunks, every chunk is a list of chunk_size lines.
+    """
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def preprocess(mode, lower=True, num_workers=None, chunk_size=500):
     """
     only need at beginning. stanza may crash on Windows, can work on Linux.
     :param mode: 'train', 'dev' or 'test'.
+    :param num_workers: if > 1, preprocess chunks of lines in a process pool, one CoreNLP client per worker.
+    :param chunk_size: number of lines in a chunk for the process pool.
     """
     print('preprocessing {}'.format(mode))
     # load label info and table info
     label_path = './data/' + 'sql_label_' + mode + '_final_label1.json'
-    label_info = read_json(label_path, 'Utterance')
-    table_info = read_json(get_wikisql_tables_path(mode), 'id')
+    label_info = JsonlStore(label_path, 'Utterance')
+    table_info = JsonlStore(get_wikisql_tables_path(mode), 'id')
     # preprocess data
     data_path, out_path = get_wikisql_path(mode), get_preprocess_path(mode)
     with open(data_path) as f, open(out_path, 'w') as out_f:
-        UNK_TERM = {'CoreTerm', 'UnknownTerm', 'AdjectiveTerm', 'VisualTerm'}
-        for line in f:
-            info = json.loads(line.strip())
-            info['tokenize'], info['original'], info['pos_tag'], info['after'] = get_annotate(info['question'], lower=lower)
-            assert len(info['tokenize']) == len(info['original']) == len(info['pos_tag']) == len(info['after'])
-            # get cells
-            cells = set()
-            for s_list in table_info[info['table_id']]['rows']:
-                for word in s_list:
-                    cells.add(str(word))
-            # filter cells
-            # the first way: need handle "cells": ["1", "8", "8abx15", "5"]
-            # cells = [cell.lower() for cell in cells if cell.lower() in info['question'].lower()]
-            # the second way
-            # todo: (1980.0 in question, 1980 in cell; 14 in question, +14/14. in cell)
-            tokenize_ngram = get_ngram(info['original'])
-            # must to lower() for match value in cells and question
-            info['cells'] = [cell.lower() for cell in cells if cell.lower().replace(' ', '') in tokenize_ngram]
-            # change conds_values to index_list
-            # todo: handle Exception
-            try:
-                info['sql_index'] = copy.deepcopy(info['sql'])
-                for cond in info['sql_index']['conds']:
-                    cond[2] = tokenize_ngram[str(cond[2]).lower().replace(' ', '')]
-            except Exception as e:
-                print(e)
-                continue
-            # try get label
-            info['label'] = []
-            if info['question'] in label_info:
-                the_label_info = label_info[info['question']]['Idx2label']
-                the_label_info = sorted(the_label_info.items(), key=lambda x: int(x[0]))
-                # ["CoreTerm_who_SpellCorrectedString, ExactMatch, _BE", ...]
-                the_label_info = [list(x[1][0].keys())[0] for x in the_label_info]
-                # need check word tokenize
-                if len(info['tokenize']) == len(the_label_info):
-                    try:
-                        for index, label in enumerate(the_label_info):
-                            if info['tokenize'][index] == '?':
-                                info['label'].append(UNK_WORD)
-                                continue
-                            label_split = label.split('_')
-                            if label_split[0] in UNK_TERM:
-                                info['label'].append(UNK_WORD)
-                            elif label_split[0] == 'ValueTerm':
-                                value = '_'.join(label_split[1:-2]).lower()
-                                info['label'].append('Value_' + str(info['cells'].index(value)))
-                            # todo: NumberRangeTerm need to handle some special situations, use SQL?
-                            elif label_split[0] == 'NumberRangeTerm':
-                                try:
-                                    value = '_'.join(label_split[1:-2]).lower()
-                                    info['label'].append('Value_' + str(info['cells'].index(value)))
-                                except Exception as e:
-                                    value = '_'.join(label_split[1:-2]).lower()
-                                    if 'than' in value:
-                                        value = value.split(' than ')[1]
-                                        if value.endswith('.0'):
-                                            value = value[:-2]
-                                        info['label'].append('Value_' + str(info['cells'].index(value)))
-                                    else:
-                                        raise Exception("Value Not Handle", value)
-                            elif label_split[0] == 'ColumnTerm':
-                                column = '_'.join(label_split[1:-2])
-                                info['label'].append('Column_' + str(table_info[info['table_id']]['header'].index(column)))
-                            else:
-                                raise Exception("Label Not Handle", label)
-                        assert len(info['label']) == len(info['tokenize'])
-                    except Exception as e:
-                        print(e)
-                        print(info['question'])
-                        info['label'] = []
-            # get columns/cells split and split_marker
-            info['columns_split'], info['columns_split_len'], info['columns_split_marker'], info['columns_split_marker_len'] = get_split(table_info[info['table_id']]['header'], lower=lower)
-            info['cells_split'], info['cells_split_len'], info['cells_split_marker'], info['cells_split_marker_len'] = get_split(info['cells'], lower=lower)
-            out_f.write(json.dumps(info) + '\n')
+        if num_workers is None or num_workers <= 1:
+            for line in f:
+                info = preprocess_info(json.loads(line.strip()), label_info, table_info, lower=lower)
+                if info is not None:
+                    out_f.write(json.dumps(info) + '\n')
+        else:
+            with multiprocessing.Pool(num_workers, initializer=_init_preprocess_worker, initargs=(label_info, table_info)) as pool:
+                # imap returns the chunks in the original order
+                chunks = ((chunk, lower) for chunk in read_chunks(f, chunk_size))
+                for lines in pool.imap(_preprocess_chunk, chunks):
+                    for line in lines:
+                        out_f.write(line + '\n')
+    annotation_cache.commit()
 
 
 def add_bert_preprocess(mode, bert_model, lower=True):
-    table_info = read_json(get_wikisql_tables_path(mode), 'id')
+    table_info = JsonlStore(get_wikisql_tables_path(mode), 'id')
     preprocess_path, out_path = get_preprocess_path(mode), get_bert_path(mode)
-    tokenizer = BertTokenizer.from_pretrained(bert_model)
-    wordpiece_tokenizer = tokenizer.wordpiece_tokenizer
+    tokenizer = FastWordPieceTokenizer.from_bert_tokenizer(BertTokenizer.from_pretrained(bert_model))
     with open(preprocess_path) as f, open(out_path, 'w') as out_f:
         for line in f:
             info = json.loads(line.strip())
-            sen_bert_tokenize, sen_tokenize_marker, marker = [], [], -1
-            for token in info['original']:
-                token_bert_tokenize = tokenizer.tokenize(token)
-                sen_bert_tokenize.extend(token_bert_tokenize)
-                sen_tokenize_marker.append(marker + len(token_bert_tokenize))
-                marker = marker + len(token_bert_tokenize)
-            info['bert_tokenize'], info['bert_tokenize_marker'] = sen_bert_tokenize, sen_tokenize_marker
-            info['bert_columns_split'], _, info['bert_columns_split_marker'], _ = get_split(table_info[info['table_id']]['header'], lower=lower, tokenizer=tokenizer)
-            info['bert_cells_split'], _, info['bert_cells_split_marker'], _ = get_split(info['cells'], lower=lower, tokenizer=tokenizer)
-            info['bert_indexed_tokenize'], info['bert_indexed_columns'], info['bert_indexed_cells'] = tokenizer.convert_tokens_to_ids(info['bert_tokenize']), tokenizer.convert_tokens_to_ids(info['bert_columns_split']), tokenizer.convert_tokens_to_ids(info['bert_cells_split'])
+            add_bert_info(info, table_info[info['table_id']]['header'], tokenizer, lower=lower)
             out_f.write(json.dumps(info) + '\n')
 
 
+def add_bert_info(info, header, tokenizer, lower=True):
+    """
+    add the wordpieces and ids of the question, columns and cells of a preprocessed info.
+    :param tokenizer: FastWordPieceTokenizer.
+    """
+    sen_bert_tokenize, sen_bert_indexed, sen_tokenize_marker, marker = [], [], [], -1
+    for token in info['original']:
+        token_bert_tokenize, token_bert_indexed = tokenizer.tokenize_with_ids(token)
+        sen_bert_tokenize.extend(token_bert_tokenize)
+        sen_bert_indexed.extend(token_bert_indexed)
+        sen_tokenize_marker.append(marker + len(token_bert_tokenize))
+        marker = marker + len(token_bert_tokenize)
+    info['bert_tokenize'], info['bert_tokenize_marker'] = sen_bert_tokenize, sen_tokenize_marker
+    info['bert_columns_split'], _, info['bert_columns_split_marker'], _ = get_split(header, lower=lower, tokenizer=tokenizer)
+    info['bert_cells_split'], _, info['bert_cells_split_marker'], _ = get_split(info['cells'], lower=lower, tokenizer=tokenizer)
+    info['bert_indexed_tokenize'], info['bert_indexed_columns'], info['bert_indexed_cells'] = sen_bert_indexed, tokenizer.convert_tokens_to_ids(info['bert_columns_split']), tokenizer.convert_tokens_to_ids(info['bert_cells_split'])
+    return info
+
+
+def iter_data(path, only_label=False):
+    """
+    read the preprocessed data line by line, skip the same lines as load_data.
+    """
+    with open(path) as f:
+        for line in f:
+            info = json.loads(line.strip())
+            if only_label and len(info['label']) == 0:
+                continue
+            if info['cells_split_len'] == 0:
+                continue
+            yield info
+
+
 def load_data(path, vocab=False, only_label=False):
     print('loading {}'.format(path))
+    return collect_data(iter_data(path, only_label=only_label), vocab=vocab)
+
+
+def collect_data(infos, vocab=False):
+    """
+    collect the features of the records from iter_data into lists, see load_data.
+    """
     tokenize_list, tokenize_len_list = [], []
     pos_tag_list = []
     table_id_list = []
@@ -223,43 +454,35 @@ def load_data(path, vocab=False, only_label=False):
     bert_columns_split_list, bert_columns_split_len_list, bert_columns_split_marker_list, bert_columns_split_marker_len_list = [], [], [], []
     bert_cells_split_list, bert_cells_split_len_list, bert_cells_split_marker_list, bert_cells_split_marker_len_list = [], [], [], []
     bert_indexed_tokenize_list, bert_indexed_columns_list, bert_indexed_cells_list = [], [], []
-    with open(path) as f:
-        for line in f:
-            info = json.loads(line.strip())
-            # get label
-            label = info['label']
-            # if only_label, pass when the label is []. need check only_label at first.
-            if only_label:
-                if len(label) == 0:
-                    continue
-            # get tokenize
-            tokenize = info['tokenize']
-            # get conds
-            conds_cols, conds_values = [], []
-            for cond in info['sql_index']['conds']:
-                conds_cols.append(cond[0])
-                conds_values.append(cond[2])
-            # todo: handle this situation, cause runBiRNN crash
-            if info['cells_split_len'] == 0:
-                continue
-            # append
-            tokenize_list.append(tokenize), tokenize_len_list.append(len(tokenize))
-            pos_tag_list.append(info['pos_tag'])
-            table_id_list.append(info['table_id'])
-            columns_split_list.append(info['columns_split']), columns_split_len_list.append(info['columns_split_len'])
-            columns_split_marker_list.append(info['columns_split_marker']), columns_split_marker_len_list.append(info['columns_split_marker_len'])
-            cells_split_list.append(info['cells_split']), cells_split_len_list.append(info['cells_split_len'])
-            cells_split_marker_list.append(info['cells_split_marker']), cells_split_marker_len_list.append(info['cells_split_marker_len'])
-            label_list.append(label)
-            sql_sel_col_list.append(info['sql']['sel']), sql_conds_cols_list.append(conds_cols), sql_conds_values_list.append(conds_values)
-            # bert
-            bert_tokenize_list.append(info['bert_tokenize']), bert_tokenize_len_list.append(len(info['bert_tokenize'])),\
-            bert_tokenize_marker_list.append(info['bert_tokenize_marker']), bert_tokenize_marker_len_list.append(len(info['bert_tokenize_marker']))
-            bert_columns_split_list.append(info['bert_columns_split']), bert_columns_split_len_list.append(len(info['bert_columns_split'])),\
-            bert_columns_split_marker_list.append(info['bert_columns_split_marker']), bert_columns_split_marker_len_list.append(len(info['bert_columns_split_marker']))
-            bert_cells_split_list.append(info['bert_cells_split']), bert_cells_split_len_list.append(len(info['bert_cells_split'])),\
-            bert_cells_split_marker_list.append(info['bert_cells_split_marker']), bert_cells_split_marker_len_list.append(len(info['bert_cells_split_marker']))
-            bert_indexed_tokenize_list.append(info['bert_indexed_tokenize']), bert_indexed_columns_list.append(info['bert_indexed_columns']), bert_indexed_cells_list.append(info['bert_indexed_cells'])
+    # the lines with an empty label (if only_label) or no cells are skipped by iter_data
+    for info in infos:
+        # get label
+        label = info['label']
+        # get tokenize
+        tokenize = info['tokenize']
+        # get conds
+        conds_cols, conds_values = [], []
+        for cond in info['sql_index']['conds']:
+            conds_cols.append(cond[0])
+            conds_values.append(cond[2])
+        # append
+        tokenize_list.append(tokenize), tokenize_len_list.append(len(tokenize))
+        pos_tag_list.append(info['pos_tag'])
+        table_id_list.append(info['table_id'])
+        columns_split_list.append(info['columns_split']), columns_split_len_list.append(info['columns_split_len'])
+        columns_split_marker_list.append(info['columns_split_marker']), columns_split_marker_len_list.append(info['columns_split_marker_len'])
+        cells_split_list.append(info['cells_split']), cells_split_len_list.append(info['cells_split_len'])
+        cells_split_marker_list.append(info['cells_split_marker']), cells_split_marker_len_list.append(info['cells_split_marker_len'])
+        label_list.append(label)
+        sql_sel_col_list.append(info['sql']['sel']), sql_conds_cols_list.append(conds_cols), sql_conds_values_list.append(conds_values)
+        # bert
+        bert_tokenize_list.append(info['bert_tokenize']), bert_tokenize_len_list.append(len(info['bert_tokenize'])),\
+        bert_tokenize_marker_list.append(info['bert_tokenize_marker']), bert_tokenize_marker_len_list.append(len(info['bert_tokenize_marker']))
+        bert_columns_split_list.append(info['bert_columns_split']), bert_columns_split_len_list.append(len(info['bert_columns_split'])),\
+        bert_columns_split_marker_list.append(info['bert_columns_split_marker']), bert_columns_split_marker_len_list.append(len(info['bert_columns_split_marker']))
+        bert_cells_split_list.append(info['bert_cells_split']), bert_cells_split_len_list.append(len(info['bert_cells_split'])),\
+        bert_cells_split_marker_list.append(info['bert_cells_split_marker']), bert_cells_split_marker_len_list.append(len(info['bert_cells_split_marker']))
+        bert_indexed_tokenize_list.append(info['bert_indexed_tokenize']), bert_indexed_columns_list.append(info['bert_indexed_columns']), bert_indexed_cells_list.append(info['bert_indexed_cells'])
     if vocab:
         return tokenize_list, columns_split_list
     else:
@@ -326,10 +549,23 @@ def build_vocab(m_lists, pre_func=None, init_vocab=None, sort=True, min_word_fre
     # get word count
     word_count = {}
     for s_list in m_lists:
-        for word in s_list:
-            if pre_func is not None:
-                word = pre_func(word)
-            word_count[word] = word_count.get(word, 0) + 1
+        count_words(s_list, word_count, pre_func=pre_func)
+    return build_vocab_from_count(word_count, init_vocab=init_vocab, sort=sort, min_word_freq=min_word_freq)
+
+
+def count_words(s_list, word_count, pre_func=None):
+    for word in s_list:
+        if pre_func is not None:
+            word = pre_func(word)
+        word_count[word] = word_count.get(word, 0) + 1
+    return word_count
+
+
+def build_vocab_from_count(word_count, init_vocab=None, sort=True, min_word_freq=1):
+    """
+    :param word_count: dict of word -> count, words with the same count keep the order of word_count.
+    :return: word2index and index2word.
+    """
     # filter rare words
     new_word_count_keys = [key for key in word_count if word_count[key] >= min_word_freq]
     # sort
@@ -353,17 +589,55 @@ def build_vocab(m_lists, pre_func=None, init_vocab=None, sort=True, min_word_fre
 
 def build_all_vocab(init_vocab=None, min_word_freq=1):
     # need to know all the words to filter the pretrained word embeddings
-    load_vocab = functools.partial(load_data, vocab=True, only_label=False)
+    # count every file in one pass, the order of words is the same as counting all tokenize and then all columns_split
     mode_list = ['train', 'dev', 'test']
-    vocab = []
+    word_count = {}
     for mode in mode_list:
-        tokenize_list, columns_split_list = load_vocab(get_bert_path(mode))
-        vocab.extend(tokenize_list)
-        vocab.extend(columns_split_list)
-    word2index, index2word = build_vocab(vocab, init_vocab=init_vocab, min_word_freq=min_word_freq)
+        tokenize_count, columns_split_count = {}, {}
+        for info in iter_data(get_bert_path(mode), only_label=False):
+            count_words(info['tokenize'], tokenize_count), count_words(info['columns_split'], columns_split_count)
+        for count in [tokenize_count, columns_split_count]:
+            for word, c in count.items():
+                word_count[word] = word_count.get(word, 0) + c
+    word2index, index2word = build_vocab_from_count(word_count, init_vocab=init_vocab, min_word_freq=min_word_freq)
     return word2index, index2word
 
 
+def build_pos_tag_vocab(mode='train', only_label=True):
+    # same as the pos_tag_vocab built by BindingDataset of train
+    pos_tag_count = {}
+    for info in iter_data(get_bert_path(mode), only_label=only_label):
+        count_words(info['pos_tag'], pos_tag_count)
+    pos_tag_vocab, _ = build_vocab_from_count(pos_tag_count, init_vocab={UNK_WORD: 0})
+    return pos_tag_vocab
+
+
+def load_all_vocab(init_vocab=None, min_word_freq=1, path=vocab_path):
+    """
+    load word2index, index2word and pos_tag_vocab from the vocab file.
+    build and save the vocab file when it is missing, or the version, the data or the params changed.
+    """
+    key = {'version': VOCAB_VERSION, 'init_vocab': init_vocab, 'min_word_freq': min_word_freq,
+           'sources': dict((mode, file_digest(get_bert_path(mode))) for mode in ['train', 'dev', 'test'])}
+    if os.path.exists(path):
+        with open(path) as f:
+            vocab = json.load(f)
+        if vocab['key'] == key:
+            word2index = vocab['word2index']
+            index2word = dict((index, word) for word, index in word2index.items())
+            return word2index, index2word, vocab['pos_tag_vocab']
+    print('building vocab {}'.format(path))
+    word2index, index2word = build_all_vocab(init_vocab=None if init_vocab is None else dict(init_vocab), min_word_freq=min_word_freq)
+    pos_tag_vocab = build_pos_tag_vocab()
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'key': key, 'word2index': word2index, 'pos_tag_vocab': pos_tag_vocab}, f)
+    os.replace(path + '.tmp', path)
+    return word2index, index2word, pos_tag_vocab
+
+
 def change2idx(m_lists, vocab, oov_token=0, name='change2idx'):
     idxs_list = []
     oov_count, total = 0, 0
@@ -384,8 +658,8 @@ def pad(m_lists, max_len, pad_token=0):
     idxs_list = []
     for s_list in m_lists:
         if len(s_list) < max_len:
-            pad = [pad_token for _ in range(max_len - len(s_list))]
-            s_list.extend(pad)
+            # do not extend s_list in place, it belongs to the caller
+            s_list = s_list + [pad_token for _ in range(max_len - len(s_list))]
         else:
             s_list = s_list[:max_len]
         idxs_list.append(s_list)
@@ -442,6 +716,39 @@ def set_seed(seed):
     np.random.seed(seed)
 
 
+def unwrap_model(model):
+    """
+    :return: the model inside nn.DataParallel, train wraps the model when there are more gpus.
+    """
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+def is_quantized(model):
+    """
+    :return: whether model has modules of quantize_dynamic, e.g. saved by export.export, their kernels only run on cpu.
+    """
+    return any(type(module).__module__.startswith('torch.ao.nn.quantized') for module in model.modules())
+
+
+def load_model(path, device, args=None):
+    """
+    load a model saved by torch.save(model, path), e.g. in train or export.
+    a quantized model is loaded on cpu whatever the device.
+    :param args: the args of the caller, their device is also set to cpu for a quantized model, so the inputs are moved to cpu.
+    :return: the model without nn.DataParallel, on device, its args moved to device.
+    """
+    model = unwrap_model(torch.load(path, map_location='cpu', weights_only=False))
+    if device.type != 'cpu' and is_quantized(model):
+        print('{} is quantized, load it on cpu instead of {}'.format(path, device))
+        device = torch.device('cpu')
+    model.to(device)
+    # the pickled args keep the device of training
+    for model_args in [getattr(model, 'args', None), args]:
+        if model_args is not None:
+            model_args.device, model_args.cuda = device, device.type == 'cuda'
+    return model
+
+
 def aeq(*args):
     """
     Assert all arguments have the same value
@@ -511,6 +818,32 @@ def sequence_mask(lengths, max_len=None, device=None):
     return torch.arange(0, max_len).to(lengths.device).type_as(lengths).repeat(batch_size, 1).lt(lengths.unsqueeze(1))
 
 
+def masked_attention(query, key, value, lengths=None, need_weights=True):
+    """
+    softmax(query key^T) value without scaling and with the keys after lengths masked, for the dot / general attention.
+    with the weights (the pointer networks need them) the mask is added inside baddbmm, without them the whole attention
+    runs fused in scaled_dot_product_attention when torch has it.
+    :param query: (batch_size, tgt_len, dim)
+    :param key: (batch_size, src_len, dim)
+    :param value: (batch_size, src_len, value_dim)
+    :param lengths: (batch_size) number of the valid keys, None if all are valid.
+    :return: context (batch_size, tgt_len, value_dim), align_vectors (batch_size, tgt_len, src_len) or None if not need_weights.
+    """
+    mask = None
+    if lengths is not None:
+        # (batch_size, 1, src_len)
+        mask = (torch.arange(key.size(1), device=key.device).unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1)
+    if not need_weights and hasattr(nn.functional, 'scaled_dot_product_attention'):
+        return nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=mask, scale=1.), None
+    if mask is None:
+        align = torch.bmm(query, key.transpose(1, 2))
+    else:
+        bias = torch.zeros(mask.size(), dtype=query.dtype, device=query.device).masked_fill(~mask, -float('inf'))
+        align = torch.baddbmm(bias, query, key.transpose(1, 2))
+    align_vectors = torch.softmax(align, dim=-1)
+    return torch.bmm(align_vectors, value), align_vectors
+
+
 def fix_hidden(h):
     """
     The encoder hidden is  (layers*directions) x batch x dim.
@@ -553,7 +886,7 @@ def add_abstraction(mode, res, args):
     typesql_path = data_path + 'typesql/' + mode + '_tok.jsonl'
     typesql_table_path = data_path + 'typesql/' + mode + '_tok.tables.jsonl'
     new_typesql_path = data_path + mode + '_tok.jsonl'
-    table_infos = read_json(typesql_table_path, key='id')
+    table_infos = JsonlStore(typesql_table_path, key='id')
     with open(typesql_path) as f:
         with open(new_typesql_path, 'w') as out_f:
             for line in f:
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+from cache import LRUCache
+
+
+class FastWordPieceTokenizer(object):
+    """
+    same output as BertTokenizer.tokenize, but the greedy longest-match-first wordpiece search walks a char trie
+    of the vocab once per piece instead of trying every substring, and the ids are found in the same walk.
+    results are memoized per surface form, the wikisql questions, columns and cells repeat a lot.
+    """
+    def __init__(self, vocab, basic_tokenizer=None, unk_token='[UNK]', max_input_chars_per_word=100, cache_size=100000):
+        """
+        :param vocab: {wordpiece: id}, e.g. BertTokenizer.vocab loaded from the vocab file.
+        :param basic_tokenizer: BasicTokenizer run before wordpiece, None to only split on whitespace.
+        """
+        self.vocab = vocab
+        self.basic_tokenizer = basic_tokenizer
+        self.unk_token, self.unk_id = unk_token, vocab[unk_token]
+        self.max_input_chars_per_word = max_input_chars_per_word
+        # node: [children, (wordpiece, id) or None], '##' pieces are saved in their own trie without the prefix
+        self.start_trie, self.subword_trie = [{}, None], [{}, None]
+        for piece, index in vocab.items():
+            if piece.startswith('##'):
+                self._insert(self.subword_trie, piece[2:], (piece, index))
+            else:
+                self._insert(self.start_trie, piece, (piece, index))
+        self.words = LRUCache(cache_size)
+        self.texts = LRUCache(cache_size)
+
+    @classmethod
+    def from_bert_tokenizer(cls, tokenizer, cache_size=100000):
+        basic_tokenizer = tokenizer.basic_tokenizer if tokenizer.do_basic_tokenize else None
+        return cls(tokenizer.vocab, basic_tokenizer=basic_tokenizer, unk_token=tokenizer.wordpiece_tokenizer.unk_token,
+                   max_input_chars_per_word=tokenizer.wordpiece_tokenizer.max_input_chars_per_word, cache_size=cache_size)
+
+    @staticmethod
+    def _insert(trie, chars, value):
+        node = trie
+        for char in chars:
+            node = node[0].setdefault(char, [{}, None])
+        node[1] = value
+
+    def _tokenize_word(self, word):
+        """
+        :return: (wordpieces, ids) of a single word.
+        """
+        result = self.words.get(word)
+        if result is not None:
+            return result
+        if len(word) > self.max_input_chars_per_word:
+            result = ([self.unk_token], [self.unk_id])
+            self.words.put(word, result)
+            return result
+        tokens, ids, start, trie = [], [], 0, self.start_trie
+        while start < len(word):
+            # the last matched node on the walk is the longest piece
+            node, match, end = trie, None, start
+            for index in range(start, len(word)):
+                node = node[0].get(word[index])
+                if node is None:
+                    break
+                if node[1] is not None:
+                    match, end = node[1], index + 1
+            if match is None:
+                tokens, ids = [self.unk_token], [self.unk_id]
+                break
+            tokens.append(match[0])
+            ids.append(match[1])
+            start, trie = end, self.subword_trie
+        result = (tokens, ids)
+        self.words.put(word, result)
+        return result
+
+    def tokenize_with_ids(self, text):
+        """
+        :return: (wordpieces, ids), the lists are shared by the memo, do not modify them.
+        """
+        result = self.texts.get(text)
+        if result is not None:
+            return result
+        words = self.basic_tokenizer.tokenize(text) if self.basic_tokenizer is not None else text.strip().split()
+        tokens, ids = [], []
+        for word in words:
+            # same as WordpieceTokenizer, which splits every basic token on whitespace again
+            for sub_word in word.split():
+                word_tokens, word_ids = self._tokenize_word(sub_word)
+                tokens.extend(word_tokens)
+                ids.extend(word_ids)
+        result = (tokens, ids)
+        self.texts.put(text, result)
+        return result
+
+    def tokenize(self, text):
+        return list(self.tokenize_with_ids(text)[0])
+
+    def convert_tokens_to_ids(self, tokens):
+        return [self.vocab[token] for token in tokens]